@@ -0,0 +1,78 @@
+"""
+Cost of rendering a whitelabel submission email, with the css inlined on
+every email (as before) and inlined once when the template is saved. Uses
+the default template from the dashboard.
+
+    python benchmarks/email_template.py
+"""
+
+import re
+import time
+import argparse
+import datetime
+
+from formspree.forms.models import EmailTemplate
+
+DEFAULTS = "formspree/js/forms/FormPage/TemplateDefaults.js"
+
+
+def load_default_template():
+    with open(DEFAULTS) as f:
+        source = f.read()
+    parts = {
+        name: value
+        for name, _, value in re.findall(r"const (\w+) = ([`'])(.*?)\2\n", source, re.S)
+    }
+
+    template = EmailTemplate(1)
+    template.id = 1
+    template.subject = parts["subject"]
+    template.from_name = parts["from_name"]
+    template.style = parts["style"]
+    template.body = parts["body"]
+    return template
+
+
+def sample_context(fields):
+    data = {"field%d" % i: "some value\nwith a second line" for i in range(fields)}
+    return EmailTemplate.make_mustache_context(
+        data=data,
+        host="example.com/contact",
+        keys=sorted(data),
+        now=datetime.datetime.utcnow().strftime("%I:%M %p UTC - %d %B %Y"),
+        unconfirm_url="https://formspree.io/unconfirm/1",
+    )
+
+
+def timed(template, context, n):
+    start = time.time()
+    for _ in range(n):
+        template.render_body(context, "https://formspree.io/unconfirm/1")
+        template.render_subject(context)
+    return (time.time() - start) / n * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=200, help="emails per run")
+    parser.add_argument("--fields", type=int, default=8, help="submission fields")
+    args = parser.parse_args()
+
+    template = load_default_template()
+    context = sample_context(args.fields)
+
+    template.inlined_body = None
+    before = timed(template, context, args.n)
+
+    template.inline()
+    if not template.inlined_body:
+        raise SystemExit("the default template can't be inlined ahead of time")
+    after = timed(template, context, args.n)
+
+    print("inlined per email:  %8.2f ms" % before)
+    print("inlined when saved: %8.2f ms" % after)
+    print("speedup:            %8.1fx" % (before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Throughput of submission processing on a single hot form, by number of
+concurrent workers, so what is measured is how much the workers get in each
+other's way on the form's row.
+
+"single" processes each submission in one transaction, holding the form's
+row lock while sending, like we used to. Sending is simulated there with a
+fixed latency. "phased" is the current process_and_commit_submission, which
+only puts the emails in the outbox, for the outbox workers to send later.
+
+    TEST_DATABASE_URL=postgresql:///formspree-test python benchmarks/hot_form.py
+
+It drops and recreates all tables in that database.
+"""
+
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+from unittest.mock import patch
+
+import structlog
+from flask import g
+
+from formspree import settings
+
+settings.SQLALCHEMY_DATABASE_URI = os.getenv("TEST_DATABASE_URL")
+settings.MONTHLY_SUBMISSIONS_LIMIT = 10 ** 9
+
+from formspree.create_app import create_app
+from formspree.app_globals import DB, redis_store
+from formspree.forms.models import (
+    Form,
+    Submission,
+    SubmissionStatus,
+    process_and_commit_submission,
+)
+
+
+def process_in_single_transaction(sub_id, keys):
+    sub = Submission.load_for_processing([sub_id], claim=True)[0]
+    sub.process(keys)
+    sub.status = SubmissionStatus.processed
+    DB.session.commit()
+
+
+def run(app, form_id, mode, workers, n, latency):
+    ids = queue.Queue()
+    with app.app_context():
+        for _ in range(n):
+            sub = Submission(form_id)
+            sub.data = {"name": "alice", "message": "hello"}
+            DB.session.add(sub)
+            DB.session.flush()
+            ids.put(sub.id)
+        DB.session.commit()
+
+    def send_email(kind, **kwargs):
+        # where we used to wait for the provider.
+        time.sleep(latency)
+
+    def worker():
+        with app.test_request_context():
+            g.log = structlog.get_logger().new()
+            while True:
+                try:
+                    sub_id = ids.get_nowait()
+                except queue.Empty:
+                    break
+                if mode == "single":
+                    process_in_single_transaction(sub_id, ["name", "message"])
+                else:
+                    process_and_commit_submission.run(sub_id, ["name", "message"])
+            DB.session.remove()
+
+    if mode == "single":
+        sending = patch("formspree.forms.models.queue_email", side_effect=send_email)
+    else:
+        # there are no outbox workers here, the emails are left in the outbox.
+        sending = patch("formspree.outbox.send_outbox_email.delay")
+
+    with sending:
+        start = time.time()
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return n / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=200, help="submissions per run")
+    parser.add_argument("--latency", type=float, default=0.05, help="send latency")
+    parser.add_argument("--workers", default="1,2,4,8,16")
+    args = parser.parse_args()
+
+    if not settings.SQLALCHEMY_DATABASE_URI:
+        sys.exit("set TEST_DATABASE_URL")
+
+    app = create_app()
+    with app.app_context():
+        DB.drop_all()
+        DB.create_all()
+        form = Form("hot@example.com", host="example.com", confirmed=True)
+        DB.session.add(form)
+        DB.session.commit()
+        form_id = form.id
+
+    print("workers  single (subs/s)  phased (subs/s)")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        single = run(app, form_id, "single", workers, args.n, args.latency)
+        phased = run(app, form_id, "phased", workers, args.n, args.latency)
+        print("%7d  %15.1f  %15.1f" % (workers, single, phased))
+
+    with app.app_context():
+        DB.session.remove()
+        DB.drop_all()
+    redis_store.flushdb()
+
+
+if __name__ == "__main__":
+    main()
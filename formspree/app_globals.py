@@ -1,9 +1,12 @@
+import time
+
 import stripe
 from flask_sqlalchemy import SQLAlchemy
 from flask_cdn import CDN
 from flask_redis import Redis
 from celery import Celery
-from itsdangerous import URLSafeSerializer
+from celery.signals import before_task_publish
+from itsdangerous import URLSafeSerializer, URLSafeTimedSerializer
 
 from . import settings
 
@@ -13,4 +16,59 @@ stripe.api_key = settings.STRIPE_SECRET_KEY
 stripe.api_version = "2018-09-24"
 cdn = CDN()
 celery = Celery(__name__, broker=settings.CELERY_BROKER_URL)
+
+# each queue gets its own workers (see the Procfile), so a backlog in one
+# doesn't hold the others back. submissions to paid forms are processed in
+# their own lane, see enqueue_processing. the emails they send go through
+# the outbox, see queue_email.
+QUEUES = [
+    "submissions_priority",
+    "submissions",
+    "outbox",
+    "mail",
+    "plugins",
+    "webhook_retries",
+    "housekeeping",
+    "celery",
+]
+celery.conf.task_default_queue = "celery"
+celery.conf.task_routes = {
+    "formspree.forms.models.process_and_commit_submission": {"queue": "submissions"},
+    "formspree.forms.models.process_pending_submissions": {"queue": "submissions"},
+    "formspree.forms.models.flush_submission_stream": {"queue": "submissions"},
+    "formspree.outbox.send_outbox_email": {"queue": "outbox"},
+    "formspree.forms.models.send_confirmation_email": {"queue": "mail"},
+    "formspree.users.helpers.send_downgrade_email": {"queue": "mail"},
+    "formspree.users.helpers.send_downgrade_reason_email": {"queue": "mail"},
+    "formspree.plugins.helpers.dispatch_webhook": {"queue": "plugins"},
+    "formspree.forms.models.fold_counter_deltas": {"queue": "housekeeping"},
+    "formspree.forms.models.reap_stuck_submissions": {"queue": "housekeeping"},
+    "formspree.outbox.drain_outbox": {"queue": "housekeeping"},
+    "formspree.forms.models.send_due_digests": {"queue": "housekeeping"},
+}
+celery.conf.beat_schedule = {
+    "fold-counter-deltas": {
+        "task": "formspree.forms.models.fold_counter_deltas",
+        "schedule": settings.COUNTER_FOLD_INTERVAL,
+    },
+    "reap-stuck-submissions": {
+        "task": "formspree.forms.models.reap_stuck_submissions",
+        "schedule": settings.REAPER_INTERVAL,
+    },
+    "drain-outbox": {
+        "task": "formspree.outbox.drain_outbox",
+        "schedule": settings.OUTBOX_DRAIN_INTERVAL,
+    },
+    "send-due-digests": {
+        "task": "formspree.forms.models.send_due_digests",
+        "schedule": settings.DIGEST_CHECK_INTERVAL,
+    },
+}
 spam_serializer = URLSafeSerializer(settings.SPAM_SECRET)
+host_serializer = URLSafeTimedSerializer(settings.NONCE_SECRET, salt="host-nonce")
+
+
+@before_task_publish.connect
+def stamp_enqueued_at(headers=None, **kwargs):
+    # lets get_queue_stats tell how long the oldest task has been waiting
+    headers["enqueued_at"] = time.time()
@@ -3,7 +3,16 @@ import os
 import re
 import structlog
 
-from flask import Flask, g, request, url_for, redirect, jsonify
+from flask import (
+    Flask,
+    g,
+    request,
+    url_for,
+    redirect,
+    jsonify,
+    current_app,
+    has_app_context,
+)
 from flask_login import LoginManager
 from flask_limiter import Limiter
 from flask_limiter.util import get_ipaddr
@@ -125,7 +134,9 @@ def create_app():
 
     class ContextTask(celery.Task):
         def __call__(self, *args, **kwargs):
-            if app.config["TESTING"]:
+            # Tasks keep the base class they were bound with, which may come from
+            # another app than the one running them, so look at the current one.
+            if has_app_context() and current_app.config["TESTING"]:
                 # When testing, celery tasks are called eagerly, from the same thread
                 # so don't push an app context, the request's app context is already there
                 return self.run(*args, **kwargs)
@@ -30,17 +30,24 @@ def _do_premailer(source_map):
     transformed = dict()
     for filename, source in source_map.items():
         p = Premailer(source, remove_classes=True)
-        transformed_template = p.transform()
-
-        # weird issue with jinja templates beforehand so we use this hack
-        # see https://github.com/peterbe/premailer/issues/72
-        mapping = (("%7B%7B", "{{"), ("%7D%7D", "}}"), ("%20", " "))
-        for k, v in mapping:
-            transformed_template = transformed_template.replace(k, v)
-        transformed[filename] = transformed_template
+        transformed[filename] = unescape_template_tags(p.transform())
     return transformed
 
 
+def unescape_template_tags(html):
+    """
+    lxml escapes {{ tags }} (jinja or mustache) found in urls when premailer
+    writes the html back, so we put them back.
+    """
+
+    # weird issue with jinja templates beforehand so we use this hack
+    # see https://github.com/peterbe/premailer/issues/72
+    mapping = (("%7B%7B", "{{"), ("%7D%7D", "}}"), ("%20", " "))
+    for k, v in mapping:
+        html = html.replace(k, v)
+    return html
+
+
 def _load_templates():
     templates = dict()
     for filename in os.listdir(TEMPLATES_DIR):
@@ -3,12 +3,14 @@ from lxml.html import rewrite_links
 from flask import request, jsonify, g
 from flask_cors import cross_origin
 from flask_login import current_user, login_required
+from sqlalchemy.orm import undefer
 
 from formspree import settings
 from formspree.app_globals import DB, spam_serializer
 from formspree.utils import prevent_xsrf, requires_feature
 from .helpers import form_control
 from .models import Form, Submission, EmailTemplate, RoutingRule
+from .routing import check_trigger
 from ..utils import unflattenUrlParams
 
 
@@ -17,7 +19,11 @@ from ..utils import unflattenUrlParams
 def list_forms():
     # grab all the forms this user controls
     if current_user.has_feature("dashboard"):
-        forms = current_user.forms.order_by(Form.id.desc()).all()
+        forms = (
+            current_user.forms.options(undefer("counter"))
+            .order_by(Form.id.desc())
+            .all()
+        )
     else:
         forms = []
 
@@ -74,6 +80,9 @@ def update_form(hashid, form):
     if "email" in patch and patch["email"] not in current_user.verified_addresses:
         return jsonify({"ok": False, "error": "Email not verified."}), 403
 
+    if patch.get("digest_interval") not in [None] + settings.DIGEST_INTERVALS:
+        return jsonify({"ok": False, "error": "Invalid digest interval."}), 400
+
     for attr in [
         "name",
         "email",
@@ -81,6 +90,7 @@ def update_form(hashid, form):
         "disabled",
         "disable_email",
         "captcha_disabled",
+        "digest_interval",
     ]:
         if attr in patch:
             setattr(form, attr, patch[attr])
@@ -115,8 +125,9 @@ def add_or_update_rule(hashid, form, ruleid=None):
     } != rule_data["trigger"].keys():
         return jsonify({"ok": False, "error": "Missing required parameters."}), 400
 
-    if rule_data["trigger"]["fn"] not in RoutingRule.functions:
-        return jsonify({"ok": False, "error": "Invalid function."}), 400
+    error = check_trigger(rule_data["trigger"])
+    if error:
+        return jsonify({"ok": False, "error": error}), 400
 
     if rule_data["email"] not in current_user.verified_addresses:
         return jsonify({"ok": False, "error": "Email not verified."}), 403
@@ -129,6 +140,7 @@ def add_or_update_rule(hashid, form, ruleid=None):
     rule.trigger = rule_data["trigger"]
     rule.email = rule_data["email"]
     DB.session.add(rule)
+    form.rules_changed()
     DB.session.commit()
     return jsonify({"ok": True, "id": rule.id}), 200 if ruleid else 201
 
@@ -140,6 +152,7 @@ def add_or_update_rule(hashid, form, ruleid=None):
 def delete_rule(ruleid, hashid, form):
     rule = form.routing_rules.filter_by(id=ruleid).first()
     DB.session.delete(rule)
+    form.rules_changed()
     DB.session.commit()
     return jsonify({"ok": True})
 
@@ -228,9 +241,8 @@ def submission_delete(hashid, form):
         DB.session.delete(sub)
         # spam submissions aren't counted
         if not sub.spam:
-            form.counter -= 1
+            form.add_to_counter(-1)
 
-    DB.session.add(form)
     DB.session.commit()
     return jsonify({"ok": True, "deleted": len(subs), "counter": form.counter})
 
@@ -254,13 +266,12 @@ def submission_set(hashid, form):
         # Only inc/dec counter when spam value changes. However, just checking
         # that spam != sub.spam doesn't work when spam == False and sub.spam == None
         if spam and not sub.spam:
-            form.counter -= 1
+            form.add_to_counter(-1)
         if not spam and sub.spam:
-            form.counter += 1
+            form.add_to_counter(1)
         sub.spam = spam
         DB.session.add(sub)
 
-    DB.session.add(form)
     DB.session.commit()
     return jsonify({"ok": True, "updated": len(subs), "counter": form.counter})
 
@@ -282,10 +293,13 @@ def custom_template_set(hashid, form):
 
     if template.body or template.subject:
         try:
+            template.inline()
             template.render_with_sample_context()
         except Exception as e:
             print(e)
             return jsonify({"error": "Failed to render. The template has errors."}), 406
+    else:
+        template.inlined_body = None
 
     DB.session.add(template)
     DB.session.commit()
@@ -11,6 +11,7 @@ from formspree.utils import (
     url_domain,
     referrer_to_path,
     verify_captcha,
+    next_url,
 )
 from formspree.forms import errors
 from formspree.forms.errors import SubmitFormError
@@ -19,8 +20,14 @@ from formspree.forms.helpers import (
     ordered_storage,
     temp_store_hostname,
     get_temp_hostname,
+    submission_idempotency_key,
+    claim_submission,
+    store_submission_status,
+    release_submission_claim,
+    take_submission_token,
 )
 from formspree.forms.models import Form
+from formspree.stats import incr_stat
 
 
 def get_host_and_referrer(received_data):
@@ -56,12 +63,14 @@ def validate_user_form(hashid):
     Checks to make sure the submission can be accepted by this form.
     """
 
-    form = Form.get_with(hashid=hashid)
+    form = Form.get_cached(hashid=hashid)
 
     if not form:
+        incr_stat("submission_rejected_bad_hashid")
         raise SubmitFormError(errors.bad_hashid_error(hashid))
 
     if form.disabled:
+        incr_stat("submission_rejected_disabled")
         raise SubmitFormError(errors.disabled_error())
 
     return form
@@ -74,7 +83,7 @@ def get_or_create_form(email, host):
     new form.
     """
 
-    form = Form.get_with(email=email, host=host)
+    form = Form.get_cached(email=email, host=host)
 
     if not form:
         if request_wants_json():
@@ -104,14 +113,26 @@ def get_or_create_form(email, host):
             )
 
         # all good, create form
-        form = Form(email, host=host, confirmed=False, normalize=True)
+        form = Form.create_spontaneous(email, host)
 
     if form.disabled:
+        incr_stat("submission_rejected_disabled")
         raise SubmitFormError(errors.disabled_error())
 
     return form
 
 
+def check_rate_limit(form):
+    """
+    Rejects the submission if the form is getting more submissions than its
+    plan allows (see Plan.plan_defs).
+    """
+
+    retry_after = take_submission_token(form.id, **form.submission_rate)
+    if retry_after:
+        raise SubmitFormError(errors.rate_limited_error(retry_after))
+
+
 def check_captcha(form, email_or_string, received_data, sorted_keys):
     """
     Checks to see if a captcha page is required, if so renders it.
@@ -145,7 +166,7 @@ def check_captcha(form, email_or_string, received_data, sorted_keys):
             )
 
         data_copy = received_data.copy()
-        # Temporarily store hostname in redis while doing captcha
+        # Carry the hostname through the captcha page
         nonce = temp_store_hostname(form.host, request.referrer)
         data_copy["_host_nonce"] = nonce
         action = urljoin(settings.API_ROOT, email_or_string)
@@ -219,8 +240,50 @@ def response_for_status(form, host, referrer, status):
     return errors.generic_send_error(status)
 
 
+def submit_once(form, received_data, sorted_keys, referrer, overlimit=False):
+    """
+    Submits the form unless the same submission was already received (same
+    Idempotency-Key, or same data within a short window), in which case the
+    response we gave to the first one is repeated.
+    """
+
+    key, ttl = submission_idempotency_key(
+        form.id, received_data, request.headers.get("Idempotency-Key")
+    )
+    if not key:
+        return form.submit(received_data, sorted_keys, referrer, overlimit)
+
+    previous = claim_submission(key, ttl)
+    if previous is not None:
+        g.log.info("Duplicate submission suppressed.")
+        incr_stat("submission_duplicate_suppressed")
+        return previous or {
+            "code": Form.STATUS_SUBMISSION_ENQUEUED,
+            "next": next_url(referrer, received_data.get("_next")),
+        }
+
+    try:
+        status = form.submit(received_data, sorted_keys, referrer, overlimit)
+    except:
+        release_submission_claim(key)
+        raise
+
+    if status["code"] == Form.STATUS_SUBMISSION_ENQUEUED:
+        store_submission_status(key, ttl, status)
+    else:
+        # let the user fix the problem and try again.
+        release_submission_claim(key)
+    return status
+
+
 @cross_origin(
-    allow_headers=["Accept", "Content-Type", "X-Requested-With", "Authorization"]
+    allow_headers=[
+        "Accept",
+        "Content-Type",
+        "X-Requested-With",
+        "Authorization",
+        "Idempotency-Key",
+    ]
 )
 @ordered_storage
 def post(email_or_string):
@@ -233,6 +296,7 @@ def post(email_or_string):
     g.log = g.log.bind(target=email_or_string)
 
     if request.method == "GET":
+        incr_stat("submission_rejected_get")
         return errors.bad_method_error()
 
     if request.form:
@@ -274,7 +338,18 @@ def post(email_or_string):
     # If form exists and is confirmed, send email
     # otherwise send a confirmation email
     if form.confirmed:
-        status = form.submit(received_data, sorted_keys, referrer)
+        # only now, so going through the captcha doesn't cost the visitor
+        # a second token.
+        try:
+            check_rate_limit(form)
+        except SubmitFormError as vfe:
+            return vfe.response
+
+        # far over the monthly limit, processing wouldn't send anything.
+        # they are stored, or not, but never queued.
+        status = submit_once(
+            form, received_data, sorted_keys, referrer, form.is_far_over_limit()
+        )
     else:
         status = form.send_confirmation(
             store_data=received_data, sorted_keys=sorted_keys
@@ -1,4 +1,5 @@
 import json
+import math
 
 from flask import request, render_template, jsonify, g
 
@@ -154,3 +155,26 @@ def generic_send_error(status):
         ),
         500,
     )
+
+
+def rate_limited_error(retry_after):
+    g.log.info("Submission rejected. Form is rate limited.")
+    headers = {"Retry-After": str(int(math.ceil(retry_after)))}
+
+    if request_wants_json():
+        return (
+            jsonify({"error": "Too many submissions, please try again later."}),
+            429,
+            headers,
+        )
+
+    return (
+        render_template(
+            "error.html",
+            title="Too many submissions",
+            text="This form is receiving too many submissions right now. "
+            "Please try again in a few moments.",
+        ),
+        429,
+        headers,
+    )
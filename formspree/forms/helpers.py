@@ -1,4 +1,6 @@
 import werkzeug.datastructures
+import re
+import time
 import datetime
 import hashlib
 import hashids
@@ -9,9 +11,10 @@ from functools import wraps, partial
 from flask import request, jsonify
 from flask_login import current_user
 from werkzeug.datastructures import ImmutableMultiDict, ImmutableOrderedMultiDict
+from itsdangerous import BadSignature, SignatureExpired
 
 from formspree import settings
-from formspree.app_globals import redis_store
+from formspree.app_globals import redis_store, host_serializer
 from formspree.utils import (
     CAPTCHA_VAL,
     referrer_to_path,
@@ -22,12 +25,39 @@ HASH = lambda x, y: hashlib.md5(
     x.encode("utf-8") + y.encode("utf-8") + settings.NONCE_SECRET
 ).hexdigest()
 
-KEYS_NOT_STORED = {"_gotcha", "_language", CAPTCHA_VAL, "_host_nonce", "_next"}
+KEYS_NOT_STORED = {
+    "_gotcha",
+    "_language",
+    CAPTCHA_VAL,
+    "_host_nonce",
+    "_next",
+    "_idempotency",
+}
 KEYS_EXCLUDED_FROM_EMAIL = KEYS_NOT_STORED.union({"_subject", "_cc", "_format"})
 
-REDIS_COUNTER_KEY = "monthly_{form_id}_{month}".format
+REDIS_COUNTER_KEY = "monthly_{form_id}_{month}".format  # legacy, see below
+REDIS_MONTHLY_COUNTERS_KEY = "monthly_counts_{year}_{month:02d}".format
+REDIS_SUBMISSION_COUNTED_KEY = "counted_submission_{submission_id}".format
 REDIS_HOSTNAME_KEY = "hostname_{nonce}".format
 REDIS_FIRSTSUBMISSION_KEY = "first_{nonce}".format
+REDIS_FEATURES_KEY = "features_{form_id}".format
+REDIS_FEATURES_USER_KEY = "features_user_{user_id}".format
+REDIS_FEATURES_ADDRESS_KEY = "features_address_{address}".format
+REDIS_FORM_HASHID_KEY = "form_hashid_{hashid}".format
+REDIS_FORM_HOST_KEY = "form_{email}_{host}".format
+REDIS_FORM_LOOKUPS_KEY = "form_lookups_{ref}".format
+REDIS_RATE_BUCKET_KEY = "rate_bucket_{form_id}".format
+REDIS_RATE_REJECTIONS_KEY = "rate_rejections_{day}".format
+REDIS_IDEMPOTENCY_KEY = "idempotency_{form_id}_{digest}".format
+REDIS_INGEST_STREAM_KEY = "ingest_submissions"
+REDIS_INGEST_SCHEDULED_KEY = "ingest_scheduled"
+REDIS_INGEST_LOCK_KEY = "ingest_lock"
+REDIS_INGEST_DEAD_LETTER_KEY = "ingest_dead_letter"
+REDIS_BATCH_SCHEDULED_KEY = "batch_scheduled"
+REDIS_STORED_SUBMISSIONS_KEY = "stored_submissions_{form_id}".format
+REDIS_STORED_SUBMISSIONS_MISSED_KEY = "stored_submissions_missed_{form_id}".format
+REDIS_DIGEST_KEY = "digest_{form_id}".format
+REDIS_DIGESTS_DUE_KEY = "digests_due"
 HASHIDS_CODEC = hashids.Hashids(
     alphabet="abcdefghijklmnopqrstuvwxyz", min_length=8, salt=settings.HASHIDS_SALT
 )
@@ -76,7 +106,16 @@ def remove_www(host):
     return host
 
 
+def normalize_email(email):
+    # same as the normalize_email() function we have on postgres
+    return re.sub(r"\+[^@]*@", "@", email)
+
+
 def temp_store_hostname(hostname, referrer):
+    if settings.SIGNED_HOST_NONCE:
+        # the nonce carries the values itself, signed and timestamped.
+        return host_serializer.dumps([hostname, referrer or ""])
+
     nonce = uuid.uuid4()
     key = REDIS_HOSTNAME_KEY(nonce=nonce)
     redis_store.set(key, "{},{}".format(hostname or "--NONE--", referrer or ""))
@@ -85,6 +124,11 @@ def temp_store_hostname(hostname, referrer):
 
 
 def get_temp_hostname(nonce):
+    # signed nonces always have dots in them, uuids from the old
+    # redis-backed format never do.
+    if "." in nonce:
+        return get_signed_temp_hostname(nonce)
+
     key = REDIS_HOSTNAME_KEY(nonce=nonce)
     value = redis_store.get(key)
     if value is None:
@@ -100,6 +144,303 @@ def get_temp_hostname(nonce):
             return values
 
 
+def get_signed_temp_hostname(nonce):
+    try:
+        hostname, referrer = host_serializer.loads(
+            nonce, max_age=settings.HOST_NONCE_MAX_AGE
+        )
+    except SignatureExpired:
+        raise KeyError("temp_hostname nonce has expired.")
+    except (BadSignature, TypeError, ValueError):
+        # sent by the client, tampering with it is no reason for an error
+        # page. it is ignored like a missing one.
+        raise KeyError("temp_hostname nonce is invalid.")
+
+    if hostname is None:
+        return referrer_to_path(referrer), referrer
+    return hostname, referrer
+
+
+# KEYS: bucket, rejections
+# ARGV: burst, tokens per second, now, rejections to count, form id,
+#       rejections retention
+TOKEN_BUCKET_LUA = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local rejected = tonumber(ARGV[4])
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+else
+  rejected = rejected + 1
+end
+
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "ts", ARGV[3])
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+
+if rejected > 0 then
+  redis.call("HINCRBY", KEYS[2], ARGV[5], rejected)
+  redis.call("EXPIRE", KEYS[2], ARGV[6])
+end
+
+return {allowed, math.ceil((1 - tokens) / rate * 1000)}
+"""
+
+_token_bucket_script = None
+
+# form id -> [time until which it is known to be out of tokens,
+#             rejections not yet counted on redis]
+_rate_limited_until = {}
+
+
+def take_submission_token(form_id, burst, per_minute):
+    """
+    Takes a token from the form's bucket, which holds `burst` tokens and is
+    refilled at `per_minute`. Returns 0 if a token was taken, otherwise the
+    seconds until one is available.
+
+    Forms found out of tokens are remembered in this process until their
+    bucket refills, so floods are rejected without a redis call. Those
+    rejections are counted on redis the next time the form goes there.
+    """
+
+    global _token_bucket_script
+
+    now = time.time()
+    limited = _rate_limited_until.pop(form_id, None)
+    if limited and now < limited[0]:
+        limited[1] += 1
+        _rate_limited_until[form_id] = limited
+        return limited[0] - now
+
+    if _token_bucket_script is None:
+        _token_bucket_script = redis_store.register_script(TOKEN_BUCKET_LUA)
+
+    allowed, wait_ms = _token_bucket_script(
+        keys=[
+            REDIS_RATE_BUCKET_KEY(form_id=form_id),
+            REDIS_RATE_REJECTIONS_KEY(day=datetime.date.today().isoformat()),
+        ],
+        args=[
+            burst,
+            per_minute / 60.0,
+            repr(now),
+            limited[1] if limited else 0,
+            form_id,
+            settings.STATS_RETENTION_DAYS * 86400,
+        ],
+        client=redis_store,
+    )
+    if allowed:
+        return 0
+
+    if len(_rate_limited_until) > 10000:
+        _rate_limited_until.clear()
+    _rate_limited_until[form_id] = [now + wait_ms / 1000.0, 0]
+    return wait_ms / 1000.0
+
+
+def get_rate_rejections(day):
+    values = redis_store.hgetall(REDIS_RATE_REJECTIONS_KEY(day=day.isoformat()))
+    return {int(k): int(v) for k, v in values.items()}
+
+
+def submission_idempotency_key(form_id, data, idempotency_key=None):
+    """
+    Returns the redis key that identifies this submission and for how long
+    it should be remembered: a day if the client sent an idempotency key,
+    DUPLICATE_SUBMISSION_WINDOW otherwise, when the submission is identified
+    by its contents. (None, None) if duplicates shouldn't be checked.
+    """
+
+    idempotency_key = idempotency_key or data.get("_idempotency")
+    if idempotency_key:
+        token, ttl = "key:" + idempotency_key, settings.IDEMPOTENCY_KEY_TTL
+    elif settings.DUPLICATE_SUBMISSION_WINDOW:
+        stored = {k: v for k, v in data.items() if k not in KEYS_NOT_STORED}
+        token = "data:" + json.dumps(stored, sort_keys=True)
+        ttl = settings.DUPLICATE_SUBMISSION_WINDOW
+    else:
+        return None, None
+
+    digest = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    return REDIS_IDEMPOTENCY_KEY(form_id=form_id, digest=digest), ttl
+
+
+def claim_submission(key, ttl):
+    """
+    Returns None if this is the first time we see this submission. Otherwise
+    returns the status stored for the first one, an empty dict if it is
+    still being handled.
+    """
+
+    if redis_store.set(key, "{}", nx=True, ex=ttl):
+        return None
+    value = redis_store.get(key)
+    return json.loads(value.decode("utf-8")) if value else {}
+
+
+def store_submission_status(key, ttl, status):
+    redis_store.set(key, json.dumps(status), ex=ttl)
+
+
+def release_submission_claim(key):
+    redis_store.delete(key)
+
+
+def stream_submission(entry):
+    """
+    Appends a submission to the ingest stream. Returns True if no flush of
+    the stream is scheduled yet, meaning the caller should schedule one.
+    """
+
+    pipe = redis_store.pipeline(transaction=False)
+    pipe.execute_command(
+        "XADD", REDIS_INGEST_STREAM_KEY, "*", "entry", json.dumps(entry)
+    )
+    pipe.set(REDIS_INGEST_SCHEDULED_KEY, 1, nx=True, ex=60)
+    _, schedule = pipe.execute()
+    return bool(schedule)
+
+
+def claim_batch_schedule():
+    """
+    Returns True if no batch processing run is scheduled yet, meaning the
+    caller should schedule one.
+    """
+
+    return bool(redis_store.set(REDIS_BATCH_SCHEDULED_KEY, 1, nx=True, ex=60))
+
+
+def read_streamed_submissions(count):
+    entries = redis_store.execute_command(
+        "XRANGE", REDIS_INGEST_STREAM_KEY, "-", "+", "COUNT", count
+    )
+    return [
+        (id, json.loads(dict(zip(fields[::2], fields[1::2]))[b"entry"].decode("utf-8")))
+        for id, fields in entries
+    ]
+
+
+def delete_streamed_submissions(ids):
+    if ids:
+        redis_store.execute_command("XDEL", REDIS_INGEST_STREAM_KEY, *ids)
+
+
+def dead_letter_streamed_submissions(entries):
+    """
+    Keeps the (stream id, entry) pairs that couldn't be flushed aside, for
+    someone to look into, before they are deleted from the stream.
+    """
+
+    if entries:
+        redis_store.rpush(
+            REDIS_INGEST_DEAD_LETTER_KEY,
+            *[
+                json.dumps({"id": stream_id.decode("utf-8"), "entry": entry})
+                for stream_id, entry in entries
+            ]
+        )
+
+
+def add_to_digest(form_id, entry, interval):
+    """
+    Appends a submission to the next digest of its form. The first one
+    schedules the digest to be sent `interval` seconds later, see
+    send_due_digests.
+    """
+
+    pipe = redis_store.pipeline()
+    pipe.rpush(REDIS_DIGEST_KEY(form_id=form_id), json.dumps(entry))
+    pipe.execute_command(
+        "ZADD", REDIS_DIGESTS_DUE_KEY, "NX", time.time() + interval, form_id
+    )
+    pipe.execute()
+
+
+# due digests are put off by `lease` seconds, so no other worker sends them
+# meanwhile and, if sending fails, they are tried again once it's over.
+CLAIM_DUE_DIGESTS_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, form_id in ipairs(due) do
+  redis.call('ZADD', KEYS[1], 'XX', ARGV[2], form_id)
+end
+return due
+"""
+_claim_due_digests_script = None
+
+
+def claim_due_digests(now=None, lease=60):
+    """
+    Returns the ids of the forms whose digests are due, putting them off by
+    `lease` seconds so only one worker sends each. drop_digest_entries ends
+    the claim.
+    """
+
+    global _claim_due_digests_script
+
+    if _claim_due_digests_script is None:
+        _claim_due_digests_script = redis_store.register_script(
+            CLAIM_DUE_DIGESTS_LUA
+        )
+    now = now or time.time()
+    due = _claim_due_digests_script(
+        keys=[REDIS_DIGESTS_DUE_KEY], args=[now, now + lease], client=redis_store
+    )
+    return [int(form_id) for form_id in due]
+
+
+def read_digest(form_id):
+    """
+    Returns the entries accumulated for a form's digest. They are kept
+    until drop_digest_entries is called, once the digest is committed.
+    """
+
+    entries = redis_store.lrange(REDIS_DIGEST_KEY(form_id=form_id), 0, -1)
+    return [json.loads(entry.decode("utf-8")) for entry in entries]
+
+
+# entries that came in while the digest was being sent stay for the next
+# one, which replaces the claim on the schedule.
+DROP_DIGEST_ENTRIES_LUA = """
+redis.call('LTRIM', KEYS[1], ARGV[1], -1)
+if redis.call('LLEN', KEYS[1]) > 0 then
+  redis.call('ZADD', KEYS[2], ARGV[2], ARGV[3])
+else
+  redis.call('ZREM', KEYS[2], ARGV[3])
+end
+"""
+_drop_digest_entries_script = None
+
+
+def drop_digest_entries(form_id, count, interval):
+    """
+    Removes the first `count` entries of a form's digest, those that were
+    sent, and ends its claim. If there are more, they are sent `interval`
+    seconds later.
+    """
+
+    global _drop_digest_entries_script
+
+    if _drop_digest_entries_script is None:
+        _drop_digest_entries_script = redis_store.register_script(
+            DROP_DIGEST_ENTRIES_LUA
+        )
+    _drop_digest_entries_script(
+        keys=[REDIS_DIGEST_KEY(form_id=form_id), REDIS_DIGESTS_DUE_KEY],
+        args=[count, time.time() + interval, form_id],
+        client=redis_store,
+    )
+
+
 def store_first_submission(nonce, store_data, sorted_keys=[]):
     if type(store_data) in (ImmutableMultiDict, ImmutableOrderedMultiDict):
         data, _ = http_form_to_dict(store_data)
@@ -108,14 +449,18 @@ def store_first_submission(nonce, store_data, sorted_keys=[]):
 
     data["_sorted_keys"] = sorted_keys
 
+    # until the confirmation email goes out more submissions may come, keep
+    # the first one.
     key = REDIS_FIRSTSUBMISSION_KEY(nonce=nonce)
-    redis_store.set(key, json.dumps(data))
-    redis_store.expire(key, 300000)
+    redis_store.set(key, json.dumps(data), nx=True, ex=300000)
 
 
 def fetch_first_submission(nonce):
     key = REDIS_FIRSTSUBMISSION_KEY(nonce=nonce)
-    jsondata = redis_store.get(key)
+    pipe = redis_store.pipeline()
+    pipe.get(key)
+    pipe.delete(key)
+    jsondata, _ = pipe.execute()
     try:
         data = json.loads(jsondata.decode("utf-8"))
         keys = data.keys()
@@ -126,21 +471,308 @@ def fetch_first_submission(nonce):
         return None, []
 
 
-def increase_monthly_counter(form_id, basedate=None):
+# monthly counters live in one hash per month, keyed by form id. the first
+# increment of a form in a month folds in what the legacy per-form key
+# (which didn't know the year) had counted for it.
+MONTHLY_COUNTER_LUA = """
+if KEYS[3] and not redis.call('SET', KEYS[3], 1, 'NX', 'EX', ARGV[3]) then
+  -- already counted, by an attempt to process it that didn't go through.
+  local n = redis.call('HGET', KEYS[1], ARGV[1]) or redis.call('GET', KEYS[2])
+  return tonumber(n) or 0
+end
+local n = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+if n == 1 then
+  local legacy = tonumber(redis.call('GET', KEYS[2]))
+  if legacy then
+    n = redis.call('HINCRBY', KEYS[1], ARGV[1], legacy)
+    redis.call('DEL', KEYS[2])
+  end
+end
+redis.call('EXPIREAT', KEYS[1], ARGV[2])
+return n
+"""
+_monthly_counter_script = None
+
+# longer than reap_stuck_submissions keeps trying a submission.
+SUBMISSION_COUNTED_TTL = 7 * 86400
+
+
+def increase_monthly_counter(form_id, basedate=None, submission_id=None):
+    """
+    Counts a submission to the form this month and returns the count. A
+    submission given by id is only counted once, however many times it is
+    processed.
+    """
+
+    global _monthly_counter_script
+
     basedate = basedate or datetime.datetime.now()
-    month = basedate.month
-    key = REDIS_COUNTER_KEY(form_id=form_id, month=month)
-    counter = redis_store.incr(key)
-    redis_store.expireat(key, unix_time_for_12_months_from_now(basedate))
+    if _monthly_counter_script is None:
+        _monthly_counter_script = redis_store.register_script(MONTHLY_COUNTER_LUA)
+
+    keys = [
+        REDIS_MONTHLY_COUNTERS_KEY(year=basedate.year, month=basedate.month),
+        REDIS_COUNTER_KEY(form_id=form_id, month=basedate.month),
+    ]
+    if submission_id is not None:
+        keys.append(REDIS_SUBMISSION_COUNTED_KEY(submission_id=submission_id))
+
+    counter = _monthly_counter_script(
+        keys=keys,
+        args=[
+            form_id,
+            unix_time_for_12_months_from_now(basedate),
+            SUBMISSION_COUNTED_TTL,
+        ],
+        client=redis_store,
+    )
     return int(counter)
 
 
 def get_monthly_counter(form_id, basedate=None):
     basedate = basedate or datetime.datetime.now()
-    month = basedate.month
-    key = REDIS_COUNTER_KEY(form_id=form_id, month=month)
-    counter = redis_store.get(key) or 0
-    return int(counter)
+    counter = redis_store.hget(
+        REDIS_MONTHLY_COUNTERS_KEY(year=basedate.year, month=basedate.month), form_id
+    )
+    if counter is None:
+        # not submitted to since the switch, or not at all
+        counter = redis_store.get(
+            REDIS_COUNTER_KEY(form_id=form_id, month=basedate.month)
+        )
+    return int(counter or 0)
+
+
+def get_monthly_counters(year, month):
+    """
+    The counts of all forms submitted to in the given month, by form id.
+    """
+
+    counters = redis_store.hgetall(REDIS_MONTHLY_COUNTERS_KEY(year=year, month=month))
+    return {int(form_id): int(n) for form_id, n in counters.items()}
+
+
+def migrate_legacy_monthly_counters():
+    """
+    Moves the counts left in legacy `monthly_{form_id}_{month}` keys into
+    the monthly hashes. Those keys expire 12 months after the start of the
+    month they were last written in, which tells us the year. Returns how
+    many keys were moved.
+    """
+
+    moved = 0
+    for key in redis_store.scan_iter(match="monthly_*"):
+        m = re.match(r"^monthly_(\d+)_(\d+)$", key.decode("utf-8"))
+        expires_at = redis_store.ttl(key)
+        if not m or expires_at is None or expires_at < 0:
+            continue
+        form_id, month = int(m.group(1)), int(m.group(2))
+        expires_at = int(time.time()) + expires_at
+        year = datetime.datetime.utcfromtimestamp(expires_at).year - 1
+
+        # taken atomically, so a submission folding it in at the same time
+        # (see MONTHLY_COUNTER_LUA) can't count it twice.
+        pipe = redis_store.pipeline()
+        pipe.get(key)
+        pipe.delete(key)
+        counter, _ = pipe.execute()
+        if counter is None:
+            continue
+
+        hash_key = REDIS_MONTHLY_COUNTERS_KEY(year=year, month=month)
+        pipe = redis_store.pipeline()
+        pipe.hincrby(hash_key, form_id, int(counter))
+        pipe.expireat(
+            hash_key, unix_time_for_12_months_from_now(datetime.date(year, month, 1))
+        )
+        pipe.execute()
+        moved += 1
+    return moved
+
+
+# the number of submissions a form has stored, kept up to date as they are
+# inserted and deleted so trimming the archive doesn't have to count them.
+# changes to a form whose count isn't known are dropped (only how many were
+# dropped is kept); it will be counted from the database the next time it is
+# needed. counts expire regardless of changes, so they are checked against
+# the database every STORED_SUBMISSIONS_TTL.
+STORED_SUBMISSIONS_TTL = 86400
+CHANGE_STORED_SUBMISSIONS_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+"""
+_change_stored_submissions_script = None
+
+# a count is only kept if no change was dropped since before counting, as
+# changes committed while counting may or may not have been seen by it.
+SEED_STORED_SUBMISSIONS_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0
+  and (tonumber(redis.call('GET', KEYS[2])) or 0) == tonumber(ARGV[2]) then
+  redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+end
+"""
+_seed_stored_submissions_script = None
+
+
+def get_stored_submissions(form_id, count):
+    """
+    Returns the number of submissions stored for the form, calling
+    `count()` to get it from the database if we don't know it.
+    """
+
+    global _seed_stored_submissions_script
+
+    key = REDIS_STORED_SUBMISSIONS_KEY(form_id=form_id)
+    stored = redis_store.get(key)
+    if stored is not None:
+        return int(stored)
+
+    missed_key = REDIS_STORED_SUBMISSIONS_MISSED_KEY(form_id=form_id)
+    missed = int(redis_store.get(missed_key) or 0)
+    stored = count()
+
+    if _seed_stored_submissions_script is None:
+        _seed_stored_submissions_script = redis_store.register_script(
+            SEED_STORED_SUBMISSIONS_LUA
+        )
+    _seed_stored_submissions_script(
+        keys=[key, missed_key],
+        args=[stored, missed, STORED_SUBMISSIONS_TTL],
+        client=redis_store,
+    )
+    return stored
+
+
+def change_stored_submissions(changes):
+    """
+    Applies {form_id: delta} to the counts of stored submissions. Only call
+    it after the changes are committed.
+    """
+
+    global _change_stored_submissions_script
+
+    if _change_stored_submissions_script is None:
+        _change_stored_submissions_script = redis_store.register_script(
+            CHANGE_STORED_SUBMISSIONS_LUA
+        )
+
+    pipe = redis_store.pipeline(transaction=False)
+    for form_id, delta in changes.items():
+        if delta:
+            _change_stored_submissions_script(
+                keys=[
+                    REDIS_STORED_SUBMISSIONS_KEY(form_id=form_id),
+                    REDIS_STORED_SUBMISSIONS_MISSED_KEY(form_id=form_id),
+                ],
+                args=[delta, STORED_SUBMISSIONS_TTL],
+                client=pipe,
+            )
+    pipe.execute()
+
+
+def get_cached_controllers(form_id):
+    value = redis_store.get(REDIS_FEATURES_KEY(form_id=form_id))
+    if value is None:
+        return None
+    return json.loads(value.decode("utf-8"))
+
+
+def cache_controllers(form_id, email, controllers):
+    """
+    Stores the ids of the users controlling a form and their merged features.
+    The form is also indexed under each of these users and under its normalized
+    address, so plan changes and linked emails can find the entries to drop.
+    """
+
+    pipe = redis_store.pipeline(transaction=False)
+    pipe.set(
+        REDIS_FEATURES_KEY(form_id=form_id),
+        json.dumps(controllers),
+        ex=settings.FEATURES_CACHE_TTL,
+    )
+    index_controlled_form(pipe, form_id, email, controllers["ids"])
+    pipe.execute()
+
+
+def index_controlled_form(pipe, form_id, email, controller_ids):
+    # the features are cached both on their own and in form snapshots, the
+    # index has to outlive whichever is kept longer.
+    ttl = max(settings.FEATURES_CACHE_TTL, settings.FORM_CACHE_TTL)
+    index_keys = [REDIS_FEATURES_USER_KEY(user_id=id) for id in controller_ids]
+    if email:
+        index_keys.append(REDIS_FEATURES_ADDRESS_KEY(address=normalize_email(email)))
+    for key in index_keys:
+        pipe.sadd(key, form_id)
+        pipe.expire(key, ttl)
+
+
+def get_cached_form(key):
+    """
+    Returns the cached form snapshot, or None if the lookup is known to match
+    no form. Raises KeyError if nothing is cached.
+    """
+
+    value = redis_store.get(key)
+    if value is None:
+        raise KeyError("no form cached.")
+    return json.loads(value.decode("utf-8"))
+
+
+def cache_missing_form(key):
+    redis_store.set(key, json.dumps(None), ex=settings.FORM_NEGATIVE_CACHE_TTL)
+
+
+def cache_form(key, snapshot, refs, controller_ids=()):
+    """
+    Stores a form snapshot under a lookup key (hashid or email+host). The
+    lookup key is indexed under each of `refs` (the form id and its email) so
+    it can be dropped when that form, or another form with the same email,
+    changes. As the snapshot carries the form's features, the form is indexed
+    again under the users controlling it and its address, like in
+    cache_controllers, so their changes drop it too.
+    """
+
+    ttl = settings.FORM_CACHE_TTL
+    pipe = redis_store.pipeline(transaction=False)
+    pipe.set(key, json.dumps(snapshot), ex=ttl)
+    for ref in refs:
+        pipe.sadd(REDIS_FORM_LOOKUPS_KEY(ref=ref), key)
+        pipe.expire(REDIS_FORM_LOOKUPS_KEY(ref=ref), ttl)
+    index_controlled_form(pipe, snapshot["id"], snapshot["email"], controller_ids)
+    pipe.execute()
+
+
+def invalidate_form_caches(form_ids=(), user_ids=(), addresses=(), emails=()):
+    form_ids = set(form_ids)
+    index_keys = [REDIS_FEATURES_USER_KEY(user_id=id) for id in user_ids] + [
+        REDIS_FEATURES_ADDRESS_KEY(address=normalize_email(addr)) for addr in addresses
+    ]
+
+    if index_keys:
+        pipe = redis_store.pipeline(transaction=False)
+        for key in index_keys:
+            pipe.smembers(key)
+        for members in pipe.execute():
+            form_ids.update(int(id) for id in members)
+
+    lookup_keys = [REDIS_FORM_LOOKUPS_KEY(ref=ref) for ref in form_ids] + [
+        REDIS_FORM_LOOKUPS_KEY(ref=email) for email in emails
+    ]
+    keys = index_keys + lookup_keys
+    keys += [REDIS_FEATURES_KEY(form_id=id) for id in form_ids]
+    keys += [REDIS_FORM_HASHID_KEY(hashid=HASHIDS_CODEC.encode(id)) for id in form_ids]
+
+    if lookup_keys:
+        pipe = redis_store.pipeline(transaction=False)
+        for key in lookup_keys:
+            pipe.smembers(key)
+        for members in pipe.execute():
+            keys += [key.decode("utf-8") for key in members]
+
+    if keys:
+        redis_store.delete(*keys)
 
 
 def form_control(func=None, api_type="internal", allow_readonly=False):
@@ -1,25 +1,45 @@
+import copy
 import hmac
+import json
+import time
 import uuid
-import random
 import hashlib
-import inspect
 import datetime
 import traceback
+from contextlib import contextmanager
 
 import pystache
 
 from flask import url_for, render_template, g
 from sqlalchemy import func, DDL, Index, event
+from sqlalchemy.orm import object_session, joinedload, column_property
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import text
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import JSON, insert as pg_insert
 from sqlalchemy.ext.mutable import MutableDict
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, DataError
 from premailer import transform
 
 from formspree import settings
-from formspree.app_globals import DB, celery, spam_serializer
-from formspree.email_templates import render_email
-from formspree.utils import send_email, next_url, is_valid_email, referrer_to_path
+from formspree.app_globals import DB, celery, redis_store, spam_serializer
+from formspree.email_templates import render_email, unescape_template_tags
+from formspree.stats import incr_stat, incr_stats
+from formspree.outbox import queue_email
+from formspree.users.models import User, Email, Plan
+from formspree.utils import (
+    send_email,
+    next_url,
+    is_valid_email,
+    referrer_to_path,
+    MAX_RECIPIENTS_PER_EMAIL,
+)
+from .routing import (
+    get_matcher,
+    compile_trigger,
+    field_value,
+    serialize_function,
+    RegexTimeout,
+)
 from .helpers import (
     HASH,
     HASHIDS_CODEC,
@@ -30,6 +50,28 @@ from .helpers import (
     get_replyto,
     get_monthly_counter,
     increase_monthly_counter,
+    get_cached_controllers,
+    cache_controllers,
+    get_stored_submissions,
+    change_stored_submissions,
+    get_cached_form,
+    cache_form,
+    cache_missing_form,
+    invalidate_form_caches,
+    REDIS_FORM_HASHID_KEY,
+    REDIS_FORM_HOST_KEY,
+    REDIS_INGEST_SCHEDULED_KEY,
+    REDIS_INGEST_LOCK_KEY,
+    REDIS_BATCH_SCHEDULED_KEY,
+    claim_batch_schedule,
+    stream_submission,
+    read_streamed_submissions,
+    delete_streamed_submissions,
+    dead_letter_streamed_submissions,
+    add_to_digest,
+    claim_due_digests,
+    read_digest,
+    drop_digest_entries,
 )
 
 
@@ -45,13 +87,22 @@ class Form(DB.Model):
     disabled = DB.Column(DB.Boolean)
     confirm_sent = DB.Column(DB.Boolean)
     confirmed = DB.Column(DB.Boolean)
-    counter = DB.Column(DB.Integer)
+    confirmation_error = DB.Column(DB.Text)
+    # the counter as of the last fold, see FormCounterDelta.
+    # read `counter` instead.
+    stored_counter = DB.Column("counter", DB.Integer)
     apikey = DB.Column(DB.String)
     owner_id = DB.Column(DB.Integer, DB.ForeignKey("users.id"), index=True)
     captcha_disabled = DB.Column(DB.Boolean)
+    # bumped when routing rules change, see routing.get_matcher
+    rules_version = DB.Column(
+        DB.Integer, nullable=False, default=0, server_default="0"
+    )
     uses_ajax = DB.Column(DB.Boolean)
     disable_email = DB.Column(DB.Boolean)
     disable_storage = DB.Column(DB.Boolean)
+    # minutes between digests, or None to send each submission as it comes
+    digest_interval = DB.Column(DB.Integer)
     created_at = DB.Column(DB.DateTime, default=DB.func.now())
 
     Index("ix_forms_normalized_host", func.normalize_host(host))
@@ -70,6 +121,15 @@ class Form(DB.Model):
     plugins = DB.relationship("Plugin", backref="form", lazy="dynamic")
     routing_rules = DB.relationship("RoutingRule", backref="form", lazy="dynamic")
 
+    # plain lists of the above, so they can be eagerly loaded for processing
+    # submissions (see Submission.load_for_processing)
+    enabled_plugins = DB.relationship(
+        "Plugin",
+        primaryjoin="and_(Plugin.form_id == Form.id, Plugin.enabled)",
+        viewonly=True,
+    )
+    all_routing_rules = DB.relationship("RoutingRule", viewonly=True)
+
     """
     When the form is created by a spontaneous submission, it is added to
     the table with a `host`, an `email` and a `hash` made of these two
@@ -98,9 +158,7 @@ class Form(DB.Model):
 
     SUBJECT_ACTIVATION = "Action Required: Activate %s on %s"
 
-    def __init__(
-        self, email, confirmed, host=None, owner=None, name=None, normalize=False
-    ):
+    def __init__(self, email, confirmed, host=None, owner=None, name=None):
         if host is not None:
             self.hash = HASH(email, host)
         elif owner:
@@ -120,19 +178,14 @@ class Form(DB.Model):
             self.confirm_sent = False
             self.confirmed = False
 
-        self.counter = 0
+        self.stored_counter = 0
         self.disabled = False
         self.captcha_disabled = False
 
-        if normalize:
-            self.host = func.normalize_host(host)
-            DB.session.add(self)
-            DB.session.flush()
-        else:
-            # forms created with a host (from endpoint.py) should
-            # be normalized. the non-normalized version is supported
-            # for testing backward-compatibility cases.
-            self.host = host
+        # forms created with a host from endpoint.py go through
+        # create_spontaneous, which normalizes the host. setting it
+        # as is here is supported for testing backward-compatibility cases.
+        self.host = host
 
     def __repr__(self):
         confirmed = "[✓]" if self.confirmed else "[ ]"
@@ -153,8 +206,6 @@ class Form(DB.Model):
 
     @property
     def controllers(self):
-        from formspree.users.models import User, Email
-
         by_email = (
             DB.session.query(User)
             .join(Email, User.id == Email.owner_id)
@@ -170,7 +221,38 @@ class Form(DB.Model):
 
     @property
     def features(self):
-        return set.union(*[set(cont.features) for cont in self.controllers])
+        return set(self.resolve_controllers()["features"])
+
+    def resolve_controllers(self):
+        """
+        Ids of the users controlling this form, the union of their plan
+        features and the most generous of their plans' submission rates.
+        Computed once per loaded form (the result is dropped whenever the form
+        is expired) and shared with other processes through redis.
+        """
+
+        try:
+            return self._controllers
+        except AttributeError:
+            pass
+
+        resolved = get_cached_controllers(self.id) if self.id else None
+        if resolved is None or "rate" not in resolved:
+            users = self.controllers.all()
+            rates = [user.submission_rate for user in users]
+            resolved = {
+                "ids": [user.id for user in users],
+                "features": sorted(set().union(*[user.features for user in users])),
+                "rate": max(
+                    rates or [Plan.submission_rate(Plan.free)],
+                    key=lambda rate: (rate["per_minute"], rate["burst"]),
+                ),
+            }
+            if self.id:
+                cache_controllers(self.id, self.email, resolved)
+
+        self._controllers = resolved
+        return resolved
 
     @property
     def apikey_readonly(self):
@@ -180,15 +262,27 @@ class Form(DB.Model):
             else None
         )
 
+    @property
+    def processes_in_batches(self):
+        # paid forms keep a task per submission, for lower latency.
+        return settings.SUBMISSION_PROCESSING == "batch" and not self.has_feature(
+            "dashboard"
+        )
+
+    @property
+    def processes_with_priority(self):
+        # paid forms have a queue of their own
+        return self.has_feature("dashboard")
+
+    @property
+    def submission_rate(self):
+        return self.resolve_controllers()["rate"]
+
     def controlled_by(self, user):
-        for cont in self.controllers:
-            if cont.id == user.id:
-                return True
-        return False
+        return user.id in self.resolve_controllers()["ids"]
 
     def has_feature(self, feature):
-        c = [user for user in self.controllers if user.has_feature(feature)]
-        return len(c) > 0
+        return feature in self.resolve_controllers()["features"]
 
     @classmethod
     def get_with(cls, email=None, host=None, hashid=None):
@@ -220,6 +314,92 @@ class Form(DB.Model):
                 .first()
             )
 
+    @classmethod
+    def create_spontaneous(cls, email, host):
+        """
+        Creates the form for a new email+host, unconfirmed. If concurrent first
+        submissions race to create it they all get the same row, in a single
+        round trip and without rolling anything back.
+        """
+
+        params = dict(
+            hash=HASH(email, host),
+            email=email,
+            host=host,
+            created_at=datetime.datetime.utcnow(),
+        )
+        form = (
+            DB.session.query(cls)
+            .from_statement(
+                text(
+                    "INSERT INTO forms (hash, email, host, created_at, confirmed, "
+                    "  confirm_sent, counter, disabled, captcha_disabled) "
+                    "VALUES (:hash, :email, normalize_host(:host), :created_at, "
+                    "  false, false, 0, false, false) "
+                    "ON CONFLICT (hash) DO NOTHING "
+                    "RETURNING *"
+                )
+            )
+            .params(**params)
+            .first()
+        )
+
+        if form:
+            # the insert bypasses the mapper, so do what its events would do.
+            schedule_cache_invalidation(
+                DB.session, form_ids=[form.id], emails=[form.email]
+            )
+        else:
+            # someone else created it first.
+            form = cls.query.filter_by(hash=params["hash"]).first()
+
+        return form
+
+    @classmethod
+    def get_cached(cls, email=None, host=None, hashid=None):
+        """
+        Same lookup as get_with, for the public submission endpoint. Confirmed
+        and disabled forms are cached in redis and returned as a FormSnapshot,
+        hashids that match no form are remembered for a short while, so neither
+        hot forms nor junk traffic cost a database query on every submission.
+        """
+
+        if hashid:
+            # junk that isn't even a hashid never leaves the process.
+            if not HASHIDS_CODEC.decode(hashid):
+                incr_stat("form_lookup_invalid_hashid")
+                return None
+            key = REDIS_FORM_HASHID_KEY(hashid=hashid)
+        else:
+            key = REDIS_FORM_HOST_KEY(email=email, host=host)
+
+        try:
+            cached = get_cached_form(key)
+        except KeyError:
+            incr_stat("form_lookup_miss")
+        else:
+            if cached is None:
+                incr_stat("form_lookup_negative_hit")
+                return None
+            if "submission_rate" in cached:  # else cached by an older release
+                incr_stat("form_lookup_hit")
+                return FormSnapshot(**cached)
+
+        form = cls.get_with(email=email, host=host, hashid=hashid)
+        if form and (form.confirmed or form.disabled):
+            cache_form(
+                key,
+                FormSnapshot.from_form(form).serialize(),
+                [form.id, form.email],
+                form.resolve_controllers()["ids"],
+            )
+        elif not form and hashid:
+            cache_missing_form(key)
+        return form
+
+    def rules_changed(self):
+        self.rules_version = Form.rules_version + 1
+
     def reset_apikey(self):
         self.apikey = str(uuid.uuid1()).replace("-", "")
 
@@ -239,11 +419,13 @@ class Form(DB.Model):
             "routing_rules": [r.serialize() for r in self.routing_rules],
             "features": {f: True for f in self.features},
             "confirm_sent": self.confirm_sent,
+            "confirmation_error": self.confirmation_error,
             "confirmed": self.confirmed,
             "disabled": self.disabled,
             "captcha_disabled": self.captcha_disabled,
             "disable_email": self.disable_email,
             "disable_storage": self.disable_storage,
+            "digest_interval": self.digest_interval,
             "api_enabled": bool(self.apikey),
             "is_public": bool(self.hash),
             "url": "{S}/{E}".format(S=settings.SERVICE_URL, E=self.hashid),
@@ -303,10 +485,11 @@ class Form(DB.Model):
 
         return submissions, fields
 
-    def submit(self, data, keys, referrer):
+    def submit(self, data, keys, referrer, overlimit=False):
         """
         Submits a form.
         Ensure data is well-formed. Create a new submission. Dispatch to worker to process submission.
+        Submissions the endpoint found `overlimit` are not processed at all.
         """
 
         keys = [k for k in keys if k not in KEYS_EXCLUDED_FROM_EMAIL]
@@ -331,13 +514,45 @@ class Form(DB.Model):
                 "referrer": referrer,
             }
 
+        stored_data = {key: data[key] for key in data if key not in KEYS_NOT_STORED}
+
+        if overlimit:
+            incr_stat("submission_overlimit_" + settings.OVERLIMIT_SUBMISSIONS)
+            if settings.OVERLIMIT_SUBMISSIONS == "store":
+                self.store_over_limit(stored_data, referrer)
+            g.log.info("Submission over limit, not processed.", form_id=self.id)
+            return {"code": Form.STATUS_SUBMISSION_ENQUEUED, "next": next}
+
+        if settings.SUBMISSION_INGEST == "stream":
+            # the submission will be written to postgres by a batch writer.
+            entry = {
+                "form_id": self.id,
+                "submitted_at": time.time(),
+                "data": stored_data,
+                "host": referrer,
+                "keys": list(keys),
+                "batch": self.processes_in_batches,
+                "priority": self.processes_with_priority,
+            }
+            if stream_submission(entry):
+                flush_submission_stream.apply_async(
+                    countdown=settings.INGEST_FLUSH_DELAY
+                )
+            g.log.info("Submission streamed.", form_id=self.id, email=self.email)
+            return {"code": Form.STATUS_SUBMISSION_ENQUEUED, "next": next}
+
         # the Submission object
         submission = Submission(self.id)
-        submission.data = {key: data[key] for key in data if key not in KEYS_NOT_STORED}
+        submission.data = stored_data
         submission.host = referrer
         DB.session.add(submission)
         DB.session.commit()
-        process_and_commit_submission.delay(submission.id, list(keys))
+        enqueue_processing(
+            submission.id,
+            list(keys),
+            self.processes_in_batches,
+            self.processes_with_priority,
+        )
         g.log.info(
             "Submission enqueued.",
             form_id=self.id,
@@ -346,43 +561,101 @@ class Form(DB.Model):
         )
         return {"code": Form.STATUS_SUBMISSION_ENQUEUED, "next": next}
 
-    def update_counters(self):
-        # increase the monthly counter
-        monthly_counter = increase_monthly_counter(self.id)
+    def store_over_limit(self, stored_data, referrer):
+        """
+        Stores a submission as processing would have left it, had the form
+        been over the limit when it got to it.
+        """
+
+        submission = Submission(self.id)
+        submission.data = stored_data
+        submission.host = referrer
+        submission.status = SubmissionStatus.processed
+        submission.append_error("Over submission limit")
+        DB.session.add(submission)
+        self.update_counters()
+        DB.session.commit()
+
+        # once it is counted among the stored ones
+        if not self.has_feature("archive"):
+            self.trim_archive()
+            DB.session.commit()
+
+    @property
+    def monthly_limit(self):
+        return (
+            settings.MONTHLY_SUBMISSIONS_LIMIT
+            if self.id > settings.FORM_LIMIT_DECREASE_ACTIVATION_SEQUENCE
+            else settings.GRANDFATHER_MONTHLY_LIMIT
+        )
+
+    def is_far_over_limit(self):
+        """
+        Whether the next submission to this form would be over the monthly
+        limit and past the overlimit notifications, so processing it would
+        neither send nor notify anything.
+        """
+
+        if self.has_feature("unlimited"):
+            return False
+        return (
+            get_monthly_counter(self.id)
+            >= self.monthly_limit + settings.OVERLIMIT_NOTIFICATION_QUANTITY
+        )
+
+    def update_counters(self, submission_id=None):
+        # increase the monthly counter, once per submission when retried
+        monthly_counter = increase_monthly_counter(
+            self.id, submission_id=submission_id
+        )
 
         # increment the forms global counter
-        self.counter = Form.counter + 1
+        self.add_to_counter(1)
 
         return monthly_counter
 
+    def add_to_counter(self, delta):
+        # appended instead of updating our row, so concurrent submissions
+        # don't all wait on the same row lock. see FormCounterDelta.
+        DB.session.add(FormCounterDelta(form_id=self.id, delta=delta))
+        if "counter" in self.__dict__:
+            set_committed_value(self, "counter", self.counter + delta)
+
     def get_monthly_counter(self):
         return get_monthly_counter(self.id)
 
-    def delete_over_archive_limit(self):
-        # For free users, sometimes we'll delete all archived submissions over the limit
-        DB.session.query(Submission.id).from_statement(
+    def trim_archive(self):
+        """
+        Deletes the oldest submissions past the archive limit. Forms are
+        trimmed on every submission, so there are rarely more than one.
+        """
+
+        overflow = (
+            get_stored_submissions(
+                self.id, lambda: Submission.query.filter_by(form_id=self.id).count()
+            )
+            - settings.ARCHIVED_SUBMISSIONS_LIMIT
+        )
+        if overflow <= 0:
+            return
+
+        deleted = DB.session.execute(
             text(
-                "WITH n_to_delete AS ( "
-                "  SELECT CASE WHEN c > :keep THEN c - :keep ELSE 0 END AS n FROM ( "
-                "    SELECT count(*) AS c FROM submissions "
-                "    WHERE form_id = :form_id "
-                "  )x "
-                "), ids_to_delete AS ( "
-                "  SELECT id FROM submissions "
-                "  WHERE form_id = :form_id "
-                "  ORDER BY submitted_at "
-                "  LIMIT (SELECT n FROM n_to_delete) "
+                "DELETE FROM submissions WHERE id IN ( "
+                "  SELECT id FROM submissions WHERE form_id = :form_id "
+                "  ORDER BY id LIMIT :overflow "
                 ") "
-                "DELETE FROM submissions WHERE id in (SELECT id FROM ids_to_delete) "
-                "RETURNING id "
-            )
-        ).params(keep=settings.ARCHIVED_SUBMISSIONS_LIMIT, form_id=self.id).all()
+                "RETURNING id"
+            ),
+            {"form_id": self.id, "overflow": overflow},
+        ).fetchall()
+        schedule_stored_submissions_change(DB.session(), self.id, -len(deleted))
 
     def send_confirmation(self, store_data=None, sorted_keys=[]):
         """
-        Helper that actually creates confirmation nonce
-        and sends the email to associated email. Renders
-        different templates depending on the result
+        Stores the first submission, if any, and enqueues the confirmation
+        email to the associated email. The email itself is rendered and sent
+        by send_confirmation_email.
         """
 
         g.log = g.log.new(form=self.id, to=self.email, host=self.host)
@@ -394,35 +667,40 @@ class Form(DB.Model):
             g.log.debug("Previously sent.")
             return {"code": Form.STATUS_CONFIRMATION_DUPLICATED}
 
-        # the nonce for email confirmation will be the hash
-        # (we only send confirmation emails for legacy forms created
-        #  automatically now)
-        nonce = self.hash
-        link = url_for("confirm_email", nonce=nonce, _external=True)
-
-        def render_content(ext):
-            if store_data:
-                store_first_submission(nonce, store_data, sorted_keys)
-
-            params = dict(
-                email=self.email, host=referrer_to_path(self.host), nonce_link=link
-            )
-            if ext == "html":
-                return render_email("confirm.html", **params)
-            elif ext == "txt":
-                return render_template("email/confirm.txt", **params)
+        if store_data:
+            # the nonce for email confirmation will be the hash
+            # (we only send confirmation emails for legacy forms created
+            #  automatically now)
+            store_first_submission(self.hash, store_data, sorted_keys)
 
+        # the worker must see the form.
         DB.session.add(self)
         try:
-            DB.session.flush()
+            DB.session.commit()
         except IntegrityError:
+            DB.session.rollback()
             return {"code": Form.STATUS_CONFIRMATION_DUPLICATED}
 
-        result = send_email(
+        try:
+            send_confirmation_email.delay(self.id)
+        except Exception:
+            # nothing was claimed, the next submission will try again.
+            g.log.exception("Could not enqueue confirmation email.")
+            return {"code": Form.STATUS_CONFIRMATION_FAILED}
+        g.log.debug("Confirmation email enqueued.")
+        return {"code": Form.STATUS_CONFIRMATION_SENT}
+
+    def render_confirmation_email(self):
+        link = url_for("confirm_email", nonce=self.hash, _external=True)
+        params = dict(
+            email=self.email, host=referrer_to_path(self.host), nonce_link=link
+        )
+
+        return dict(
             to=self.email,
             subject=self.SUBJECT_ACTIVATION % (settings.SERVICE_NAME, self.host),
-            text=render_content("txt"),
-            html=render_content("html"),
+            text=render_template("email/confirm.txt", **params),
+            html=render_email("confirm.html", **params),
             sender=settings.DEFAULT_SENDER,
             headers={
                 "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
@@ -436,16 +714,6 @@ class Form(DB.Model):
                 + ">",
             },
         )
-        g.log.debug("Confirmation email queued.")
-
-        if not result[0]:
-            return {"code": Form.STATUS_CONFIRMATION_FAILED}
-
-        self.confirm_sent = True
-        DB.session.add(self)
-        DB.session.commit()
-
-        return {"code": Form.STATUS_CONFIRMATION_SENT}
 
     @classmethod
     def confirm(cls, nonce):
@@ -500,6 +768,149 @@ class Form(DB.Model):
         return True
 
 
+class FormCounterDelta(DB.Model):
+    """
+    Changes to Form.counter not yet applied to the forms table. Processing
+    a submission appends here instead of updating the form's row, and
+    fold_counter_deltas periodically moves them into forms.counter, in the
+    same statement that deletes them, so the sum is exact at all times.
+    """
+
+    __tablename__ = "form_counter_deltas"
+
+    id = DB.Column(DB.BigInteger, primary_key=True)
+    form_id = DB.Column(
+        DB.Integer, DB.ForeignKey("forms.id", ondelete="CASCADE"), nullable=False
+    )
+    delta = DB.Column(DB.Integer, nullable=False)
+
+    Index("ix_form_counter_deltas_form_id", form_id)
+
+    @classmethod
+    def fold(cls, limit):
+        """
+        Applies up to `limit` deltas to the counters of their forms and
+        deletes them. Returns how many deltas were folded.
+        """
+
+        folded = DB.session.execute(
+            text(
+                "WITH folded AS ( "
+                "  DELETE FROM form_counter_deltas WHERE id IN ( "
+                "    SELECT id FROM form_counter_deltas ORDER BY id LIMIT :limit "
+                "  ) "
+                "  RETURNING form_id, delta "
+                "), sums AS ( "
+                "  SELECT form_id, sum(delta) AS delta, count(*) AS n "
+                "  FROM folded GROUP BY form_id "
+                "), updated AS ( "
+                "  UPDATE forms SET counter = coalesce(forms.counter, 0) + sums.delta "
+                "  FROM sums WHERE forms.id = sums.form_id "
+                ") "
+                "SELECT coalesce(sum(n), 0) FROM sums"
+            ),
+            {"limit": limit},
+        ).scalar()
+        DB.session.commit()
+        return int(folded)
+
+
+# stored counter plus whatever hasn't been folded yet. deferred so forms
+# loaded only to be looked at don't pay for the subquery.
+Form.counter = column_property(
+    func.coalesce(Form.stored_counter, 0)
+    + DB.select([func.coalesce(func.sum(FormCounterDelta.delta), 0)])
+    .where(FormCounterDelta.form_id == Form.id)
+    .correlate_except(FormCounterDelta)
+    .as_scalar(),
+    deferred=True,
+)
+
+
+@celery.task()
+def fold_counter_deltas():
+    while FormCounterDelta.fold(settings.COUNTER_FOLD_BATCH_SIZE) == (
+        settings.COUNTER_FOLD_BATCH_SIZE
+    ):
+        pass
+
+
+class FormSnapshot(object):
+    """
+    The attributes of a confirmed or disabled form the submission endpoint
+    reads, as cached by Form.get_cached. Anything else needs the real Form.
+    """
+
+    def __init__(
+        self,
+        id,
+        email,
+        host,
+        confirmed,
+        disabled,
+        captcha_disabled,
+        features,
+        submission_rate,
+    ):
+        self.id = id
+        self.email = email
+        self.host = host
+        self.confirmed = confirmed
+        self.disabled = disabled
+        self.captcha_disabled = captcha_disabled
+        self.features = set(features)
+        self.submission_rate = submission_rate
+
+    def __repr__(self):
+        return "<FormSnapshot {}, email={}, host={}>".format(
+            self.id, self.email, self.host
+        )
+
+    @classmethod
+    def from_form(cls, form):
+        return cls(
+            id=form.id,
+            email=form.email,
+            host=form.host,
+            confirmed=form.confirmed,
+            disabled=form.disabled,
+            captcha_disabled=form.captcha_disabled,
+            features=form.features,
+            submission_rate=form.submission_rate,
+        )
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "email": self.email,
+            "host": self.host,
+            "confirmed": self.confirmed,
+            "disabled": self.disabled,
+            "captcha_disabled": self.captcha_disabled,
+            "features": sorted(self.features),
+            "submission_rate": self.submission_rate,
+        }
+
+    @property
+    def hashid(self):
+        return HASHIDS_CODEC.encode(self.id)
+
+    def has_feature(self, feature):
+        return feature in self.features
+
+    processes_in_batches = Form.processes_in_batches
+    processes_with_priority = Form.processes_with_priority
+    monthly_limit = Form.monthly_limit
+    is_far_over_limit = Form.is_far_over_limit
+    store_over_limit = Form.store_over_limit
+    trim_archive = Form.trim_archive
+    update_counters = Form.update_counters
+    add_to_counter = Form.add_to_counter
+
+    def submit(self, data, keys, referrer, overlimit=False):
+        return Form.submit(self, data, keys, referrer, overlimit)
+
+
 drop_normalize_host = "DROP FUNCTION normalize_host(text)"
 create_normalize_host = """
 CREATE FUNCTION normalize_host(host text) RETURNS text AS $$
@@ -537,6 +948,114 @@ event.listen(Form.metadata, "before_create", DDL(create_normalize_email))
 event.listen(Form.metadata, "after_drop", DDL(drop_normalize_email))
 
 
+def schedule_cache_invalidation(
+    session, form_ids=(), user_ids=(), addresses=(), emails=()
+):
+    """
+    Cached forms and features are only dropped after the transaction that
+    changed them is committed, otherwise a concurrent request could cache the
+    old state again right after we invalidated it.
+    """
+
+    if session is None:
+        invalidate_form_caches(form_ids, user_ids, addresses, emails)
+        return
+
+    pending = session.info.setdefault(
+        "invalidate",
+        {"form_ids": set(), "user_ids": set(), "addresses": set(), "emails": set()},
+    )
+    pending["form_ids"].update(form_ids)
+    pending["user_ids"].update(user_ids)
+    pending["addresses"].update(addresses)
+    pending["emails"].update(emails)
+
+
+def schedule_stored_submissions_change(session, form_id, delta):
+    """
+    Like cache invalidation, changes to the count of stored submissions
+    (see get_stored_submissions) only count once they are committed.
+    """
+
+    pending = session.info.setdefault("stored_submissions", {})
+    pending[form_id] = pending.get(form_id, 0) + delta
+
+
+@event.listens_for(DB.session, "after_commit")
+def apply_cache_invalidation(session):
+    if session.transaction.nested:
+        # only a savepoint, see savepoint().
+        return
+
+    pending = session.info.pop("invalidate", None)
+    if pending:
+        invalidate_form_caches(**pending)
+
+    changes = session.info.pop("stored_submissions", None)
+    if changes:
+        change_stored_submissions(changes)
+
+
+@event.listens_for(DB.session, "after_rollback")
+def discard_cache_invalidation(session):
+    if session.transaction.nested:
+        return
+
+    session.info.pop("invalidate", None)
+    session.info.pop("stored_submissions", None)
+
+
+@event.listens_for(Form, "expire")
+def forget_controllers(target, attrs):
+    if target is None:
+        # the form was already garbage collected.
+        return
+    target.__dict__.pop("_controllers", None)
+
+
+@event.listens_for(Form.email, "set")
+@event.listens_for(Form.owner_id, "set")
+def form_controllers_changed(target, value, oldvalue, initiator):
+    if target.id is not None:
+        target.__dict__.pop("_controllers", None)
+        schedule_cache_invalidation(object_session(target), form_ids=[target.id])
+
+
+@event.listens_for(Form.email, "set")
+@event.listens_for(Form.host, "set")
+@event.listens_for(Form.confirmed, "set")
+@event.listens_for(Form.disabled, "set")
+@event.listens_for(Form.captcha_disabled, "set")
+def form_lookup_changed(target, value, oldvalue, initiator):
+    # other forms with the same email may win (or lose) an email+host lookup
+    # after this change, so drop every lookup under that email too.
+    if target.id is not None:
+        emails = {e for e in (target.email, value, oldvalue) if isinstance(e, str)}
+        schedule_cache_invalidation(
+            object_session(target), form_ids=[target.id], emails=emails
+        )
+
+
+@event.listens_for(Form, "after_insert")
+@event.listens_for(Form, "after_delete")
+def form_inserted_or_deleted(mapper, connection, target):
+    schedule_cache_invalidation(
+        object_session(target), form_ids=[target.id], emails=[target.email]
+    )
+
+
+@event.listens_for(User.plan, "set")
+def user_plan_changed(target, value, oldvalue, initiator):
+    if target.id is not None:
+        schedule_cache_invalidation(object_session(target), user_ids=[target.id])
+
+
+@event.listens_for(Email, "after_insert")
+@event.listens_for(Email, "after_delete")
+def linked_email_changed(mapper, connection, target):
+    schedule_cache_invalidation(object_session(target), addresses=[target.address])
+
+
 class EmailTemplate(DB.Model):
     __tablename__ = "email_templates"
 
@@ -548,6 +1067,8 @@ class EmailTemplate(DB.Model):
     from_name = DB.Column(DB.Text)
     style = DB.Column(DB.Text)
     body = DB.Column(DB.Text)
+    # style and body with the css already inlined, see inline()
+    inlined_body = DB.Column(DB.Text)
 
     form = DB.relationship("Form", back_populates="template")
 
@@ -603,9 +1124,34 @@ class EmailTemplate(DB.Model):
             result["body"] = self.body
         return result
 
+    def inline(self):
+        """
+        Inlines the css into the body once, when the template is saved, so
+        sending an email only has to fill it in. Templates that wouldn't come
+        out the same that way, like those styling elements by their position
+        among the ones a section repeats, keep being inlined on every email.
+        """
+
+        self.inlined_body = None
+        if not self.body:
+            return
+
+        source = "<style>" + self.style + "</style>" + self.body
+        inlined = unescape_template_tags(transform(source))
+        sample = EmailTemplate.make_sample_context()
+        if pystache.render(inlined, sample) == transform(
+            pystache.render(source, sample)
+        ):
+            self.inlined_body = inlined
+
     def render_body(self, data, unconfirm_url):
-        html = pystache.render("<style>" + self.style + "</style>" + self.body, data)
-        inlined = transform(html)
+        if self.inlined_body:
+            inlined = render_mustache(self.id, self.inlined_body, data)
+        else:
+            html = pystache.render(
+                "<style>" + self.style + "</style>" + self.body, data
+            )
+            inlined = transform(html)
         if unconfirm_url not in inlined:
             suffix = """<table width="100%"><tr><td>If you no longer wish to receive these emails <a href="{unconfirm_url}">click here to unsubscribe</a>.</td></tr></table>""".format(
                 unconfirm_url=unconfirm_url
@@ -614,11 +1160,12 @@ class EmailTemplate(DB.Model):
         return inlined
 
     def render_subject(self, data):
-        subject = pystache.render(self.subject, data)
+        subject = render_mustache(self.id, self.subject, data)
         return subject
 
-    def render_with_sample_context(self):
-        data = EmailTemplate.make_mustache_context(
+    @classmethod
+    def make_sample_context(cls):
+        return cls.make_mustache_context(
             data={
                 "name": "Irwin Jones",
                 "_replyto": "i.jones@example.com",
@@ -629,11 +1176,37 @@ class EmailTemplate(DB.Model):
             now=datetime.datetime.utcnow().strftime("%I:%M %p UTC - %d %B %Y"),
             unconfirm_url="#",
         )
+
+    def render_with_sample_context(self):
+        data = EmailTemplate.make_sample_context()
         body = self.render_body(data, "#") if self.body else None
         subject = self.render_subject(data) if self.subject else None
         return body, subject
 
 
+# (template id, content digest) -> parsed mustache template
+_parsed_templates = {}
+_mustache_renderer = pystache.Renderer()
+
+
+def render_mustache(template_id, template, context):
+    """
+    pystache.render, minus parsing the template again each time for saved
+    templates (the ones with an id).
+    """
+
+    if template_id is None:
+        return pystache.render(template, context)
+
+    key = (template_id, hashlib.sha1(template.encode("utf-8")).hexdigest())
+    parsed = _parsed_templates.get(key)
+    if parsed is None:
+        if len(_parsed_templates) > 10000:
+            _parsed_templates.clear()
+        parsed = _parsed_templates[key] = pystache.parse(template)
+    return _mustache_renderer.render(parsed, context)
+
+
 class RoutingRule(DB.Model):
     __tablename__ = "routing_rules"
 
@@ -645,7 +1218,20 @@ class RoutingRule(DB.Model):
     # hidden 'form' property maps to the form referenced at form_id
     # this dirty magic is defined in the rules DB.Relationship at Form.
 
-    functions = ["exists", "contains", "doesntexist", "doesntcontain", "true"]
+    functions = [
+        "exists",
+        "contains",
+        "doesntexist",
+        "doesntcontain",
+        "true",
+        "equals",
+        "oneof",
+        "regex",
+        "gt",
+        "gte",
+        "lt",
+        "lte",
+    ]
 
     def __init__(self, form_id):
         self.id = str(uuid.uuid4())
@@ -658,92 +1244,102 @@ class RoutingRule(DB.Model):
         return {"id": self.id, "trigger": self.trigger, "email": self.email}
 
     def matches(self, submission):
-        fn_name = self.trigger["fn"]
-        field = self.trigger["field"]
-        params = self.trigger["params"]
-
-        val = (
-            None
-            if not field
-            else (
-                submission.host
-                if field == "_host"
-                else submission.submitted_at
-                if field == "_date"
-                else submission.data.get(field, "")
+        try:
+            return compile_trigger(self.trigger)(
+                field_value(submission, self.trigger["field"])
             )
-        )
-
-        return getattr(RoutingRule, fn_name)(val, *params)
+        except RegexTimeout:
+            return False
 
     @staticmethod
     def serialize_function(fn_name):
-        fn = getattr(RoutingRule, fn_name)
-        params = [
-            p
-            for p in inspect.signature(fn).parameters.values()
-            if p.kind == inspect.Parameter.POSITIONAL_OR_KEYWORD
-        ]
-        doc = inspect.getdoc(fn)
+        return serialize_function(fn_name)
 
-        return {
-            "name": fn_name,
-            "doc": doc,
-            "uses_field": len(params) > 0,
-            "params": [p.name for p in params[1:]],
-        }
 
-    @staticmethod
-    def contains(field, substring="", *args):
-        "Match if contained in"
-        return substring in field if field else False
+class SubmissionStatus(DB.Enum):
+    pending = "pending"
+    processing = "processing"
+    processed = "processed"
+    statuses = [pending, processing, processed]
 
-    @staticmethod
-    def doesntcontain(field, substring="", *args):
-        "Match if not contained in"
-        return substring not in field if field else True
 
-    @staticmethod
-    def exists(field, *args):
-        "Match if not empty"
-        return field and field != ""
+def commit_keeping_state():
+    """
+    Commits without expiring what is loaded in the session, so it can still
+    be read afterwards without opening a new transaction.
+    """
 
-    @staticmethod
-    def doesntexist(field, *args):
-        "Match if empty"
-        return not field
+    session = DB.session()
+    expire_on_commit = session.expire_on_commit
+    session.expire_on_commit = False
+    try:
+        session.commit()
+    finally:
+        session.expire_on_commit = expire_on_commit
 
-    @staticmethod
-    def true(*args):
-        "Always match"
-        return True
 
+@contextmanager
+def savepoint():
+    """
+    Runs the block in a SAVEPOINT, so if it raises only what it did is
+    rolled back, along with what it scheduled for after the commit. What
+    was scheduled before it is kept.
+    """
 
-class SubmissionStatus(DB.Enum):
-    pending = "pending"
-    processed = "processed"
-    statuses = [pending, processed]
+    session = DB.session()
+    scheduled = {
+        key: {k: copy.copy(v) for k, v in value.items()}
+        if isinstance(value, dict)
+        else copy.copy(value)
+        for key, value in session.info.items()
+    }
+    try:
+        with session.begin_nested():
+            yield
+    except Exception:
+        session.info.clear()
+        session.info.update(scheduled)
+        raise
 
 
 @celery.task()
 def process_and_commit_submission(sub_id, *args):
     g.log.bind(sub=sub_id)
-    sub = Submission.query.filter_by(id=sub_id).first()
-    if not sub:
-        g.log.warning("Submission not found with id.")
+    subs = Submission.load_for_processing([sub_id], claim=True)
+    if not subs:
+        g.log.warning("Submission not found with id, or already processed.")
         return
+    sub = subs[0]
 
     g.log = g.log.bind(form=sub.form.hashid)
     try:
-        sub.process(*args)
-        sub.status = SubmissionStatus.processed
+        # bump the counters and decide what to send, then commit so the
+        # form's row lock is released before we talk to anyone.
+        outgoing = sub.prepare(*args)
+        sub.status = SubmissionStatus.processing
+        sub.processing_since = datetime.datetime.utcnow()
+        commit_keeping_state()
+    except:
+        # nothing was committed, it is still pending and will be tried again
+        # by reap_stuck_submissions.
+        DB.session.rollback()
+        raise
+
+    try:
+        # no transaction is open while sending.
+        sub.deliver(outgoing, *args)
     except:
+        # the counters were already bumped, so it isn't tried again. what was
+        # queued is dropped and the error recorded on its own, as the session
+        # may not be usable after a database error.
+        debug_msg = traceback.format_exc()
+        DB.session.rollback()
         sub.append_error(
-            "Unexpected Error, please contact support", debug_msg=traceback.format_exc()
+            "Unexpected Error, please contact support", debug_msg=debug_msg
         )
         raise
-
     finally:
+        sub.status = SubmissionStatus.processed
         # if submission storage is disabled, remove submission after processing
         # note that if there are errors, they won't be captured
         if sub.form.has_feature("dashboard") and sub.form.disable_storage:
@@ -753,6 +1349,473 @@ def process_and_commit_submission(sub_id, *args):
         DB.session.commit()
 
 
+def enqueue_processing(sub_id, keys, batch=False, priority=False):
+    if not batch:
+        process_and_commit_submission.apply_async(
+            (sub_id, keys),
+            queue="submissions_priority" if priority else "submissions",
+        )
+    elif claim_batch_schedule():
+        process_pending_submissions.apply_async(
+            countdown=settings.PROCESSING_BATCH_DELAY
+        )
+
+
+@celery.task()
+def process_pending_submissions():
+    # submissions from now on will schedule another run.
+    redis_store.delete(REDIS_BATCH_SCHEDULED_KEY)
+
+    while process_submission_batch(settings.PROCESSING_BATCH_SIZE) == (
+        settings.PROCESSING_BATCH_SIZE
+    ):
+        pass
+
+
+def process_submission_batch(size):
+    """
+    Claims up to `size` pending submissions, skipping those other workers
+    have claimed, and processes them in three steps: prepare all of them in
+    one short transaction, deliver each with no transaction open but for the
+    commit of what it queued, then record all the results in a single
+    UPDATE. Submissions of the same form share the loaded form, features,
+    template and rules. Returns how many submissions were claimed.
+    """
+
+    ids = [
+        id
+        for (id,) in DB.session.query(Submission.id)
+        .filter(Submission.status == SubmissionStatus.pending)
+        .order_by(Submission.id)
+        .limit(size)
+        .with_for_update(skip_locked=True)
+    ]
+    if not ids:
+        DB.session.commit()
+        return 0
+
+    subs = Submission.load_for_processing(ids)
+    subs.sort(key=lambda sub: (sub.form_id, sub.id))
+    for sub in subs:
+        # results are written below, all at once
+        DB.session.expunge(sub)
+    DB.session.execute(
+        text(
+            "UPDATE submissions SET status = 'processing', processing_since = :now "
+            "WHERE id = ANY(:ids)"
+        ),
+        {"ids": ids, "now": datetime.datetime.utcnow()},
+    )
+
+    def unexpected_error(sub):
+        # don't leave it pending, or it would be claimed again forever.
+        g.log.exception("Failed to process submission.")
+        sub.append_error(
+            "Unexpected Error, please contact support", debug_msg=traceback.format_exc()
+        )
+
+    prepared = []
+    for sub in subs:
+        g.log = g.log.bind(sub=sub.id, form=sub.form.hashid)
+        keys = [k for k in sub.data if k not in KEYS_EXCLUDED_FROM_EMAIL]
+        try:
+            # a database error only aborts this submission.
+            with savepoint():
+                prepared.append((sub, sub.prepare(keys), keys))
+        except Exception:
+            unexpected_error(sub)
+    commit_keeping_state()
+
+    for sub, outgoing, keys in prepared:
+        g.log = g.log.bind(sub=sub.id, form=sub.form.hashid)
+        try:
+            # no transaction is open while plugins are dispatched, what it
+            # queued is committed on its own so a failure of the next one
+            # doesn't drop it.
+            sub.deliver(outgoing, keys)
+            commit_keeping_state()
+        except Exception:
+            DB.session.rollback()
+            unexpected_error(sub)
+
+    results = []
+    discarded = []
+    for sub in subs:
+        if sub.form.has_feature("dashboard") and sub.form.disable_storage:
+            discarded.append(sub)
+        else:
+            results.append(
+                {
+                    "id": sub.id,
+                    "status": SubmissionStatus.processed,
+                    "errors": sub.errors,
+                }
+            )
+
+    if results:
+        DB.session.execute(
+            text(
+                "UPDATE submissions "
+                "SET status = r.status::submission_status, errors = r.errors "
+                "FROM json_to_recordset(:results) "
+                "  AS r(id int, status text, errors json) "
+                "WHERE submissions.id = r.id"
+            ),
+            {"results": json.dumps(results)},
+        )
+    if discarded:
+        DB.session.execute(
+            text("DELETE FROM submissions WHERE id = ANY(:ids)"),
+            {"ids": [sub.id for sub in discarded]},
+        )
+        for sub in discarded:
+            schedule_stored_submissions_change(DB.session(), sub.form_id, -1)
+    DB.session.commit()
+
+    g.log.info("Processed submission batch.", count=len(ids))
+    return len(ids)
+
+
+@celery.task()
+def send_confirmation_email(form_id):
+    g.log = g.log.bind(form=form_id)
+
+    # only the worker that flips confirm_sent gets to send the email, so
+    # concurrent or repeated enqueues don't send it twice.
+    claimed = DB.session.execute(
+        text(
+            "UPDATE forms SET confirm_sent = true, confirmation_error = NULL "
+            "WHERE id = :id AND NOT coalesce(confirm_sent, false) "
+            "RETURNING id"
+        ),
+        {"id": form_id},
+    ).first()
+    DB.session.commit()
+    if not claimed:
+        g.log.info("Confirmation already sent.")
+        return
+
+    form = Form.query.get(form_id)
+    try:
+        result = send_email(**form.render_confirmation_email())
+    except Exception:
+        # the claim has to be released all the same, or no one would ever
+        # send it.
+        g.log.exception("Error sending confirmation email.")
+        DB.session.rollback()
+        form = Form.query.get(form_id)
+        result = (False, None, 500)
+    if result[0]:
+        g.log.info("Confirmation email sent.")
+        return
+
+    # let the next submission (or a resend) try again, and tell the owner
+    # what happened through the dashboard.
+    g.log.warning("Failed to send confirmation email.", err=result[1])
+    form.confirm_sent = False
+    form.confirmation_error = result[1] or "Delivery failed ({}).".format(result[2])
+    DB.session.add(form)
+    DB.session.commit()
+
+
+@celery.task()
+def flush_submission_stream():
+    """
+    Drains the ingest stream into postgres, one multi-row INSERT per batch,
+    and enqueues the processing of each submission in the order they came.
+
+    Entries are only deleted from the stream after the commit, so a flush
+    that dies in between leaves them to be read again. The stream id is
+    stored on each row and those already in are skipped, so they are never
+    inserted twice. Their processing, if it wasn't enqueued, is left to
+    reap_stuck_submissions. Entries that can't be inserted at all, like
+    those for a form deleted meanwhile, are moved to a dead-letter list.
+    """
+
+    # submissions streamed from now on will schedule another flush.
+    redis_store.delete(REDIS_INGEST_SCHEDULED_KEY)
+
+    lock_ttl = 300
+    if not redis_store.set(REDIS_INGEST_LOCK_KEY, 1, nx=True, ex=lock_ttl):
+        # another worker is flushing, try again later so we don't miss
+        # whatever was streamed after it last looked.
+        flush_submission_stream.apply_async(countdown=settings.INGEST_FLUSH_DELAY)
+        return
+
+    try:
+        while True:
+            # a busy stream can keep us here for longer than the lock lasts,
+            # hold on to it for as long as we're still going.
+            redis_store.expire(REDIS_INGEST_LOCK_KEY, lock_ttl)
+            entries = read_streamed_submissions(settings.INGEST_BATCH_SIZE)
+            if not entries:
+                break
+
+            failed = []
+            try:
+                with savepoint():
+                    ids = insert_streamed_submissions(entries)
+            except (IntegrityError, DataError):
+                # one bad entry must not keep the whole batch in the stream.
+                ids = {}
+                for stream_id, entry in entries:
+                    try:
+                        with savepoint():
+                            ids.update(
+                                insert_streamed_submissions([(stream_id, entry)])
+                            )
+                    except (IntegrityError, DataError):
+                        g.log.exception(
+                            "Failed to flush streamed submission.",
+                            stream_id=stream_id,
+                            form_id=entry.get("form_id"),
+                        )
+                        failed.append((stream_id, entry))
+
+            inserted = [(ids[id], entry) for id, entry in entries if id in ids]
+            for _, entry in inserted:
+                schedule_stored_submissions_change(DB.session(), entry["form_id"], 1)
+            DB.session.commit()
+            dead_letter_streamed_submissions(failed)
+            delete_streamed_submissions([stream_id for stream_id, _ in entries])
+
+            g.log.info(
+                "Flushed submission stream.",
+                count=len(inserted),
+                skipped=len(entries) - len(inserted) - len(failed),
+                failed=len(failed),
+            )
+            for sub_id, entry in inserted:
+                enqueue_processing(
+                    sub_id, entry["keys"], entry.get("batch"), entry.get("priority")
+                )
+    finally:
+        redis_store.delete(REDIS_INGEST_LOCK_KEY)
+
+
+def insert_streamed_submissions(entries):
+    """
+    Inserts the submissions of a list of (stream id, entry) pairs, skipping
+    those whose stream id is already in. Returns the new submission ids by
+    stream id.
+    """
+
+    table = Submission.__table__
+    rows = DB.session.execute(
+        pg_insert(table)
+        .values(
+            [
+                {
+                    "form_id": entry["form_id"],
+                    "submitted_at": datetime.datetime.utcfromtimestamp(
+                        entry["submitted_at"]
+                    ),
+                    "data": entry["data"],
+                    "host": entry["host"],
+                    "status": SubmissionStatus.pending,
+                    "ingest_id": stream_id.decode("utf-8"),
+                }
+                for stream_id, entry in entries
+            ]
+        )
+        .on_conflict_do_nothing(index_elements=[table.c.ingest_id])
+        .returning(table.c.id, table.c.ingest_id)
+    ).fetchall()
+    return {ingest_id.encode("utf-8"): id for id, ingest_id in rows}
+
+
+@celery.task()
+def reap_stuck_submissions():
+    """
+    Enqueues again the submissions left pending for longer than
+    STUCK_SUBMISSION_AGE, as happens when a worker dies or a task is lost,
+    waiting longer after each attempt. Those that have been tried
+    MAX_SUBMISSION_ATTEMPTS times are given up on. Those left processing
+    for as long, by a worker that died while delivering them, are marked
+    processed with an error, as some of it may have gone out already.
+    Returns the counts.
+    """
+
+    before = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=settings.STUCK_SUBMISSION_AGE
+    )
+    params = {
+        "before": before,
+        "age": settings.STUCK_SUBMISSION_AGE,
+        "max": settings.MAX_SUBMISSION_ATTEMPTS,
+        "limit": settings.REAPER_BATCH_SIZE,
+    }
+    stuck = (
+        "SELECT id FROM submissions "
+        "WHERE status = 'pending' AND submitted_at < :before "
+        "  AND submitted_at < :before - make_interval(secs => :age * attempts) "
+        "  AND attempts {} :max "
+        "ORDER BY submitted_at LIMIT :limit "
+        "FOR UPDATE SKIP LOCKED"
+    )
+
+    # given up on first, so those requeued now for the last time aren't seen
+    # as having had all their attempts already.
+    given_up = DB.session.execute(
+        text(
+            "UPDATE submissions SET status = 'processed', errors = :errors "
+            "WHERE id IN (" + stuck.format(">=") + ") "
+            "RETURNING id"
+        ),
+        dict(
+            params,
+            errors=json.dumps(
+                [
+                    {
+                        "message": "Could not be processed, please contact support",
+                        "plugin": None,
+                        "rule": None,
+                        "debug": "gave up after %s attempts"
+                        % settings.MAX_SUBMISSION_ATTEMPTS,
+                    }
+                ]
+            ),
+        ),
+    ).fetchall()
+    interrupted = DB.session.execute(
+        text(
+            "UPDATE submissions SET status = 'processed', errors = ( "
+            "  coalesce(errors::jsonb, '[]') || CAST(:errors AS jsonb) "
+            ")::json "
+            "WHERE id IN ( "
+            "  SELECT id FROM submissions "
+            "  WHERE status = 'processing' "
+            "    AND coalesce(processing_since, submitted_at) < :before "
+            "  ORDER BY submitted_at LIMIT :limit "
+            "  FOR UPDATE SKIP LOCKED "
+            ") "
+            "RETURNING id"
+        ),
+        dict(
+            params,
+            errors=json.dumps(
+                [
+                    {
+                        "message": "Delivery was interrupted, "
+                        "some notifications may not have been sent",
+                        "plugin": None,
+                        "rule": None,
+                        "debug": "left processing for over %s seconds"
+                        % settings.STUCK_SUBMISSION_AGE,
+                    }
+                ]
+            ),
+        ),
+    ).fetchall()
+    requeued = DB.session.execute(
+        text(
+            "UPDATE submissions SET attempts = attempts + 1 "
+            "WHERE id IN (" + stuck.format("<") + ") "
+            "RETURNING id, form_id, data"
+        ),
+        params,
+    ).fetchall()
+    DB.session.commit()
+
+    forms = {
+        form.id: form
+        for form in Form.query.filter(Form.id.in_({row.form_id for row in requeued}))
+    }
+    for row in requeued:
+        form = forms[row.form_id]
+        keys = [k for k in row.data or {} if k not in KEYS_EXCLUDED_FROM_EMAIL]
+        enqueue_processing(
+            row.id, keys, form.processes_in_batches, form.processes_with_priority
+        )
+
+    counts = {
+        "requeued": len(requeued),
+        "given_up": len(given_up),
+        "interrupted": len(interrupted),
+    }
+    g.log.info("Reaped stuck submissions.", **counts)
+    incr_stats({"submissions_" + k: v for k, v in counts.items() if v})
+    return counts
+
+
+@celery.task()
+def send_due_digests(now=None):
+    """
+    Sends the digests whose interval is over. Those that fail are tried
+    again DIGEST_RETRY_DELAY seconds later. Returns how many were sent.
+    """
+
+    sent = 0
+    for form_id in claim_due_digests(now, settings.DIGEST_RETRY_DELAY):
+        try:
+            send_digest(form_id)
+            sent += 1
+        except Exception:
+            # still claimed, until the retry delay is over.
+            DB.session.rollback()
+            g.log.exception("Failed to send digest.", form=form_id)
+    return sent
+
+
+def send_digest(form_id):
+    """
+    Puts in the outbox a single email listing the submissions a form got
+    since its last digest, using the multi-entry variants of the usual
+    submission templates.
+    """
+
+    entries = read_digest(form_id)
+    form = Form.query.get(form_id)
+    if not entries or form is None:
+        # nothing to send, or no one to send it to.
+        drop_digest_entries(form_id, len(entries), 0)
+        return
+
+    g.log.info("Sending digest.", form=form.hashid, count=len(entries))
+    hosts = sorted({entry["host"] for entry in entries})
+    shown = entries[: settings.DIGEST_MAX_ENTRIES]
+    unconfirm_url = url_for("request_unconfirm_form", form_id=form.id, _external=True)
+    context = dict(
+        entries=shown,
+        more=len(entries) - len(shown),
+        host=", ".join(hosts),
+        now=datetime.datetime.utcnow().strftime("%I:%M %p UTC - %d %B %Y"),
+        unconfirm_url=unconfirm_url,
+    )
+    queue_email(
+        "digest",
+        to=form.email,
+        subject="{} new submission{} from {}".format(
+            len(entries), "s" if len(entries) > 1 else "", context["host"]
+        ),
+        text=render_template("email/form_digest.txt", **context),
+        html=render_email(
+            "form_digest.html",
+            submission_count=form.counter,
+            upgraded=form.has_feature("dashboard"),
+            **context,
+        ),
+        sender=settings.DEFAULT_SENDER,
+        headers={
+            "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
+            "List-Unsubscribe": "<"
+            + url_for(
+                "unconfirm_form",
+                form_id=form.id,
+                digest=form.unconfirm_digest(),
+                _external=True,
+            )
+            + ">",
+        },
+    )
+    interval = (form.digest_interval or 0) * 60
+    DB.session.commit()
+    # only now, so a digest that didn't make it to the outbox goes out with
+    # the next one.
+    drop_digest_entries(form_id, len(entries), interval)
+    incr_stat("digests_sent")
+
+
 class Submission(DB.Model):
     SUBJECT_SUBMISSION = "New submission from %s"
     SUBJECT_APPROACHING_LIMIT = "Formspree Notice: Approaching Submission Limit"
@@ -775,6 +1838,17 @@ class Submission(DB.Model):
         nullable=False,
         default="pending",
     )
+    # times it was enqueued again by reap_stuck_submissions
+    attempts = DB.Column(DB.Integer, nullable=False, default=0, server_default="0")
+    # when it was claimed for delivery, see reap_stuck_submissions
+    processing_since = DB.Column(DB.DateTime)
+    # id of the ingest stream entry it came from, see flush_submission_stream
+    ingest_id = DB.Column(DB.String(64), unique=True)
+
+    # trimming the archive takes the oldest ids of a form
+    Index("ix_submissions_form_id_id", form_id, id)
+    # reap_stuck_submissions looks for old pending ones
+    Index("ix_submissions_status_submitted_at", status, submitted_at)
 
     # hidden 'form' property maps to the form referenced at form_id
     # this dirty magic is defined in the subscriptions DB.Relationship at Form.
@@ -791,19 +1865,46 @@ class Submission(DB.Model):
             self.data.keys(),
         )
 
+    @classmethod
+    def load_for_processing(cls, ids, claim=False):
+        """
+        Loads submissions with everything processing them needs in one query:
+        their forms, the forms' templates, enabled plugins and routing rules.
+        The forms' features come from redis, or from one more query per form.
+
+        With `claim`, only pending submissions no one else is processing are
+        loaded, and they stay locked until the transaction ends.
+        """
+
+        form = joinedload(cls.form)
+        query = cls.query.options(
+            form.undefer("counter"),
+            form.joinedload(Form.template),
+            form.joinedload(Form.enabled_plugins),
+            form.joinedload(Form.all_routing_rules),
+        ).filter(cls.id.in_(ids))
+        if claim:
+            query = query.filter(cls.status == SubmissionStatus.pending)
+            query = query.with_for_update(of=cls.__table__, skip_locked=True)
+
+        subs = query.all()
+        for sub in subs:
+            sub.form.resolve_controllers()
+        return subs
+
     def get_host_path(self):
         return referrer_to_path(self.host) if self.host else self.UNKNOWN_REFERRER
 
     def append_error(self, message, plugin_kind=None, rule_id=None, debug_msg=None):
-        self.errors = self.errors or []
-        self.errors.append(
+        # a new list, changes inside the loaded one wouldn't be saved.
+        self.errors = (self.errors or []) + [
             {
                 "message": message,
                 "plugin": plugin_kind,
                 "rule": rule_id,
                 "debug": debug_msg,
             }
-        )
+        ]
 
     def serialize(self):
         data = self.data.copy()
@@ -824,7 +1925,7 @@ class Submission(DB.Model):
 
     def dispatch_plugins(self, keys):
         # dispatch webhooks to subscriptions
-        for plugin in self.form.plugins.filter_by(enabled=True):
+        for plugin in self.form.enabled_plugins:
             try:
                 plugin.dispatch(self, sorted_keys=keys)
             except Exception as e:
@@ -844,14 +1945,10 @@ class Submission(DB.Model):
                     debug_msg=traceback.format_exc(),
                 )
 
-    def check_over_submission_limit(self, unconfirm_url):
+    def check_over_submission_limit(self, unconfirm_url, notices):
         # check if the forms are over the counter and the user has unlimited submissions
-        monthly_counter = self.form.update_counters()
-        monthly_limit = (
-            settings.MONTHLY_SUBMISSIONS_LIMIT
-            if self.form.id > settings.FORM_LIMIT_DECREASE_ACTIVATION_SEQUENCE
-            else settings.GRANDFATHER_MONTHLY_LIMIT
-        )
+        monthly_counter = self.form.update_counters(self.id)
+        monthly_limit = self.form.monthly_limit
         overlimit = monthly_counter > monthly_limit and not self.form.has_feature(
             "unlimited"
         )
@@ -859,26 +1956,28 @@ class Submission(DB.Model):
         if overlimit:
             g.log.info("Form over limit.", monthly_counter=monthly_counter)
 
-        # send overlimit or approaching limit emails
+        # overlimit or approaching limit emails, to be sent by deliver()
 
         if monthly_counter == int(monthly_limit * 0.9) and not self.form.has_feature(
             "unlimited"
         ):
             # send email notification
-            send_email(
-                to=self.form.email,
-                subject=self.SUBJECT_APPROACHING_LIMIT,
-                text=render_template(
-                    "email/90-percent-warning.txt",
-                    unconfirm_url=unconfirm_url,
-                    limit=monthly_limit,
-                ),
-                html=render_email(
-                    "90-percent-warning.html",
-                    unconfirm_url=unconfirm_url,
-                    limit=monthly_limit,
-                ),
-                sender=settings.DEFAULT_SENDER,
+            notices.append(
+                dict(
+                    to=self.form.email,
+                    subject=self.SUBJECT_APPROACHING_LIMIT,
+                    text=render_template(
+                        "email/90-percent-warning.txt",
+                        unconfirm_url=unconfirm_url,
+                        limit=monthly_limit,
+                    ),
+                    html=render_email(
+                        "90-percent-warning.html",
+                        unconfirm_url=unconfirm_url,
+                        limit=monthly_limit,
+                    ),
+                    sender=settings.DEFAULT_SENDER,
+                )
             )
 
         # send an overlimit notification for the first x overlimit emails
@@ -889,72 +1988,91 @@ class Submission(DB.Model):
             and monthly_counter
             <= monthly_limit + settings.OVERLIMIT_NOTIFICATION_QUANTITY
         ):
-            send_email(
-                to=self.form.email,
-                subject=self.SUBJECT_OVER_LIMIT,
-                text=render_template(
-                    "email/overlimit-notification.txt",
-                    host=self.get_host_path(),
-                    unconfirm_url=unconfirm_url,
-                    limit=monthly_limit,
-                ),
-                html=render_email(
-                    "overlimit-notification.html",
-                    host=self.get_host_path(),
-                    unconfirm_url=unconfirm_url,
-                    limit=monthly_limit,
-                ),
-                sender=settings.DEFAULT_SENDER,
+            notices.append(
+                dict(
+                    to=self.form.email,
+                    subject=self.SUBJECT_OVER_LIMIT,
+                    text=render_template(
+                        "email/overlimit-notification.txt",
+                        host=self.get_host_path(),
+                        unconfirm_url=unconfirm_url,
+                        limit=monthly_limit,
+                    ),
+                    html=render_email(
+                        "overlimit-notification.html",
+                        host=self.get_host_path(),
+                        unconfirm_url=unconfirm_url,
+                        limit=monthly_limit,
+                    ),
+                    sender=settings.DEFAULT_SENDER,
+                )
             )
 
         return overlimit
 
     def process(self, keys):
         """
-        Processes a submission, including sending submission to target email.
+        Processes a submission in one go. Workers use prepare() and deliver()
+        separately, so no transaction is held open while talking to the
+        outside world.
+        """
+
+        self.deliver(self.prepare(keys), keys)
+
+    def prepare(self, keys):
+        """
+        First phase of processing a submission: trims the archive, bumps the
+        counters, checks the limits, decides the recipients and renders the
+        emails. It only touches the database and redis. The returned outgoing
+        messages are sent by deliver().
         Assumes sender's email has been verified.
 
-        NOTE: shouldn't call DB.commit() when processing a submission. All actions are
-        committed after processing by process_and_commit_submission()
+        NOTE: shouldn't call DB.commit() when preparing a submission. All actions are
+        committed by the caller (see process_and_commit_submission()).
         """
 
+        outgoing = {"notices": [], "plugins": False, "emails": [], "digest": None}
+
         # url to request_unconfirm_form page
         unconfirm_url = url_for(
             "request_unconfirm_form", form_id=self.form.id, _external=True
         )
         spam_url = url_for("mark-spam", id=self.spam_hash, _external=True)
 
-        if (
-            not self.form.has_feature("archive")
-            and random.random() < settings.EXPENSIVELY_WIPE_SUBMISSIONS_FREQUENCY
-        ):
-            self.form.delete_over_archive_limit()
+        if not self.form.has_feature("archive"):
+            self.form.trim_archive()
 
-        if self.check_over_submission_limit(unconfirm_url) is True:
+        if self.check_over_submission_limit(unconfirm_url, outgoing["notices"]):
             self.append_error("Over submission limit")
-            return
+            return outgoing
 
-        self.dispatch_plugins(keys)
+        outgoing["plugins"] = True
 
         # build the list of recipients: for normal forms it will be just
         # form.email; for forms with routing rules we ignore that and use
         # the results from the routing rules instead.
         if (
             self.form.has_feature("submission_routing")
-            and self.form.routing_rules.count()
+            and self.form.all_routing_rules
         ):
-            recipients = {
-                (rule.email, rule.id)
-                for rule in self.form.routing_rules
-                if rule.matches(self)
-            }
+            recipients = get_matcher(self.form).recipients(self)
             g.log.info("Got recipients from route matching", n=len(recipients))
         else:
             # if emails are disabled, don't send email notification
             # (but routing rules are applied anyway)
             if self.form.has_feature("dashboard") and self.form.disable_email:
                 g.log.info("Form has email disabled, will not send.")
-                return
+                return outgoing
+            elif self.form.has_feature("dashboard") and self.form.digest_interval:
+                g.log.info("Form sends digests, will add to the next one.")
+                outgoing["digest"] = {
+                    "data": {k: self.data.get(k) for k in keys},
+                    "keys": keys,
+                    "host": self.get_host_path(),
+                    "submitted_at": self.submitted_at.isoformat(),
+                    "spam_url": spam_url,
+                }
+                return outgoing
             else:
                 recipients = {(self.form.email, None)}
                 g.log.info("Will send to simple recipient", recipient=self.form.email)
@@ -1032,12 +2150,19 @@ class Submission(DB.Model):
             )
             from_name = self.form.template.from_name or from_name
 
-        # send the emails ----------------------------------------------------------
+        # the emails, to be sent by deliver() ------------------------------------
 
+        # everybody gets the same email, so they share a single request to the
+        # provider. an address matched by many rules gets it only once.
+        rules_by_address = {}
         for to, rule_id in recipients:
-            g.log.info("Submitting.", target=to)
-            result = send_email(
-                to=to,
+            rules_by_address.setdefault(to, []).append(rule_id)
+        addresses = sorted(rules_by_address)
+
+        for i in range(0, len(addresses), MAX_RECIPIENTS_PER_EMAIL):
+            batch = addresses[i : i + MAX_RECIPIENTS_PER_EMAIL]
+            email = dict(
+                to=batch[0] if len(batch) == 1 else batch,
                 subject=subject,
                 text=text,
                 html=html,
@@ -1057,12 +2182,43 @@ class Submission(DB.Model):
                     + ">",
                 },
             )
+            outgoing["emails"].append(
+                (email, {to: rules_by_address[to] for to in batch})
+            )
 
-            if not result[0]:
-                g.log.warning("Failed to send email.", reason=result[1], code=result[2])
-                # self.errors.append("Couldn't send email. " + result[1])
-                self.append_error(
-                    "Could not send email",
-                    debug_msg=f"code {result[2]}: {result[1]}",
-                    rule=rule_id,
-                )
+        return outgoing
+
+    def deliver(self, outgoing, keys):
+        """
+        Second phase of processing a submission: dispatches the plugins and
+        puts in the outbox what prepare() decided to send, to be sent once
+        the caller commits. Failures are recorded on the submission, by the
+        outbox workers for emails.
+        """
+
+        for notice in outgoing["notices"]:
+            queue_email("notice", **notice)
+
+        if outgoing["plugins"]:
+            self.dispatch_plugins(keys)
+
+        if outgoing["digest"]:
+            add_to_digest(
+                self.form_id, outgoing["digest"], self.form.digest_interval * 60
+            )
+
+        for email, recipients in outgoing["emails"]:
+            g.log.info("Submitting.", targets=email["to"])
+            queue_email(
+                "submission", submission_id=self.id, recipients=recipients, **email
+            )
+
+
+@event.listens_for(Submission, "after_insert")
+def submission_inserted(mapper, connection, target):
+    schedule_stored_submissions_change(object_session(target), target.form_id, 1)
+
+
+@event.listens_for(Submission, "after_delete")
+def submission_deleted(mapper, connection, target):
+    schedule_stored_submissions_change(object_session(target), target.form_id, -1)
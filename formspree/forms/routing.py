@@ -0,0 +1,264 @@
+import re
+import signal
+import inspect
+import threading
+
+# patterns come from form owners and are run against whatever visitors send,
+# so they are kept short and only the start of long values is searched. a
+# pattern can still take exponential time on a crafted value, as "(a|a)+$"
+# does, so searches are given up on after REGEX_TIMEOUT seconds. patterns
+# with obviously nested repetition (as in "(a+)+") are refused right away,
+# but that check is easily got around and is only there to tell their
+# authors early.
+REGEX_MAX_PATTERN = 200
+REGEX_MAX_INPUT = 10000
+REGEX_TIMEOUT = 0.1
+NESTED_REPETITION = re.compile(r"\([^()]*(?:[*+]|\{\d*,\d*\})[^()]*\)(?:[*+]|\{\d*,)")
+
+# name -> compiler. a compiler takes the rule's params and returns a
+# predicate on the value of the rule's field. its docstring and parameter
+# names are what the dashboard shows (see serialize_function).
+OPERATORS = {}
+
+
+def operator(uses_field=True):
+    def register(compile):
+        compile.uses_field = uses_field
+        OPERATORS[compile.__name__] = compile
+        return compile
+
+    return register
+
+
+def never(value):
+    return False
+
+
+def as_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def compare(number, test):
+    number = as_number(number)
+    if number is None:
+        return never
+
+    def predicate(value):
+        value = as_number(value)
+        return value is not None and test(value, number)
+
+    return predicate
+
+
+@operator()
+def exists(*args):
+    "Match if not empty"
+    return lambda value: bool(value)
+
+
+@operator()
+def contains(substring="", *args):
+    "Match if contained in"
+    return lambda value: substring in value if value else False
+
+
+@operator()
+def doesntexist(*args):
+    "Match if empty"
+    return lambda value: not value
+
+
+@operator()
+def doesntcontain(substring="", *args):
+    "Match if not contained in"
+    return lambda value: substring not in value if value else True
+
+
+@operator(uses_field=False)
+def true(*args):
+    "Always match"
+    return lambda value: True
+
+
+@operator()
+def equals(text="", *args):
+    "Match if equal to"
+    return lambda value: value == text
+
+
+@operator()
+def oneof(options="", *args):
+    "Match if one of (comma-separated)"
+    options = {option.strip() for option in options.split(",")}
+    return lambda value: isinstance(value, str) and value.strip() in options
+
+
+def check_regex(pattern):
+    if len(pattern) > REGEX_MAX_PATTERN:
+        return "Regular expression is too long."
+    if NESTED_REPETITION.search(pattern):
+        return "Regular expression has nested repetition."
+    try:
+        re.compile(pattern)
+    except re.error:
+        return "Invalid regular expression."
+
+
+class RegexTimeout(Exception):
+    pass
+
+
+def raise_regex_timeout(signum, frame):
+    raise RegexTimeout()
+
+
+def search_on_budget(pattern, value):
+    """
+    pattern.search(value), raising RegexTimeout if it takes longer than
+    REGEX_TIMEOUT. The time is kept with SIGALRM, which only the main
+    thread can handle. Workers and web processes run everything there, a
+    search anywhere else is given up on right away.
+    """
+
+    if threading.current_thread() is not threading.main_thread():
+        raise RegexTimeout()
+
+    previous = signal.signal(signal.SIGALRM, raise_regex_timeout)
+    signal.setitimer(signal.ITIMER_REAL, REGEX_TIMEOUT)
+    try:
+        return pattern.search(value)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+@operator()
+def regex(pattern="", *args):
+    "Match if matches the regular expression"
+    if check_regex(pattern):
+        return never
+    pattern = re.compile(pattern)
+    return lambda value: isinstance(value, str) and bool(
+        search_on_budget(pattern, value[:REGEX_MAX_INPUT])
+    )
+
+
+@operator()
+def gt(number="", *args):
+    "Match if greater than"
+    return compare(number, lambda value, number: value > number)
+
+
+@operator()
+def gte(number="", *args):
+    "Match if greater than or equal to"
+    return compare(number, lambda value, number: value >= number)
+
+
+@operator()
+def lt(number="", *args):
+    "Match if less than"
+    return compare(number, lambda value, number: value < number)
+
+
+@operator()
+def lte(number="", *args):
+    "Match if less than or equal to"
+    return compare(number, lambda value, number: value <= number)
+
+
+def serialize_function(fn_name):
+    fn = OPERATORS[fn_name]
+    params = [
+        p
+        for p in inspect.signature(fn).parameters.values()
+        if p.kind == inspect.Parameter.POSITIONAL_OR_KEYWORD
+    ]
+
+    return {
+        "name": fn_name,
+        "doc": inspect.getdoc(fn),
+        "uses_field": fn.uses_field,
+        "params": [p.name for p in params],
+    }
+
+
+def check_trigger(trigger):
+    """
+    Returns an error message if the trigger can't be compiled into what its
+    author meant, otherwise None.
+    """
+
+    fn = trigger["fn"]
+    if fn not in OPERATORS:
+        return "Invalid function."
+
+    params = trigger["params"] or []
+    if fn == "regex":
+        error = check_regex(params[0] if params else "")
+        if error:
+            return error
+    if fn in ("gt", "gte", "lt", "lte"):
+        if as_number(params[0] if params else None) is None:
+            return "Invalid number."
+
+
+def compile_trigger(trigger):
+    return OPERATORS[trigger["fn"]](*(trigger["params"] or []))
+
+
+def field_value(submission, field):
+    if not field:
+        return None
+    if field == "_host":
+        return submission.host
+    if field == "_date":
+        return submission.submitted_at
+    return submission.data.get(field, "")
+
+
+class RuleMatcher(object):
+    """
+    All the routing rules of a form, compiled. Finding the recipients of a
+    submission is a single pass over them, reading each field once.
+    """
+
+    def __init__(self, rules):
+        self.rules = [
+            (rule.email, rule.id, rule.trigger["field"], compile_trigger(rule.trigger))
+            for rule in rules
+        ]
+
+    def recipients(self, submission):
+        values = {}
+        recipients = set()
+        for email, rule_id, field, predicate in self.rules:
+            if field not in values:
+                values[field] = field_value(submission, field)
+            try:
+                if predicate(values[field]):
+                    recipients.add((email, rule_id))
+            except RegexTimeout:
+                submission.append_error(
+                    "Routing rule took too long to match, skipped.", rule_id=rule_id
+                )
+        return recipients
+
+
+# (form_id, rules_version, rule ids) -> RuleMatcher. the version is bumped
+# whenever rules are changed through the api, the ids catch everything else.
+_matchers = {}
+
+
+def get_matcher(form):
+    rules = form.all_routing_rules
+    key = (form.id, form.rules_version, tuple(sorted(rule.id for rule in rules)))
+    matcher = _matchers.get(key)
+    if matcher is None:
+        if len(_matchers) > 10000:
+            _matchers.clear()
+        matcher = _matchers[key] = RuleMatcher(rules)
+    return matcher
@@ -20,10 +20,10 @@ from flask_login import current_user, login_required
 from formspree import settings
 from formspree.app_globals import (DB, spam_serializer)
 from formspree.email_templates import render_email
+from formspree.outbox import queue_email
 from formspree.utils import (
     request_wants_json,
     valid_url,
-    send_email,
     verify_captcha,
     requires_feature,
 )
@@ -199,7 +199,8 @@ def request_unconfirm_form(form_id):
         digest=form.unconfirm_digest(),
         _external=True,
     )
-    send_email(
+    queue_email(
+        "unsubscribe",
         to=form.email,
         subject="Unsubscribe from form at {}".format(form.host),
         html=render_email(
@@ -216,6 +217,7 @@ def request_unconfirm_form(form_id):
         ),
         sender=settings.DEFAULT_SENDER,
     )
+    DB.session.commit()
 
     return (
         render_template(
@@ -6,9 +6,22 @@ import click
 from flask_migrate import Migrate
 
 from formspree import app, settings
-from formspree.app_globals import redis_store, DB
-from formspree.forms.helpers import REDIS_COUNTER_KEY, HASHIDS_CODEC
-from formspree.forms.models import Form
+from formspree.app_globals import DB
+from formspree.forms.helpers import (
+    HASHIDS_CODEC,
+    get_monthly_counters,
+    migrate_legacy_monthly_counters,
+    get_rate_rejections,
+)
+from formspree.forms.models import (
+    Form,
+    EmailTemplate,
+    flush_submission_stream,
+    fold_counter_deltas,
+    reap_stuck_submissions,
+)
+from formspree.outbox import drain_outbox, replay_outbox
+from formspree.stats import get_stats, get_queue_stats
 
 # add flask-migrate commands
 migrate = Migrate(app, DB)
@@ -18,7 +31,12 @@ migrate = Migrate(app, DB)
 @click.option("-i", "--id", default=None, help="form id")
 @click.option("-H", "--host", default=None, help="referer hostname")
 @click.option("-e", "--email", default=None, help="form email")
-def monthly_counters(email=None, host=None, id=None, month=datetime.date.today().month):
+@click.option("-y", "--year", default=datetime.date.today().year, help="year")
+@click.option("-m", "--month", default=datetime.date.today().month, help="month")
+@click.option("-t", "--top", default=20, help="forms to show when not filtering")
+def monthly_counters(email, host, id, year, month, top):
+    counters = get_monthly_counters(year, month)
+
     if id:
         query = [Form.query.get(id)]
     elif email and host:
@@ -28,14 +46,18 @@ def monthly_counters(email=None, host=None, id=None, month=datetime.date.today()
     elif host and not email:
         query = Form.query.filter_by(host=host)
     else:
-        print("supply each --email or --form or both (or --id).")
-        return 1
+        busiest = sorted(counters, key=counters.get, reverse=True)[:top]
+        query = sorted(
+            Form.query.filter(Form.id.in_(busiest)), key=lambda f: busiest.index(f.id)
+        )
 
     for form in query:
-        nsubmissions = (
-            redis_store.get(REDIS_COUNTER_KEY(form_id=form.id, month=month)) or 0
-        )
-        print("%s submissions for %s" % (nsubmissions, form))
+        print("%s submissions for %s" % (counters.get(form.id, 0), form))
+
+
+@app.cli.command()
+def migrate_monthly_counters():
+    print("moved %s counters" % migrate_legacy_monthly_counters())
 
 
 @app.cli.command()
@@ -44,6 +66,80 @@ def hashid_to_id(hashid):
     print(HASHIDS_CODEC.decode(hashid)[0])
 
 
+@app.cli.command()
+def flush_submissions():
+    flush_submission_stream()
+
+
+@app.cli.command()
+def fold_counters():
+    fold_counter_deltas()
+
+
+@app.cli.command()
+def inline_templates():
+    templates = EmailTemplate.query.filter(
+        EmailTemplate.inlined_body.is_(None), EmailTemplate.body.isnot(None)
+    ).all()
+    for template in templates:
+        template.inline()
+    DB.session.commit()
+    inlined = sum(1 for t in templates if t.inlined_body)
+    print("inlined %s of %s templates" % (inlined, len(templates)))
+
+
+@app.cli.command()
+def reap_submissions():
+    counts = reap_stuck_submissions()
+    print(
+        "%(requeued)s submissions enqueued again, gave up on %(given_up)s, "
+        "%(interrupted)s interrupted while delivering" % counts
+    )
+
+
+@app.cli.command()
+def drain_email_outbox():
+    counts = drain_outbox()
+    print(
+        "%(enqueued)s emails enqueued again, %(failed)s out of attempts failed, "
+        "%(purged)s old ones deleted" % counts
+    )
+
+
+@app.cli.command()
+@click.option("-h", "--hours", default=24, help="replay failures of the last hours")
+@click.option("-k", "--kind", default=None, help="only emails of this kind")
+def replay_email_outbox(hours, kind):
+    since = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+    print("%s failed emails enqueued again" % replay_outbox(since, kind))
+
+
+@app.cli.command()
+@click.option("-d", "--days", default=1, help="number of days to show")
+def stats(days):
+    today = datetime.date.today()
+    for n in range(days):
+        day = today - datetime.timedelta(days=n)
+        print(day.isoformat())
+        for name, value in sorted(get_stats(day).items()):
+            print("  %s: %s" % (name, value))
+
+
+@app.cli.command()
+def queue_stats():
+    for queue, stats in get_queue_stats().items():
+        age = "-" if stats["age"] is None else "%ss" % stats["age"]
+        print("%-22s %6d waiting, oldest %s" % (queue, stats["depth"], age))
+
+
+@app.cli.command()
+@click.option("-n", "--top", default=20, help="number of forms to show")
+def rate_limited(top):
+    rejections = get_rate_rejections(datetime.date.today())
+    for form_id, count in sorted(rejections.items(), key=lambda x: -x[1])[:top]:
+        print("%s rate limited submissions for %s" % (count, Form.query.get(form_id)))
+
+
 @app.cli.command()
 def super_user_password():
     print(
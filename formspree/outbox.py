@@ -0,0 +1,387 @@
+import json
+import time
+import datetime
+
+from flask import g
+from sqlalchemy import Index, event
+from sqlalchemy.sql import text
+from sqlalchemy.dialects.postgresql import JSON
+
+from formspree import settings, utils
+from formspree.app_globals import DB, celery, redis_store
+from formspree.stats import incr_stat, REDIS_STATS_KEY
+from formspree.forms.helpers import TOKEN_BUCKET_LUA
+
+REDIS_OUTBOX_BUCKET_KEY = "outbox_bucket_{provider}".format
+
+
+class OutboxStatus(DB.Enum):
+    pending = "pending"
+    sending = "sending"
+    sent = "sent"
+    failed = "failed"
+    statuses = [pending, sending, sent, failed]
+
+
+class OutboxEmail(DB.Model):
+    """
+    An email to be sent, and what became of it. Callers add them with
+    queue_email in their own transaction, the outbox workers send them once
+    it is committed (see send_outbox_email), so a slow provider never holds
+    up whoever is sending.
+    """
+
+    __tablename__ = "email_outbox"
+
+    id = DB.Column(DB.BigInteger, primary_key=True)
+    created_at = DB.Column(
+        DB.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    kind = DB.Column(DB.String(32), nullable=False)
+    # the arguments to send_email
+    message = DB.Column(JSON, nullable=False)
+    # for submission emails, the ids of the rules that matched each
+    # recipient, so failures are recorded against the right ones. not a
+    # foreign key: the submission may be deleted in the same transaction
+    # when the form doesn't store them.
+    submission_id = DB.Column(DB.Integer)
+    recipients = DB.Column(JSON)
+    status = DB.Column(
+        DB.Enum(*OutboxStatus.statuses, name="outbox_status"),
+        nullable=False,
+        default="pending",
+    )
+    attempts = DB.Column(DB.Integer, nullable=False, default=0, server_default="0")
+    # when a pending email is due, or when a sending one is given up for
+    # lost. for sent emails that's around when they were sent.
+    next_attempt_at = DB.Column(
+        DB.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    sent_at = DB.Column(DB.DateTime)
+    last_error = DB.Column(DB.Text)
+
+    # drain_outbox looks for those that are due
+    Index("ix_email_outbox_status_next_attempt_at", status, next_attempt_at)
+
+
+def queue_email(kind, submission_id=None, recipients=None, **message):
+    """
+    Adds an email to the outbox. It is sent after the current transaction
+    is committed, and never if it is rolled back. Takes the same arguments
+    as send_email.
+    """
+
+    if None in [message.get(k) for k in ("to", "subject", "text", "sender")]:
+        raise ValueError("to, subject text and sender required to send email")
+
+    email = OutboxEmail(
+        kind=kind, message=message, submission_id=submission_id, recipients=recipients
+    )
+    DB.session.add(email)
+    DB.session.info.setdefault("outbox", []).append(email)
+    return email
+
+
+@event.listens_for(DB.session, "after_commit")
+def send_committed_emails(session):
+    if session.transaction.nested:
+        # only a savepoint, the emails aren't committed yet.
+        return
+
+    for email in session.info.pop("outbox", []):
+        send_outbox_email.delay(email.id)
+
+
+@event.listens_for(DB.session, "after_rollback")
+def discard_queued_emails(session):
+    if session.transaction.nested:
+        return
+
+    session.info.pop("outbox", None)
+
+
+_token_bucket_script = None
+
+
+def take_send_token():
+    """
+    Takes a token from the bucket of the provider we're sending through,
+    shared by all the outbox workers. Returns 0 if a token was taken,
+    otherwise the seconds until one is available.
+    """
+
+    global _token_bucket_script
+    if _token_bucket_script is None:
+        _token_bucket_script = redis_store.register_script(TOKEN_BUCKET_LUA)
+
+    allowed, wait_ms = _token_bucket_script(
+        keys=[
+            REDIS_OUTBOX_BUCKET_KEY(provider=settings.EMAIL_TRANSPORT),
+            REDIS_STATS_KEY(day=datetime.date.today().isoformat()),
+        ],
+        args=[
+            settings.OUTBOX_BURST,
+            settings.OUTBOX_RATE_LIMIT,
+            repr(time.time()),
+            0,
+            "outbox_rate_limited",
+            settings.STATS_RETENTION_DAYS * 86400,
+        ],
+        client=redis_store,
+    )
+    return 0 if allowed else wait_ms / 1000.0
+
+
+def is_rejection(result):
+    # the provider didn't like the request itself, trying again won't help.
+    return 400 <= result[2] < 500 and result[2] != 429
+
+
+def describe(result):
+    return "code {}: {}".format(result[2], result[1])
+
+
+def record_failures(conn, submission_id, failures):
+    """
+    Appends an error to the submission for each rule whose recipient
+    couldn't be sent its email. `failures` are (rule_ids, result) pairs.
+    """
+
+    errors = [
+        {
+            "message": "Could not send email",
+            "plugin": None,
+            "rule": rule_id,
+            "debug": describe(result),
+        }
+        for rule_ids, result in failures
+        for rule_id in rule_ids
+    ]
+    conn.execute(
+        text(
+            "UPDATE submissions SET errors = ( "
+            "  coalesce(errors::jsonb, '[]') || CAST(:errors AS jsonb) "
+            ")::json "
+            "WHERE id = :id"
+        ),
+        {"id": submission_id, "errors": json.dumps(errors)},
+    )
+
+
+def extend_sending(email_id, attempt):
+    """
+    Pushes back the moment a sending email is taken for lost, for when it
+    takes more than one request. Returns False if it was taken for lost
+    already and that attempt is over.
+    """
+
+    lost_at = datetime.datetime.utcnow() + datetime.timedelta(
+        seconds=settings.OUTBOX_SEND_TIMEOUT
+    )
+    with DB.engine.begin() as conn:
+        extended = conn.execute(
+            text(
+                "UPDATE email_outbox SET next_attempt_at = :lost_at "
+                "WHERE id = :id AND status = 'sending' AND attempts = :attempt"
+            ),
+            {"id": email_id, "lost_at": lost_at, "attempt": attempt},
+        ).rowcount
+    return extended > 0
+
+
+@celery.task()
+def send_outbox_email(email_id):
+    """
+    Sends an email from the outbox. Throttling and server errors are tried
+    again later, up to OUTBOX_MAX_ATTEMPTS times, waiting longer each time.
+
+    It only uses short transactions of its own, outside of the session, so
+    it can run right after the commit that queued the email.
+    """
+
+    wait = take_send_token()
+    if wait:
+        send_outbox_email.apply_async((email_id,), countdown=wait)
+        return
+
+    now = datetime.datetime.utcnow()
+    lost_at = now + datetime.timedelta(seconds=settings.OUTBOX_SEND_TIMEOUT)
+    with DB.engine.begin() as conn:
+        email = conn.execute(
+            text(
+                "UPDATE email_outbox "
+                "SET status = 'sending', attempts = attempts + 1, "
+                "    next_attempt_at = :lost_at "
+                "WHERE id = :id AND status = 'pending' "
+                "RETURNING message, submission_id, recipients, attempts"
+            ),
+            {"id": email_id, "lost_at": lost_at},
+        ).first()
+    if email is None:
+        # already sent, or being sent by someone else.
+        return
+
+    recipients = email.recipients or {}
+    result = utils.send_email(**email.message)
+
+    failures = []
+    retry = {}
+    if result[0]:
+        status = "sent"
+    elif len(recipients) > 1 and is_rejection(result):
+        # the provider refused the whole batch, most likely because of one
+        # bad address. send them one by one to find out which.
+        for to, rule_ids in recipients.items():
+            if not extend_sending(email_id, email.attempts):
+                # taken for lost and picked up by another worker meanwhile.
+                return
+            single = utils.send_email(**dict(email.message, to=to))
+            if single[0]:
+                continue
+            if is_rejection(single) or email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                failures.append((rule_ids, single))
+            else:
+                # throttled or a server error, this email is left for them.
+                retry[to] = (rule_ids, single)
+        if retry:
+            status = "pending"
+        else:
+            status = "failed" if len(failures) == len(recipients) else "sent"
+    elif is_rejection(result) or email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        status = "failed"
+        failures = [(rule_ids, result) for rule_ids in recipients.values()]
+    else:
+        status = "pending"
+
+    if failures or retry:
+        error = "; ".join(describe(r) for _, r in failures + list(retry.values()))
+    else:
+        error = None if result[0] else describe(result)
+    message = left = None
+    if retry:
+        # only those left are sent when it is tried again.
+        to = sorted(retry)
+        message = json.dumps(dict(email.message, to=to[0] if len(to) == 1 else to))
+        left = json.dumps({to: rule_ids for to, (rule_ids, _) in retry.items()})
+    delay = settings.OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1)
+    now = datetime.datetime.utcnow()
+    with DB.engine.begin() as conn:
+        conn.execute(
+            text(
+                "UPDATE email_outbox "
+                "SET status = CAST(:status AS outbox_status), last_error = :error, "
+                "    sent_at = :sent_at, next_attempt_at = :next_attempt_at, "
+                "    message = coalesce(CAST(:message AS json), message), "
+                "    recipients = coalesce(CAST(:recipients AS json), recipients) "
+                "WHERE id = :id"
+            ),
+            {
+                "id": email_id,
+                "status": status,
+                "error": error,
+                "message": message,
+                "recipients": left,
+                "sent_at": now if status == "sent" else None,
+                "next_attempt_at": now
+                + datetime.timedelta(seconds=delay if status == "pending" else 0),
+            },
+        )
+        if failures and email.submission_id:
+            record_failures(conn, email.submission_id, failures)
+
+    incr_stat("outbox_" + ("retried" if status == "pending" else status))
+    if status == "pending":
+        g.log.info("Will try sending email again.", id=email_id, delay=delay)
+        send_outbox_email.apply_async((email_id,), countdown=delay)
+
+
+@celery.task()
+def drain_outbox():
+    """
+    Enqueues again the emails that are due and haven't been sent: those
+    whose task was lost, those waiting to be retried and those whose worker
+    died while sending them, unless that was their last attempt, then they
+    are failed. Deletes sent emails older than OUTBOX_RETENTION_DAYS.
+    Returns the counts.
+    """
+
+    now = datetime.datetime.utcnow()
+    params = {
+        # anything newer most likely has its task waiting in the queue.
+        "before": now - datetime.timedelta(seconds=settings.OUTBOX_DRAIN_INTERVAL),
+        "limit": settings.OUTBOX_BATCH_SIZE,
+        "max": settings.OUTBOX_MAX_ATTEMPTS,
+    }
+    failed = DB.session.execute(
+        text(
+            "UPDATE email_outbox SET status = 'failed', "
+            "  last_error = coalesce(last_error || '; ', '') || :error "
+            "WHERE id IN ( "
+            "  SELECT id FROM email_outbox "
+            "  WHERE status = 'sending' AND attempts >= :max "
+            "    AND next_attempt_at < :before "
+            "  ORDER BY next_attempt_at LIMIT :limit "
+            "  FOR UPDATE SKIP LOCKED "
+            ") "
+            "RETURNING id"
+        ),
+        dict(params, error="the last attempt was interrupted"),
+    ).fetchall()
+    due = DB.session.execute(
+        text(
+            "UPDATE email_outbox SET status = 'pending' "
+            "WHERE id IN ( "
+            "  SELECT id FROM email_outbox "
+            "  WHERE status IN ('pending', 'sending') AND next_attempt_at < :before "
+            "    AND (status = 'pending' OR attempts < :max) "
+            "  ORDER BY next_attempt_at LIMIT :limit "
+            "  FOR UPDATE SKIP LOCKED "
+            ") "
+            "RETURNING id"
+        ),
+        params,
+    ).fetchall()
+    purged = DB.session.execute(
+        text(
+            "DELETE FROM email_outbox WHERE id IN ( "
+            "  SELECT id FROM email_outbox "
+            "  WHERE status = 'sent' AND next_attempt_at < :expired "
+            "  LIMIT :limit "
+            ")"
+        ),
+        {
+            "expired": now - datetime.timedelta(days=settings.OUTBOX_RETENTION_DAYS),
+            "limit": settings.OUTBOX_BATCH_SIZE,
+        },
+    ).rowcount
+    DB.session.commit()
+
+    for (email_id,) in due:
+        send_outbox_email.delay(email_id)
+
+    counts = {"enqueued": len(due), "failed": len(failed), "purged": purged}
+    g.log.info("Drained the outbox.", **counts)
+    return counts
+
+
+def replay_outbox(since, kind=None):
+    """
+    Puts back in the outbox the emails that failed after `since`, as after
+    an outage of the provider. Returns how many.
+    """
+
+    replayed = DB.session.execute(
+        text(
+            "UPDATE email_outbox "
+            "SET status = 'pending', attempts = 0, next_attempt_at = :now "
+            "WHERE status = 'failed' AND created_at >= :since "
+            "  AND (CAST(:kind AS text) IS NULL OR kind = :kind) "
+            "RETURNING id"
+        ),
+        {"now": datetime.datetime.utcnow(), "since": since, "kind": kind},
+    ).fetchall()
+    DB.session.commit()
+
+    for (email_id,) in replayed:
+        send_outbox_email.delay(email_id)
+    return len(replayed)
@@ -103,6 +103,7 @@ def dispatch_webhook(
                     attempt + 1,
                 ),
                 countdown=2 ** ((attempt + 1) * 4),
+                queue="webhook_retries",
             )
         else:
             call_it_a_failure(plugin_id)
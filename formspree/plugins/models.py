@@ -14,7 +14,8 @@ from flask import g, url_for, render_template
 from formspree import settings
 from formspree.app_globals import DB, redis_store
 from formspree.email_templates import render_email
-from formspree.utils import send_email, is_valid_email
+from formspree.outbox import queue_email
+from formspree.utils import is_valid_email
 from .helpers import (
     dispatch_webhook,
     call_it_a_failure,
@@ -90,7 +91,6 @@ class Plugin(DB.Model):
             redis_store.delete(key)
             self.enabled = False
             DB.session.add(self)
-            DB.session.commit()
 
             # notify them through email
             render_args = dict(
@@ -104,7 +104,8 @@ class Plugin(DB.Model):
                     _external=True,
                 ),
             )
-            send_email(
+            queue_email(
+                "plugin_disabled",
                 to=self.form.email,
                 subject="Plugin disabled due to delivery failure",
                 text=render_template(
@@ -113,6 +114,7 @@ class Plugin(DB.Model):
                 html=render_email("plugin-disabled-notification.html", **render_args),
                 sender=settings.DEFAULT_SENDER,
             )
+            # both are committed by whoever is processing the submission.
         else:
             g.log.debug(
                 "Dispatching submission to plugin.",
@@ -25,6 +25,8 @@ SPAM_SECRET = os.getenv("SPAM_SECRET") or ""
 
 GRANDFATHER_MONTHLY_LIMIT = 1000
 OVERLIMIT_NOTIFICATION_QUANTITY = 25
+# what to do with submissions that come after the overlimit notifications
+OVERLIMIT_SUBMISSIONS = os.getenv("OVERLIMIT_SUBMISSIONS") or "store"  # or "drop"
 MONTHLY_SUBMISSIONS_LIMIT = int(os.getenv("MONTHLY_SUBMISSIONS_LIMIT") or 100)
 ARCHIVED_SUBMISSIONS_LIMIT = int(os.getenv("ARCHIVED_SUBMISSIONS_LIMIT") or 1000)
 LINKED_EMAIL_ADDRESSES_LIMIT = int(os.getenv("LINKED_EMAIL_ADDRESSES_LIMIT") or 3)
@@ -38,9 +40,32 @@ PROMO_DELAY = int(os.getenv("PROMO_DELAY", "10000"))
 FAILED_WEBHOOKS_ALLOWED = 6
 CURRENT_SALE = os.getenv("CURRENT_SALE", None)
 
-EXPENSIVELY_WIPE_SUBMISSIONS_FREQUENCY = float(
-    os.getenv("EXPENSIVELY_WIPE_SUBMISSIONS_FREQUENCY") or 0.2
-)
+FEATURES_CACHE_TTL = int(os.getenv("FEATURES_CACHE_TTL") or 300)
+FORM_CACHE_TTL = int(os.getenv("FORM_CACHE_TTL") or 600)
+FORM_NEGATIVE_CACHE_TTL = int(os.getenv("FORM_NEGATIVE_CACHE_TTL") or 60)
+STATS_RETENTION_DAYS = int(os.getenv("STATS_RETENTION_DAYS") or 30)
+SIGNED_HOST_NONCE = os.getenv("SIGNED_HOST_NONCE", "True") in trueish
+HOST_NONCE_MAX_AGE = int(os.getenv("HOST_NONCE_MAX_AGE") or 300000)
+
+DUPLICATE_SUBMISSION_WINDOW = int(os.getenv("DUPLICATE_SUBMISSION_WINDOW") or 10)
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL") or 86400)
+SUBMISSION_INGEST = os.getenv("SUBMISSION_INGEST") or "direct"  # or "stream"
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE") or 500)
+INGEST_FLUSH_DELAY = float(os.getenv("INGEST_FLUSH_DELAY") or 0.5)
+SUBMISSION_PROCESSING = os.getenv("SUBMISSION_PROCESSING") or "task"  # or "batch"
+PROCESSING_BATCH_SIZE = int(os.getenv("PROCESSING_BATCH_SIZE") or 100)
+PROCESSING_BATCH_DELAY = float(os.getenv("PROCESSING_BATCH_DELAY") or 1)
+COUNTER_FOLD_INTERVAL = float(os.getenv("COUNTER_FOLD_INTERVAL") or 60)
+COUNTER_FOLD_BATCH_SIZE = int(os.getenv("COUNTER_FOLD_BATCH_SIZE") or 10000)
+REAPER_INTERVAL = float(os.getenv("REAPER_INTERVAL") or 300)
+REAPER_BATCH_SIZE = int(os.getenv("REAPER_BATCH_SIZE") or 1000)
+STUCK_SUBMISSION_AGE = int(os.getenv("STUCK_SUBMISSION_AGE") or 600)
+MAX_SUBMISSION_ATTEMPTS = int(os.getenv("MAX_SUBMISSION_ATTEMPTS") or 3)
+DIGEST_INTERVALS = [15, 60, 360, 1440]  # minutes, the choices forms have
+DIGEST_CHECK_INTERVAL = float(os.getenv("DIGEST_CHECK_INTERVAL") or 60)
+DIGEST_MAX_ENTRIES = int(os.getenv("DIGEST_MAX_ENTRIES") or 100)
+DIGEST_RETRY_DELAY = float(os.getenv("DIGEST_RETRY_DELAY") or 300)
+
 REDIS_URL = (
     os.getenv("REDISTOGO_URL")
     or os.getenv("REDISCLOUD_URL")
@@ -74,6 +99,24 @@ API_ROOT = os.getenv("API_ROOT") or "//example.com"
 SENDGRID_USERNAME = os.getenv("SENDGRID_USERNAME")
 SENDGRID_PASSWORD = os.getenv("SENDGRID_PASSWORD")
 
+EMAIL_TRANSPORT = os.getenv("EMAIL_TRANSPORT") or "sendgrid"  # or "file", "smtp"
+EMAIL_CONNECT_TIMEOUT = float(os.getenv("EMAIL_CONNECT_TIMEOUT") or 3.05)
+EMAIL_READ_TIMEOUT = float(os.getenv("EMAIL_READ_TIMEOUT") or 10)
+EMAIL_POOL_SIZE = int(os.getenv("EMAIL_POOL_SIZE") or 10)
+EMAIL_RETRIES = int(os.getenv("EMAIL_RETRIES") or 3)
+EMAIL_RETRY_BACKOFF = float(os.getenv("EMAIL_RETRY_BACKOFF") or 0.5)
+EMAIL_FILE_PATH = os.getenv("EMAIL_FILE_PATH") or "emails.jsonl"
+EMAIL_SMTP_HOST = os.getenv("EMAIL_SMTP_HOST") or "localhost"
+EMAIL_SMTP_PORT = int(os.getenv("EMAIL_SMTP_PORT") or 1025)
+OUTBOX_RATE_LIMIT = float(os.getenv("OUTBOX_RATE_LIMIT") or 50)  # emails per second
+OUTBOX_BURST = int(os.getenv("OUTBOX_BURST") or 100)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS") or 5)
+OUTBOX_RETRY_DELAY = int(os.getenv("OUTBOX_RETRY_DELAY") or 60)
+OUTBOX_SEND_TIMEOUT = int(os.getenv("OUTBOX_SEND_TIMEOUT") or 300)
+OUTBOX_DRAIN_INTERVAL = float(os.getenv("OUTBOX_DRAIN_INTERVAL") or 60)
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE") or 1000)
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS") or 7)
+
 STRIPE_TEST_PUBLISHABLE_KEY = os.getenv("STRIPE_TEST_PUBLISHABLE_KEY")
 STRIPE_TEST_SECRET_KEY = os.getenv("STRIPE_TEST_SECRET_KEY")
 STRIPE_PUBLISHABLE_KEY = (
@@ -88,6 +131,11 @@ OLARK_KEY = os.getenv("OLARK_KEY", "123456")
 
 RECAPTCHA_SECRET = os.getenv("RECAPTCHA_SECRET")
 RECAPTCHA_KEY = os.getenv("RECAPTCHA_KEY")
+RECAPTCHA_VERIFIER = os.getenv("RECAPTCHA_VERIFIER") or "google"  # or "local"
+RECAPTCHA_TIMEOUT = float(os.getenv("RECAPTCHA_TIMEOUT") or 2)
+RECAPTCHA_POOL_SIZE = int(os.getenv("RECAPTCHA_POOL_SIZE") or 10)
+RECAPTCHA_CACHE_TTL = int(os.getenv("RECAPTCHA_CACHE_TTL") or 120)
+RECAPTCHA_FAIL_OPEN = os.getenv("RECAPTCHA_FAIL_OPEN", "True") in trueish
 
 RATE_LIMIT = os.getenv("RATE_LIMIT", "120 per hour")
 REDIS_RATE_LIMIT = os.getenv("REDIS_URL")  # heroku-redis
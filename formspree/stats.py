@@ -0,0 +1,78 @@
+import json
+import time
+import datetime
+
+from formspree import settings
+from formspree.app_globals import redis_store, QUEUES
+
+REDIS_STATS_KEY = "stats_{day}".format
+
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2000, 5000)
+
+
+def incr_stat(name, amount=1):
+    incr_stats({name: amount})
+
+
+def incr_stats(amounts):
+    """
+    Daily counters of things we want to keep an eye on (cache hits, rejected
+    submissions...), kept in a redis hash per day. See `flask stats`.
+    """
+
+    key = REDIS_STATS_KEY(day=datetime.date.today().isoformat())
+    pipe = redis_store.pipeline(transaction=False)
+    for name, amount in amounts.items():
+        pipe.hincrby(key, name, amount)
+    pipe.expire(key, settings.STATS_RETENTION_DAYS * 86400)
+    pipe.execute()
+
+
+def observe_latency(name, seconds, outcome="ok"):
+    """
+    Counts a call to an external service by outcome, and its latency in a
+    coarse histogram (`<name>_le_<ms>ms` buckets, plus a total in ms).
+    """
+
+    ms = int(seconds * 1000)
+    bucket = next(("%sms" % b for b in LATENCY_BUCKETS_MS if ms <= b), "inf")
+    incr_stats(
+        {
+            "{}_{}".format(name, outcome): 1,
+            "{}_le_{}".format(name, bucket): 1,
+            "{}_ms_total".format(name): ms,
+        }
+    )
+
+
+def get_stats(day=None):
+    day = day or datetime.date.today()
+    values = redis_store.hgetall(REDIS_STATS_KEY(day=day.isoformat()))
+    return {k.decode("utf-8"): int(v) for k, v in values.items()}
+
+
+def get_queue_stats():
+    """
+    The number of tasks waiting in each celery queue and how long the oldest
+    has been waiting, in seconds. The broker is the same redis we use.
+    """
+
+    pipe = redis_store.pipeline(transaction=False)
+    for queue in QUEUES:
+        pipe.llen(queue)
+        pipe.lindex(queue, -1)  # tasks are pushed on the left
+    results = pipe.execute()
+
+    now = time.time()
+    stats = {}
+    for i, queue in enumerate(QUEUES):
+        depth, oldest = results[2 * i], results[2 * i + 1]
+        age = None
+        if oldest:
+            try:
+                message = json.loads(oldest.decode("utf-8"))
+                age = round(now - message["headers"]["enqueued_at"], 1)
+            except (ValueError, KeyError, TypeError):
+                pass
+        stats[queue] = {"depth": depth, "age": age}
+    return stats
@@ -11,6 +11,7 @@ from sqlalchemy.exc import IntegrityError
 from formspree import settings
 from formspree.app_globals import DB
 from formspree.email_templates import render_email
+from formspree.outbox import queue_email
 from formspree.utils import send_email, is_valid_email
 from .helpers import store_pending_email
 
@@ -149,11 +150,13 @@ class Plan(DB.Enum):
         "v1_free": {
             "product": Product.free,
             "price": 0,
+            "submission_rate": {"burst": 30, "per_minute": 20},
             "features": ["base", "replyto", "recaptcha"],
         },
         "gold": {  # the old gold still shines.
             "product": Product.gold,
             "price": 9.99,
+            "submission_rate": {"burst": 100, "per_minute": 60},
             "features": [
                 # Free
                 "base",
@@ -174,6 +177,7 @@ class Plan(DB.Enum):
         "v1_gold": {
             "product": Product.gold,
             "price": 12,
+            "submission_rate": {"burst": 100, "per_minute": 60},
             "features": [
                 # Free
                 "base",
@@ -193,6 +197,7 @@ class Plan(DB.Enum):
         "v1_gold_yearly": {
             "product": Product.gold,
             "price": 120,
+            "submission_rate": {"burst": 100, "per_minute": 60},
             "features": [
                 # Free
                 "base",
@@ -212,6 +217,7 @@ class Plan(DB.Enum):
         "v1_platinum": {
             "product": Product.platinum,
             "price": 48,
+            "submission_rate": {"burst": 300, "per_minute": 300},
             "features": [
                 # Free
                 "base",
@@ -236,6 +242,7 @@ class Plan(DB.Enum):
         "v1_platinum_yearly": {
             "product": Product.platinum,
             "price": 480,
+            "submission_rate": {"burst": 300, "per_minute": 300},
             "features": [
                 # Free
                 "base",
@@ -263,6 +270,10 @@ class Plan(DB.Enum):
     def has_feature(cls, plan, feature_id):
         return feature_id in cls.plan_defs[plan]["features"]
 
+    @classmethod
+    def submission_rate(cls, plan):
+        return cls.plan_defs[plan]["submission_rate"]
+
 
 def _merge_plan_details(plan):
     """ conveneince method for building plan lists"""
@@ -371,6 +382,10 @@ class User(DB.Model):
     def features(self):
         return Plan.plan_defs[self.plan]["features"]
 
+    @property
+    def submission_rate(self):
+        return Plan.submission_rate(self.plan)
+
     @property
     def public_id(self):
         """ 
@@ -403,7 +418,8 @@ class User(DB.Model):
         link = url_for(
             "reset-password", digest=digest, email=self.email, _external=True
         )
-        res = send_email(
+        queue_email(
+            "password_reset",
             to=self.email,
             subject="Reset your %s password!" % settings.SERVICE_NAME,
             text=render_template(
@@ -412,11 +428,7 @@ class User(DB.Model):
             html=render_email("reset-password.html", add=self.email, link=link),
             sender=settings.ACCOUNT_SENDER,
         )
-        if not res[0]:
-            g.log.info("Failed to send email.", reason=res[1], code=res[2])
-            return False
-        else:
-            return True
+        DB.session.commit()
 
     @classmethod
     def register(cls, email, password):
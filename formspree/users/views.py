@@ -152,15 +152,13 @@ def forgot_password():
     elif request.method == "POST":
         email = request.form["email"].lower().strip()
         user = User.query.filter_by(email=email).first()
-        if not user or user.send_password_reset():
-            return render_template(
-                "info.html",
-                title="Reset email sent",
-                text="We've sent you a password reset link. Please check your email.",
-            )
-        else:
-            flash("Something is wrong, please report this to us.", "error")
-        return redirect(url_for("login", next=request.args.get("next")))
+        if user:
+            user.send_password_reset()
+        return render_template(
+            "info.html",
+            title="Reset email sent",
+            text="We've sent you a password reset link. Please check your email.",
+        )
 
 
 def reset_password(digest):
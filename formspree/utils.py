@@ -1,8 +1,14 @@
+import time
+import random
+import smtplib
+import hashlib
 import requests
 import datetime
 import calendar
 import json
 import re
+from email.message import EmailMessage
+from email.utils import formataddr
 from urllib.parse import urlparse, urlunparse
 from functools import wraps, partial
 
@@ -10,9 +16,14 @@ from flask import request, url_for, jsonify, g
 from flask_login import current_user
 
 from formspree import settings
+from formspree.app_globals import redis_store
+from formspree.stats import incr_stat, observe_latency
 
 CAPTCHA_URL = "https://www.google.com/recaptcha/api/siteverify"
 CAPTCHA_VAL = "g-recaptcha-response"
+REDIS_CAPTCHA_KEY = "captcha_{digest}".format
+SENDGRID_URL = "https://api.sendgrid.com/api/mail.send.json"
+MAX_RECIPIENTS_PER_EMAIL = 1000  # sendgrid's limit for x-smtpapi "to"
 
 def is_valid_email(addr):
     return re.match(r"[^@]+@[^@]+\.[^@]+", addr) is not None
@@ -110,6 +121,178 @@ def next_url(referrer=None, next=None):
         return url_for("thanks", next=referrer)
 
 
+class SendgridTransport(object):
+    """
+    Sends email through SendGrid's web API, reusing keep-alive connections
+    from a pool shared by the whole process.
+
+    Throttling (429) and server errors (5xx) are retried with jittered
+    exponential backoff, and so are connections that couldn't be opened.
+    A read timeout is not retried: SendGrid may have accepted the message
+    already and we'd rather lose an email than send it twice.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self, username, password, connect_timeout, read_timeout, pool_size, retries
+    ):
+        self.credentials = {"api_user": username, "api_key": password}
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size),
+        )
+
+    def backoff(self, attempt):
+        return settings.EMAIL_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def post(self, data):
+        start = time.time()
+        try:
+            r = self.session.post(
+                SENDGRID_URL, data=dict(data, **self.credentials), timeout=self.timeout
+            )
+        except requests.exceptions.Timeout:
+            observe_latency("sendgrid", time.time() - start, "timeout")
+            raise
+        except requests.exceptions.ConnectionError:
+            observe_latency("sendgrid", time.time() - start, "error")
+            raise
+
+        if r.ok:
+            outcome = "ok"
+        elif r.status_code == 429:
+            outcome = "throttled"
+        elif r.status_code >= 500:
+            outcome = "error"
+        else:
+            outcome = "rejected"
+        observe_latency("sendgrid", time.time() - start, outcome)
+        return r
+
+    def send(self, data):
+        attempt = 0
+        while True:
+            try:
+                r = self.post(data)
+            except requests.exceptions.ReadTimeout:
+                return False, "Timed out waiting for SendGrid.", 504
+            except requests.exceptions.ConnectionError as e:
+                if attempt >= self.retries:
+                    return False, "Could not connect to SendGrid: {}".format(e), 503
+            else:
+                if r.status_code not in self.RETRY_STATUSES or attempt >= self.retries:
+                    break
+
+            incr_stat("sendgrid_retry")
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+        errmsg = ""
+        if not r.ok:
+            try:
+                errmsg = "; \n".join(r.json().get("errors"))
+            except (ValueError, TypeError):
+                errmsg = r.text
+        return r.ok, errmsg, r.status_code
+
+
+class FileTransport(object):
+    """
+    Stand-in for load tests: appends each email as a line of JSON to a file
+    instead of sending it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, data):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(data) + "\n")
+        return True, "", 200
+
+
+class SmtpTransport(object):
+    """
+    Stand-in for load tests: hands each email to an SMTP sink (MailHog, a
+    local debugging server), over one connection kept open per process.
+    """
+
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connection = None
+
+    def message(self, data):
+        message = EmailMessage()
+        message["Subject"] = data["subject"]
+        message["From"] = formataddr((data.get("fromname", ""), data["from"]))
+        message["To"] = data["to"]
+        if data.get("cc"):
+            message["Cc"] = ", ".join(data["cc"])
+        if data.get("replyto"):
+            message["Reply-To"] = data["replyto"]
+        for name, value in json.loads(data.get("headers") or "{}").items():
+            message[name] = value
+        message.set_content(data["text"])
+        if data.get("html"):
+            message.add_alternative(data["html"], subtype="html")
+        return message
+
+    def send(self, data):
+        message = self.message(data)
+        recipients = json.loads(data.get("x-smtpapi") or "{}").get("to")
+        for _ in range(2):
+            try:
+                if self.connection is None:
+                    self.connection = smtplib.SMTP(
+                        self.host, self.port, timeout=self.timeout
+                    )
+                for to in recipients or [data["to"]]:
+                    message.replace_header("To", to)
+                    self.connection.send_message(message)
+                return True, "", 250
+            except smtplib.SMTPServerDisconnected:
+                # the sink closed our idle connection, open another one.
+                self.connection = None
+            except smtplib.SMTPResponseException as e:
+                return False, str(e.smtp_error), e.smtp_code
+            except OSError as e:
+                self.connection = None
+                return False, str(e), 503
+        return False, "SMTP server disconnected.", 503
+
+
+_email_transports = {}
+
+
+def get_email_transport():
+    kind = settings.EMAIL_TRANSPORT
+    if kind not in _email_transports:
+        if kind == "file":
+            _email_transports[kind] = FileTransport(settings.EMAIL_FILE_PATH)
+        elif kind == "smtp":
+            _email_transports[kind] = SmtpTransport(
+                settings.EMAIL_SMTP_HOST,
+                settings.EMAIL_SMTP_PORT,
+                settings.EMAIL_READ_TIMEOUT,
+            )
+        else:
+            _email_transports[kind] = SendgridTransport(
+                settings.SENDGRID_USERNAME,
+                settings.SENDGRID_PASSWORD,
+                settings.EMAIL_CONNECT_TIMEOUT,
+                settings.EMAIL_READ_TIMEOUT,
+                settings.EMAIL_POOL_SIZE,
+                settings.EMAIL_RETRIES,
+            )
+    return _email_transports[kind]
+
+
 def send_email(
     to=None,
     subject=None,
@@ -123,12 +306,10 @@ def send_email(
 ):
     g.log = g.log.new(to=to, sender=sender)
 
-    if None in [to, subject, text, sender]:
+    if None in [to, subject, text, sender] or to == []:
         raise ValueError("to, subject text and sender required to send email")
 
     data = {
-        "api_user": settings.SENDGRID_USERNAME,
-        "api_key": settings.SENDGRID_PASSWORD,
         "to": to,
         "subject": subject,
         "text": text,
@@ -158,19 +339,21 @@ def send_email(
         valid_emails = [email for email in cc if is_valid_email(email)]
         data.update({"cc": valid_emails})
 
-    result = requests.post("https://api.sendgrid.com/api/mail.send.json", data=data)
+    if isinstance(to, list):
+        # a single request for all the recipients, each still gets their own
+        # copy of the email.
+        data.update({"to": to[0], "x-smtpapi": json.dumps({"to": to})})
 
-    errmsg = ""
-    if result.status_code / 100 != 2:
-        try:
-            errmsg = "; \n".join(result.json().get("errors"))
-        except ValueError:
-            errmsg = result.text
-        g.log.warning("Could not send email.", err=errmsg)
+    start = time.time()
+    ok, errmsg, status_code = get_email_transport().send(data)
+    observe_latency("email", time.time() - start, "ok" if ok else "error")
+
+    if not ok:
+        g.log.warning("Could not send email.", err=errmsg, code=status_code)
     else:
         g.log.info("Sent email.", to=to)
 
-    return result.status_code / 100 == 2, errmsg, result.status_code
+    return ok, errmsg, status_code
 
 
 def referrer_to_path(r):
@@ -202,24 +385,92 @@ def prevent_xsrf(func):
     return decorated_view
 
 
+class RecaptchaVerifier(object):
+    """
+    Verifies reCAPTCHA tokens with Google, reusing keep-alive connections
+    from a pool shared by the whole process.
+    """
+
+    def __init__(self, secret, timeout, pool_size):
+        self.secret = secret
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size),
+        )
+
+    def verify(self, token, remote_ip):
+        r = self.session.post(
+            CAPTCHA_URL,
+            data={"secret": self.secret, "response": token, "remoteip": remote_ip},
+            timeout=self.timeout,
+        )
+        return bool(r.ok and r.json().get("success"))
+
+
+class LocalRecaptchaVerifier(object):
+    """
+    Stand-in for tests and benchmarks: accepts any token except "invalid",
+    optionally after pretending to wait for the network.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+
+    def verify(self, token, remote_ip):
+        if self.latency:
+            time.sleep(self.latency)
+        return token != "invalid"
+
+
+_captcha_verifiers = {}
+
+
+def get_captcha_verifier():
+    kind = settings.RECAPTCHA_VERIFIER
+    if kind not in _captcha_verifiers:
+        if kind == "local":
+            _captcha_verifiers[kind] = LocalRecaptchaVerifier()
+        else:
+            _captcha_verifiers[kind] = RecaptchaVerifier(
+                settings.RECAPTCHA_SECRET,
+                settings.RECAPTCHA_TIMEOUT,
+                settings.RECAPTCHA_POOL_SIZE,
+            )
+    return _captcha_verifiers[kind]
+
+
 def verify_captcha(form_data, remote_ip):
     if not CAPTCHA_VAL in form_data:
         return False
 
+    token = form_data[CAPTCHA_VAL]
+
+    # tokens google rejected are remembered, so replaying them doesn't cost
+    # a request. valid ones are not: google only accepts a token once, and
+    # answering from here would let it be replayed for as long as it's kept.
+    key = REDIS_CAPTCHA_KEY(digest=hashlib.sha256(token.encode("utf-8")).hexdigest())
+    if redis_store.get(key) is not None:
+        incr_stat("captcha_cache_hit")
+        return False
+
+    start = time.time()
     try:
-        r = requests.post(
-            CAPTCHA_URL,
-            data={
-                "secret": settings.RECAPTCHA_SECRET,
-                "response": form_data[CAPTCHA_VAL],
-                "remoteip": remote_ip,
-            },
-            timeout=2,
-        )
-        return r.ok and r.json().get("success")
-    except requests.exceptions.ConnectionError:
-        # when google or us are failing, assume everything is ok so the user don't get sad
-        return True
+        ok = get_captcha_verifier().verify(token, remote_ip)
+    except requests.exceptions.Timeout:
+        observe_latency("captcha", time.time() - start, "timeout")
+        return settings.RECAPTCHA_FAIL_OPEN
+    except (requests.exceptions.ConnectionError, ValueError):
+        # when google or us are failing, by default assume everything is ok
+        # so the user don't get sad
+        observe_latency("captcha", time.time() - start, "error")
+        return settings.RECAPTCHA_FAIL_OPEN
+
+    observe_latency("captcha", time.time() - start, "ok" if ok else "rejected")
+    if not ok:
+        redis_store.set(key, "0", ex=settings.RECAPTCHA_CACHE_TTL)
+    return ok
 
 
 def requires_feature(*args, **kwargs):
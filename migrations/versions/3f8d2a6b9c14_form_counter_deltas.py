@@ -0,0 +1,40 @@
+"""form counter deltas
+
+Revision ID: 3f8d2a6b9c14
+Revises: 7e2b4c91d0a8
+Create Date: 2026-10-18 12:21:47.550913
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "3f8d2a6b9c14"
+down_revision = "7e2b4c91d0a8"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        "form_counter_deltas",
+        sa.Column("id", sa.BigInteger(), nullable=False),
+        sa.Column("form_id", sa.Integer(), nullable=False),
+        sa.Column("delta", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["form_id"], ["forms.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_form_counter_deltas_form_id", "form_counter_deltas", ["form_id"]
+    )
+
+
+def downgrade():
+    # fold what is pending before dropping it
+    op.execute(
+        "UPDATE forms SET counter = coalesce(forms.counter, 0) + sums.delta "
+        "FROM (SELECT form_id, sum(delta) AS delta FROM form_counter_deltas "
+        "      GROUP BY form_id) sums "
+        "WHERE forms.id = sums.form_id"
+    )
+    op.drop_index("ix_form_counter_deltas_form_id", table_name="form_counter_deltas")
+    op.drop_table("form_counter_deltas")
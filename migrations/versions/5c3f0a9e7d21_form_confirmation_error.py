@@ -0,0 +1,22 @@
+"""record confirmation delivery errors on forms
+
+Revision ID: 5c3f0a9e7d21
+Revises: 01a6f93d3537
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "5c3f0a9e7d21"
+down_revision = "01a6f93d3537"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column("forms", sa.Column("confirmation_error", sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("forms", "confirmation_error")
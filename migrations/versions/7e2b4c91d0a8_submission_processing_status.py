@@ -0,0 +1,32 @@
+"""add 'processing' to submission statuses
+
+Revision ID: 7e2b4c91d0a8
+Revises: 5c3f0a9e7d21
+Create Date: 2026-10-18 11:40:02.118734
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "7e2b4c91d0a8"
+down_revision = "5c3f0a9e7d21"
+
+from alembic import op
+
+
+def upgrade():
+    # ALTER TYPE ... ADD VALUE can't run inside a transaction block
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE submission_status ADD VALUE 'processing'")
+
+
+def downgrade():
+    op.execute("UPDATE submissions SET status = 'pending' WHERE status = 'processing'")
+    op.execute("ALTER TYPE submission_status RENAME TO submission_status_old")
+    op.execute("CREATE TYPE submission_status AS ENUM ('processed', 'pending')")
+    op.execute("ALTER TABLE submissions ALTER COLUMN status DROP DEFAULT")
+    op.execute(
+        "ALTER TABLE submissions ALTER COLUMN status TYPE submission_status "
+        "USING status::text::submission_status"
+    )
+    op.execute("ALTER TABLE submissions ALTER COLUMN status SET DEFAULT 'pending'")
+    op.execute("DROP TYPE submission_status_old")
@@ -0,0 +1,27 @@
+"""index submissions by form and id
+
+Revision ID: 9a1c5e3f7b20
+Revises: 3f8d2a6b9c14
+Create Date: 2026-10-18 13:05:12.873301
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "9a1c5e3f7b20"
+down_revision = "3f8d2a6b9c14"
+
+from alembic import op
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_submissions_form_id_id",
+            "submissions",
+            ["form_id", "id"],
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    op.drop_index("ix_submissions_form_id_id", table_name="submissions")
@@ -0,0 +1,33 @@
+"""store the ingest stream id of submissions
+
+Revision ID: a7d3e9c1b548
+Revises: f2c6a8e4b157
+Create Date: 2026-10-18 19:05:21.318467
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "a7d3e9c1b548"
+down_revision = "f2c6a8e4b157"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        "submissions", sa.Column("ingest_id", sa.String(length=64), nullable=True)
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "submissions_ingest_id_key",
+            "submissions",
+            ["ingest_id"],
+            unique=True,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    op.drop_index("submissions_ingest_id_key", table_name="submissions")
+    op.drop_column("submissions", "ingest_id")
@@ -0,0 +1,25 @@
+"""version of the routing rules of each form
+
+Revision ID: b3e7d1f4a962
+Revises: 9a1c5e3f7b20
+Create Date: 2026-10-18 13:48:20.016472
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "b3e7d1f4a962"
+down_revision = "9a1c5e3f7b20"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        "forms",
+        sa.Column("rules_version", sa.Integer(), nullable=False, server_default="0"),
+    )
+
+
+def downgrade():
+    op.drop_column("forms", "rules_version")
@@ -0,0 +1,33 @@
+"""count submission attempts, index submissions by status and date
+
+Revision ID: c4f2a8e6d153
+Revises: b3e7d1f4a962
+Create Date: 2026-10-18 14:32:05.694180
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "c4f2a8e6d153"
+down_revision = "b3e7d1f4a962"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        "submissions",
+        sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_submissions_status_submitted_at",
+            "submissions",
+            ["status", "submitted_at"],
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    op.drop_index("ix_submissions_status_submitted_at", table_name="submissions")
+    op.drop_column("submissions", "attempts")
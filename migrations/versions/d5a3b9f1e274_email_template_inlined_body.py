@@ -0,0 +1,24 @@
+"""keep email templates with their css inlined
+
+Revision ID: d5a3b9f1e274
+Revises: c4f2a8e6d153
+Create Date: 2026-10-18 15:10:44.208516
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "d5a3b9f1e274"
+down_revision = "c4f2a8e6d153"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # existing templates are inlined on every email until they are saved again,
+    # or `flask inline_templates` runs
+    op.add_column("email_templates", sa.Column("inlined_body", sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("email_templates", "inlined_body")
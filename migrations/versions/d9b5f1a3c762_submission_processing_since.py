@@ -0,0 +1,24 @@
+"""record when submissions were claimed for delivery
+
+Revision ID: d9b5f1a3c762
+Revises: a7d3e9c1b548
+Create Date: 2026-10-18 20:41:09.527113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "d9b5f1a3c762"
+down_revision = "a7d3e9c1b548"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        "submissions", sa.Column("processing_since", sa.DateTime(), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column("submissions", "processing_since")
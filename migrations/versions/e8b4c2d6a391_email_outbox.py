@@ -0,0 +1,48 @@
+"""email outbox
+
+Revision ID: e8b4c2d6a391
+Revises: d5a3b9f1e274
+Create Date: 2026-10-18 16:05:12.318842
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "e8b4c2d6a391"
+down_revision = "d5a3b9f1e274"
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table(
+        "email_outbox",
+        sa.Column("id", sa.BigInteger(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("kind", sa.String(length=32), nullable=False),
+        sa.Column("message", postgresql.JSON(), nullable=False),
+        sa.Column("submission_id", sa.Integer(), nullable=True),
+        sa.Column("recipients", postgresql.JSON(), nullable=True),
+        sa.Column(
+            "status",
+            sa.Enum("pending", "sending", "sent", "failed", name="outbox_status"),
+            nullable=False,
+        ),
+        sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("next_attempt_at", sa.DateTime(), nullable=False),
+        sa.Column("sent_at", sa.DateTime(), nullable=True),
+        sa.Column("last_error", sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_email_outbox_status_next_attempt_at",
+        "email_outbox",
+        ["status", "next_attempt_at"],
+    )
+
+
+def downgrade():
+    op.drop_index("ix_email_outbox_status_next_attempt_at", table_name="email_outbox")
+    op.drop_table("email_outbox")
+    op.execute("DROP TYPE outbox_status")
@@ -0,0 +1,22 @@
+"""form digest interval
+
+Revision ID: f2c6a8e4b157
+Revises: e8b4c2d6a391
+Create Date: 2026-10-18 17:12:40.902216
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "f2c6a8e4b157"
+down_revision = "e8b4c2d6a391"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column("forms", sa.Column("digest_interval", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("forms", "digest_interval")
@@ -11,6 +11,7 @@ from pyppeteer import launch
 from formspree import settings
 from formspree.create_app import create_app
 from formspree.app_globals import DB, redis_store, celery
+from formspree.forms import helpers as form_helpers
 from urllib.parse import urlparse
 
 
@@ -22,12 +23,11 @@ def msend():
             msend(*args, **kwargs)
             return DEFAULT
 
+        # the outbox sends through formspree.utils.send_email itself
         with patch("formspree.users.models.send_email", side_effect=side_effect), patch(
             "formspree.users.views.send_email", side_effect=side_effect
         ), patch("formspree.users.helpers.send_email", side_effect=side_effect), patch(
             "formspree.forms.models.send_email", side_effect=side_effect
-        ), patch(
-            "formspree.forms.views.send_email", side_effect=side_effect
         ):
             yield msend
 
@@ -43,13 +43,15 @@ def setup_settings():
     settings.OVERLIMIT_NOTIFICATION_QUANTITY = 2
     settings.ARCHIVED_SUBMISSIONS_LIMIT = 4
     settings.FORM_LIMIT_DECREASE_ACTIVATION_SEQUENCE = 0
-    settings.EXPENSIVELY_WIPE_SUBMISSIONS_FREQUENCY = 1
+    settings.DUPLICATE_SUBMISSION_WINDOW = 0
     settings.PRESERVE_CONTEXT_ON_EXCEPTION = False
     settings.STRIPE_PUBLISHABLE_KEY = settings.STRIPE_TEST_PUBLISHABLE_KEY
     settings.STRIPE_SECRET_KEY = settings.STRIPE_TEST_SECRET_KEY
     settings.PRESERVE_CONTEXT_ON_EXCEPTION = False
     settings.SERVICE_URL = "http://localhost:5000"
     settings.SERVER_NAME = urlparse(settings.SERVICE_URL).netloc
+    settings.RECAPTCHA_VERIFIER = "local"
+    settings.EMAIL_RETRY_BACKOFF = 0
     settings.TESTING = True
 
 
@@ -70,6 +72,8 @@ def client(setup_settings):
         DB.drop_all()
 
     redis_store.flushdb()
+    # form ids are reused by the next test
+    form_helpers._rate_limited_until.clear()
 
 
 @pytest.fixture()
@@ -1,6 +1,9 @@
 import re
 import random
 import string
+from contextlib import contextmanager
+
+from sqlalchemy import event
 
 from formspree.app_globals import DB
 from formspree.users.models import User, Plan
@@ -44,3 +47,18 @@ def create_and_activate_form(client, email, host):
     DB.session.add(form)
     DB.session.commit()
     return form
+
+
+@contextmanager
+def count_queries():
+    # collects the SQL statements executed inside the block
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(DB.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(DB.engine, "before_cursor_execute", before_cursor_execute)
@@ -1,5 +1,10 @@
 from formspree import settings
-from formspree.app_globals import DB
+from formspree.app_globals import DB, redis_store
+from formspree.forms.helpers import (
+    REDIS_STORED_SUBMISSIONS_KEY,
+    get_stored_submissions,
+    change_stored_submissions,
+)
 from formspree.forms.models import Form, Submission
 
 from .helpers import create_and_activate_form
@@ -211,3 +216,61 @@ def test_grandfather_limit_and_decrease(client, msend):
     assert "limit" in msend.call_args_list[-2][1]["text"]
     assert "new@example.com" == msend.call_args_list[-1][1]["to"]
     assert "limit" in msend.call_args_list[-1][1]["text"]
+
+
+def test_stored_submissions_are_counted_as_they_change(client, msend):
+    form = Form("bob@example.com", host="example.com", confirmed=True)
+    DB.session.add(form)
+    DB.session.commit()
+    key = REDIS_STORED_SUBMISSIONS_KEY(form_id=form.id)
+
+    def post(n):
+        r = client.post(
+            "/bob@example.com",
+            headers={"referer": "http://example.com"},
+            data={"n": n},
+        )
+        assert r.status_code == 302
+
+    # counted from the database the first time
+    DB.session.add(Submission(form.id))
+    DB.session.commit()
+    assert redis_store.get(key) is None
+    post(1)
+    assert int(redis_store.get(key)) == 2
+
+    # then kept up to date without counting
+    post(2)
+    DB.session.add(Submission(form.id))
+    DB.session.commit()
+    assert int(redis_store.get(key)) == 4
+    DB.session.delete(form.submissions.first())
+    DB.session.commit()
+    assert int(redis_store.get(key)) == 3
+
+    # trimming deletes exactly the overflow, oldest first
+    post(3)
+    post(4)
+    post(5)
+    assert int(redis_store.get(key)) == settings.ARCHIVED_SUBMISSIONS_LIMIT
+    assert form.submissions.count() == settings.ARCHIVED_SUBMISSIONS_LIMIT
+    assert [s.data["n"] for s in form.submissions] == ["5", "4", "3", "2"]
+
+    # rolled back changes are not counted
+    DB.session.add(Submission(form.id))
+    DB.session.flush()
+    DB.session.rollback()
+    assert int(redis_store.get(key)) == settings.ARCHIVED_SUBMISSIONS_LIMIT
+
+    # a count that may have missed a change committed while counting isn't
+    # kept, the next one is
+    redis_store.delete(key)
+
+    def count():
+        change_stored_submissions({form.id: 1})
+        return 4
+
+    assert get_stored_submissions(form.id, count) == 4
+    assert redis_store.get(key) is None
+    assert get_stored_submissions(form.id, lambda: 5) == 5
+    assert int(redis_store.get(key)) == 5
@@ -0,0 +1,100 @@
+import json
+import time
+from unittest.mock import patch
+
+from formspree import settings
+from formspree.forms.models import Form
+
+from .helpers import create_user_and_form
+
+
+def test_digests(client, msend):
+    from formspree.forms.models import send_due_digests
+
+    user, form = create_user_and_form(client)
+
+    def set_interval(interval):
+        return client.patch(
+            "/api-int/forms/" + form.hashid,
+            headers={"Referer": settings.SERVICE_URL},
+            content_type="application/json",
+            data=json.dumps({"digest_interval": interval}),
+        )
+
+    assert set_interval(7).status_code == 400
+    assert set_interval(60).status_code == 200
+    assert Form.query.get(form.id).serialize()["digest_interval"] == 60
+
+    msend.reset_mock()
+    for name in ["alice", "bob", "carol"]:
+        r = client.post(
+            "/" + form.hashid,
+            headers={"Referer": "http://example.com"},
+            data={"name": name},
+        )
+        assert r.status_code == 302
+    assert not msend.called
+    assert form.submissions.count() == 3
+
+    # one email for all of them, once the interval is over
+    assert send_due_digests() == 0
+    assert send_due_digests(time.time() + 3601) == 1
+    assert msend.call_count == 1
+    assert msend.call_args[1]["to"] == form.email
+    assert msend.call_args[1]["subject"] == "3 new submissions from example.com"
+    assert all(name in msend.call_args[1]["text"] for name in ["alice", "bob", "carol"])
+    assert send_due_digests(time.time() + 7200) == 0
+
+    # without digests they're sent as they come again
+    assert set_interval(None).status_code == 200
+    r = client.post(
+        "/" + form.hashid,
+        headers={"Referer": "http://example.com"},
+        data={"name": "dave"},
+    )
+    assert r.status_code == 302
+    assert msend.call_count == 2
+    assert "dave" in msend.call_args[1]["text"]
+
+
+def test_digests_are_kept_until_queued(client, msend):
+    from formspree.forms.models import send_due_digests
+
+    user, form = create_user_and_form(client)
+    r = client.patch(
+        "/api-int/forms/" + form.hashid,
+        headers={"Referer": settings.SERVICE_URL},
+        content_type="application/json",
+        data=json.dumps({"digest_interval": 60}),
+    )
+    assert r.status_code == 200
+
+    def post(name):
+        r = client.post(
+            "/" + form.hashid,
+            headers={"Referer": "http://example.com"},
+            data={"name": name},
+        )
+        assert r.status_code == 302
+
+    post("alice")
+    due = time.time() + 3601
+    with patch("formspree.forms.models.queue_email", side_effect=ValueError):
+        assert send_due_digests(due) == 0
+    assert not msend.called
+
+    # tried again once the claim is over, with no new submission
+    assert send_due_digests(due) == 0
+    assert send_due_digests(due + settings.DIGEST_RETRY_DELAY) == 1
+    assert msend.call_args[1]["subject"] == "1 new submission from example.com"
+    assert send_due_digests(due + 7200) == 0
+
+    # what comes while one is claimed goes out with it
+    post("bob")
+    post("carol")
+    due += 7200
+    with patch("formspree.forms.models.queue_email", side_effect=ValueError):
+        assert send_due_digests(due) == 0
+    post("dave")
+    assert send_due_digests(due + settings.DIGEST_RETRY_DELAY) == 1
+    assert msend.call_args[1]["subject"] == "3 new submissions from example.com"
@@ -1,4 +1,5 @@
 import json
+from unittest.mock import patch
 
 from formspree import settings
 from formspree.app_globals import DB
@@ -178,3 +179,61 @@ def test_user_gets_previous_forms_assigned_to_him(client, msend):
     assert 3 == len(forms)
     assert forms[0]["email"] == "márkö@example.com"
     assert forms[0]["host"] == "elsewhere.com"
+
+
+def test_confirmation_delivery_failures_are_recorded(client, msend):
+    with patch(
+        "formspree.forms.models.send_email",
+        return_value=(False, "mailbox unavailable", 550),
+    ):
+        r = client.post(
+            "/bounce@example.com",
+            headers={"Referer": "http://example.com"},
+            data={"name": "alice"},
+        )
+        assert r.status_code == 200
+
+    form = Form.query.filter_by(email="bounce@example.com").first()
+    assert not form.confirm_sent
+    assert form.confirmation_error == "mailbox unavailable"
+
+    # the next submission tries again
+    r = client.post(
+        "/bounce@example.com",
+        headers={"Referer": "http://example.com"},
+        data={"name": "alice"},
+    )
+    form = Form.query.filter_by(email="bounce@example.com").first()
+    assert form.confirm_sent
+    assert form.confirmation_error is None
+    assert msend.call_count == 1
+
+    # and further submissions don't send it again
+    r = client.post(
+        "/bounce@example.com",
+        headers={"Referer": "http://example.com"},
+        data={"name": "alice"},
+    )
+    assert msend.call_count == 1
+
+
+def test_confirmation_errors_release_the_claim(client, msend):
+    with patch("formspree.forms.models.send_email", side_effect=ValueError("boom")):
+        r = client.post(
+            "/crash@example.com",
+            headers={"Referer": "http://example.com"},
+            data={"name": "alice"},
+        )
+        assert r.status_code == 200
+
+    form = Form.query.filter_by(email="crash@example.com").first()
+    assert not form.confirm_sent
+    assert form.confirmation_error == "Delivery failed (500)."
+
+    r = client.post(
+        "/crash@example.com",
+        headers={"Referer": "http://example.com"},
+        data={"name": "alice"},
+    )
+    assert Form.query.filter_by(email="crash@example.com").first().confirm_sent
+    assert msend.call_count == 1
@@ -0,0 +1,126 @@
+import json
+
+from formspree import settings
+from formspree.app_globals import DB, redis_store
+from formspree.users.models import Plan, Email
+from formspree.stats import get_stats
+from formspree.forms.helpers import (
+    HASHIDS_CODEC,
+    REDIS_FEATURES_KEY,
+    REDIS_FEATURES_USER_KEY,
+    REDIS_FORM_HASHID_KEY,
+    REDIS_FORM_HOST_KEY,
+)
+from formspree.forms.models import Form, FormSnapshot
+
+from .helpers import create_user_and_form, create_and_activate_form
+
+
+def test_features_cache_follows_plans_and_emails(client, msend):
+    user, form = create_user_and_form(client)
+
+    assert form.has_feature("dashboard")
+    assert not form.has_feature("whitelabel")
+    assert redis_store.get(REDIS_FEATURES_KEY(form_id=form.id)) is not None
+
+    # upgrading the owner drops the cached features
+    user.plan = Plan.platinum
+    DB.session.add(user)
+    DB.session.commit()
+    assert redis_store.get(REDIS_FEATURES_KEY(form_id=form.id)) is None
+    assert form.has_feature("whitelabel")
+
+    # a form created spontaneously is controlled by nobody
+    other = Form("someone@example.com", host="example.com", confirmed=True)
+    DB.session.add(other)
+    DB.session.commit()
+    assert not other.has_feature("dashboard")
+    assert not other.controlled_by(user)
+
+    # until its address is linked to an account
+    DB.session.add(
+        Email(address="someone@example.com", owner_id=user.id, verified=True)
+    )
+    DB.session.commit()
+    other = Form.query.get(other.id)
+    assert other.has_feature("whitelabel")
+    assert other.controlled_by(user)
+
+    # and stops being when the address is removed
+    DB.session.delete(Email.query.get(["someone@example.com", user.id]))
+    DB.session.commit()
+    assert not Form.query.get(other.id).controlled_by(user)
+
+
+def test_form_lookups_are_cached_until_the_form_changes(client, msend):
+    user, form = create_user_and_form(client)
+    key = REDIS_FORM_HASHID_KEY(hashid=form.hashid)
+
+    r = client.post(
+        "/" + form.hashid,
+        headers={"Referer": "http://site.com"},
+        data={"name": "alice"},
+    )
+    assert r.status_code == 302
+    assert redis_store.get(key) is not None
+    assert isinstance(Form.get_cached(hashid=form.hashid), FormSnapshot)
+
+    # the snapshot carries the features, so it goes with the owner's plan
+    # even when the index kept with the features cache has expired already
+    redis_store.delete(key, REDIS_FEATURES_USER_KEY(user_id=user.id))
+    assert not Form.get_cached(hashid=form.hashid).has_feature("whitelabel")
+    user.plan = Plan.platinum
+    DB.session.add(user)
+    DB.session.commit()
+    assert redis_store.get(key) is None
+    assert Form.get_cached(hashid=form.hashid).has_feature("whitelabel")
+
+    # disabling the form drops the snapshot
+    client.patch(
+        "/api-int/forms/" + form.hashid,
+        headers={"Referer": settings.SERVICE_URL},
+        content_type="application/json",
+        data=json.dumps({"disabled": True}),
+    )
+    assert redis_store.get(key) is None
+    r = client.post(
+        "/" + form.hashid,
+        headers={"Referer": "http://site.com"},
+        data={"name": "bob"},
+    )
+    assert r.status_code != 302
+    assert form.submissions.count() == 1
+
+    # email+host lookups are dropped when another form with that email
+    # could take over the lookup
+    first = create_and_activate_form(client, "bob@example.com", "www.example.com")
+    assert Form.get_cached(email="bob@example.com", host="example.com").id == first.id
+    host_key = REDIS_FORM_HOST_KEY(email="bob@example.com", host="example.com")
+    assert redis_store.get(host_key) is not None
+    second = create_and_activate_form(client, "bob@example.com", "example.com")
+    assert redis_store.get(host_key) is None
+    assert Form.get_cached(email="bob@example.com", host="example.com").id == second.id
+
+
+def test_unknown_hashids_are_rejected_from_cache(client, msend):
+    hashid = HASHIDS_CODEC.encode(99999)
+
+    for _ in range(3):
+        r = client.post(
+            "/" + hashid,
+            headers={"Referer": "http://site.com"},
+            data={"name": "spam"},
+        )
+        assert r.status_code == 400
+    assert redis_store.get(REDIS_FORM_HASHID_KEY(hashid=hashid)) is not None
+
+    r = client.post(
+        "/notahashid", headers={"Referer": "http://site.com"}, data={"name": "spam"}
+    )
+    assert r.status_code == 400
+
+    stats = get_stats()
+    assert stats["form_lookup_miss"] == 1
+    assert stats["form_lookup_negative_hit"] == 2
+    assert stats["form_lookup_invalid_hashid"] == 1
+    assert stats["submission_rejected_bad_hashid"] == 4
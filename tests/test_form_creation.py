@@ -1,4 +1,5 @@
 import json
+import threading
 
 from formspree import settings
 from formspree.app_globals import DB
@@ -266,3 +267,32 @@ def test_form_settings(client, msend):
         data=json.dumps({"captcha_disabled": False}),
     )
     assert not Form.query.first().captcha_disabled
+
+
+def test_concurrent_first_submissions_create_one_form(client, msend):
+    app = client.application
+    barrier = threading.Barrier(5)
+    statuses = []
+
+    def submit(name):
+        with app.app_context():
+            barrier.wait()
+            r = app.test_client().post(
+                "/racing@example.com",
+                headers={"Referer": "http://example.com/race"},
+                data={"name": name},
+            )
+            statuses.append(r.status_code)
+            DB.session.remove()
+
+    threads = [threading.Thread(target=submit, args=(str(i),)) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert statuses == [200] * 5
+    assert Form.query.filter_by(email="racing@example.com").count() == 1
+    form = Form.query.filter_by(email="racing@example.com").first()
+    assert form.hash == HASH("racing@example.com", "example.com/race")
+    assert form.host == "example.com/race"
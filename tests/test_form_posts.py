@@ -1,9 +1,13 @@
 import json
+import datetime
 from functools import partial
+from unittest.mock import patch
+
+import pytest
 
 from formspree import settings
 from formspree.app_globals import DB
-from formspree.forms.models import Form
+from formspree.forms.models import Form, FormCounterDelta, Submission
 from formspree.users.models import User, Email, Plan
 
 from .helpers import create_user_and_form
@@ -49,6 +53,346 @@ def test_submit_form(client, msend):
     assert "plain" not in msend.call_args[1]["text"]
 
 
+def test_tampered_host_nonces_fall_back_to_the_referrer(client, msend):
+    form = Form("alice@testwebsite.com", host="testwebsite.com", confirmed=True)
+    DB.session.add(form)
+    DB.session.commit()
+
+    r = client.post(
+        "/alice@testwebsite.com",
+        headers=http_headers,
+        data={"name": "alice", "_host_nonce": "not.signed.by.us"},
+    )
+    assert r.status_code == 302
+    assert form.submissions.count() == 1
+
+
+def test_submit_form_through_ingest_stream(client, msend):
+    form = Form("alice@testwebsite.com", host="testwebsite.com", confirmed=True)
+    DB.session.add(form)
+    DB.session.commit()
+
+    settings.SUBMISSION_INGEST = "stream"
+    try:
+        for name in ["alice", "bob", "carol"]:
+            r = client.post(
+                "/alice@testwebsite.com", headers=http_headers, data={"name": name}
+            )
+            assert r.status_code == 302
+    finally:
+        settings.SUBMISSION_INGEST = "direct"
+
+    submissions = form.submissions.order_by(None).order_by(Submission.id).all()
+    assert [s.data["name"] for s in submissions] == ["alice", "bob", "carol"]
+    assert all(s.status == "processed" for s in submissions)
+    assert msend.call_count == 3
+    assert "carol" in msend.call_args[1]["text"]
+
+
+def test_bad_entries_dont_hold_up_the_ingest_stream(client, msend):
+    from formspree.app_globals import redis_store
+    from formspree.forms.helpers import (
+        stream_submission,
+        read_streamed_submissions,
+        REDIS_INGEST_DEAD_LETTER_KEY,
+    )
+    from formspree.forms.models import (
+        flush_submission_stream,
+        insert_streamed_submissions,
+    )
+
+    client.get("/")  # sets up g.log
+    form = Form("alice@testwebsite.com", host="testwebsite.com", confirmed=True)
+    DB.session.add(form)
+    DB.session.commit()
+
+    for form_id, name in [(form.id, "alice"), (form.id + 1, "bob"), (form.id, "carol")]:
+        stream_submission(
+            {
+                "form_id": form_id,
+                "submitted_at": 0,
+                "data": {"name": name},
+                "host": "testwebsite.com",
+                "keys": ["name"],
+            }
+        )
+    entries = read_streamed_submissions(10)
+    flush_submission_stream()
+
+    submissions = form.submissions.order_by(None).order_by(Submission.id).all()
+    assert [s.data["name"] for s in submissions] == ["alice", "carol"]
+    assert all(s.status == "processed" for s in submissions)
+    assert read_streamed_submissions(10) == []
+    dead = redis_store.lrange(REDIS_INGEST_DEAD_LETTER_KEY, 0, -1)
+    assert [json.loads(e)["entry"]["data"]["name"] for e in dead] == ["bob"]
+
+    # reading the same entries again doesn't insert them twice
+    assert insert_streamed_submissions([entries[0]]) == {}
+
+
+def test_submissions_processed_in_batches(client, msend):
+    form = Form("alice@testwebsite.com", host="testwebsite.com", confirmed=True)
+    DB.session.add(form)
+    DB.session.commit()
+
+    settings.SUBMISSION_PROCESSING = "batch"
+    try:
+        for name in ["alice", "bob"]:
+            r = client.post(
+                "/alice@testwebsite.com",
+                headers=http_headers,
+                data={"name": name, "_subject": "hi"},
+            )
+            assert r.status_code == 302
+    finally:
+        settings.SUBMISSION_PROCESSING = "task"
+
+    submissions = form.submissions.order_by(None).order_by(Submission.id).all()
+    assert [s.status for s in submissions] == ["processed", "processed"]
+    # and the notice that the form is approaching its monthly limit
+    assert msend.call_count == 3
+    assert msend.call_args[1]["subject"] == "hi"
+    assert "bob" in msend.call_args[1]["text"]
+    assert Form.query.get(form.id).counter == 2
+
+
+def test_database_errors_only_fail_their_own_submission(client, msend):
+    form = Form("alice@testwebsite.com", host="testwebsite.com", confirmed=True)
+    DB.session.add(form)
+    DB.session.commit()
+
+    prepare = Submission.prepare
+
+    def failing_prepare(sub, keys):
+        if sub.data["name"] == "bob":
+            DB.session.execute("SELECT 1/0")
+        return prepare(sub, keys)
+
+    settings.SUBMISSION_PROCESSING = "batch"
+    try:
+        with patch.object(Submission, "prepare", failing_prepare):
+            for name in ["bob", "carol"]:
+                r = client.post(
+                    "/alice@testwebsite.com", headers=http_headers, data={"name": name}
+                )
+                assert r.status_code == 302
+    finally:
+        settings.SUBMISSION_PROCESSING = "task"
+
+    bob, carol = form.submissions.order_by(None).order_by(Submission.id).all()
+    assert bob.status == "processed"
+    assert "Unexpected Error" in bob.errors[0]["message"]
+    assert carol.status == "processed"
+    assert not carol.errors
+    assert "carol" in msend.call_args[1]["text"]
+
+
+def test_delivery_errors_only_fail_their_own_submission(client, msend):
+    from formspree.forms.models import process_submission_batch
+
+    form = Form("alice@testwebsite.com", host="testwebsite.com", confirmed=True)
+    DB.session.add(form)
+    DB.session.commit()
+
+    settings.SUBMISSION_PROCESSING = "batch"
+    try:
+        # both are left pending, to be processed in the same batch
+        with patch("formspree.forms.models.process_pending_submissions.apply_async"):
+            for name in ["bob", "carol"]:
+                r = client.post(
+                    "/alice@testwebsite.com", headers=http_headers, data={"name": name}
+                )
+                assert r.status_code == 302
+    finally:
+        settings.SUBMISSION_PROCESSING = "task"
+
+    deliver = Submission.deliver
+
+    def failing_deliver(sub, outgoing, keys):
+        deliver(sub, outgoing, keys)
+        if sub.data["name"] == "bob":
+            raise ValueError("plugin went away")
+
+    with patch.object(Submission, "deliver", failing_deliver):
+        assert process_submission_batch(10) == 2
+
+    bob, carol = form.submissions.order_by(None).order_by(Submission.id).all()
+    assert bob.status == "processed"
+    assert "Unexpected Error" in bob.errors[0]["message"]
+    assert carol.status == "processed"
+    assert not carol.errors
+    # what bob's delivery queued was dropped, carol's was sent
+    texts = [c[1]["text"] for c in msend.call_args_list]
+    assert not any("bob" in text for text in texts)
+    assert any("carol" in text for text in texts)
+
+
+def test_counter_is_exact_before_and_after_folding(client, msend):
+    form = Form("alice@testwebsite.com", host="testwebsite.com", confirmed=True)
+    DB.session.add(form)
+    DB.session.commit()
+
+    for name in ["alice", "bob", "carol"]:
+        r = client.post(
+            "/alice@testwebsite.com", headers=http_headers, data={"name": name}
+        )
+        assert r.status_code == 302
+
+    # submissions don't touch the stored counter
+    form = Form.query.get(form.id)
+    assert form.stored_counter == 0
+    assert FormCounterDelta.query.filter_by(form_id=form.id).count() == 3
+    assert form.counter == 3
+    assert form.serialize()["counter"] == 3
+
+    from formspree.forms.models import fold_counter_deltas
+
+    fold_counter_deltas()
+    form = Form.query.get(form.id)
+    assert form.stored_counter == 3
+    assert FormCounterDelta.query.count() == 0
+    assert form.counter == 3
+
+
+def test_paid_forms_are_processed_in_their_own_queue(client, msend):
+    from formspree.forms.models import process_and_commit_submission
+
+    user, paid = create_user_and_form(client)
+    free = Form("alice@testwebsite.com", host="testwebsite.com", confirmed=True)
+    DB.session.add(free)
+    DB.session.commit()
+
+    with patch.object(process_and_commit_submission, "apply_async") as enqueue:
+        r = client.post("/" + paid.hashid, headers=http_headers, data={"a": "b"})
+        assert r.status_code == 302
+        r = client.post("/alice@testwebsite.com", headers=http_headers, data={"a": "b"})
+        assert r.status_code == 302
+
+    assert [c[1]["queue"] for c in enqueue.call_args_list] == [
+        "submissions_priority",
+        "submissions",
+    ]
+
+
+def test_failed_deliveries_are_not_left_processing(client, msend):
+    from formspree.forms.models import process_and_commit_submission
+
+    user, form = create_user_and_form(client)
+    sub = Submission(form.id)
+    sub.data = {"name": "alice"}
+    DB.session.add(sub)
+    DB.session.commit()
+    sub_id = sub.id
+
+    with patch.object(Submission, "deliver", side_effect=ValueError("boom")):
+        with pytest.raises(ValueError):
+            process_and_commit_submission(sub_id, ["name"])
+
+    sub = Submission.query.get(sub_id)
+    assert sub.status == "processed"
+    assert "Unexpected Error" in sub.errors[-1]["message"]
+    assert not msend.called
+
+
+def test_stuck_submissions_are_reaped(client, msend):
+    from formspree.forms.models import reap_stuck_submissions
+
+    form = Form("alice@testwebsite.com", host="testwebsite.com", confirmed=True)
+    DB.session.add(form)
+    DB.session.commit()
+    client.get("/")  # tasks log through g.log, set up by requests
+
+    def pending(minutes_ago, attempts=0):
+        sub = Submission(form.id)
+        sub.data = {"name": "lost"}
+        sub.submitted_at -= datetime.timedelta(minutes=minutes_ago)
+        sub.attempts = attempts
+        DB.session.add(sub)
+        return sub
+
+    lost = pending(60)
+    recent = pending(1)
+    retried = pending(15, attempts=1)  # waits twice as long after an attempt
+    last_try = pending(600, attempts=settings.MAX_SUBMISSION_ATTEMPTS - 1)
+    hopeless = pending(600, attempts=settings.MAX_SUBMISSION_ATTEMPTS)
+    # a worker died while delivering these
+    interrupted = pending(60)
+    interrupted.status = "processing"
+    interrupted.processing_since = interrupted.submitted_at
+    delivering = pending(60)
+    delivering.status = "processing"
+    delivering.processing_since = datetime.datetime.utcnow()
+    DB.session.commit()
+    ids = [lost.id, recent.id, retried.id, last_try.id, hopeless.id]
+    ids += [interrupted.id, delivering.id]
+
+    counts = reap_stuck_submissions()
+    assert counts == {"requeued": 2, "given_up": 1, "interrupted": 1}
+    assert "lost" in msend.call_args[1]["text"]
+
+    subs = {s.id: s for s in Submission.query.filter(Submission.id.in_(ids))}
+    assert subs[lost.id].status == "processed"
+    assert subs[lost.id].attempts == 1
+    assert subs[last_try.id].status == "processed"
+    assert subs[last_try.id].attempts == settings.MAX_SUBMISSION_ATTEMPTS
+    assert not subs[last_try.id].errors
+    assert subs[recent.id].status == "pending"
+    assert subs[retried.id].status == "pending"
+    assert subs[hopeless.id].status == "processed"
+    assert "Could not be processed" in subs[hopeless.id].errors[0]["message"]
+    assert subs[interrupted.id].status == "processed"
+    assert "interrupted" in subs[interrupted.id].errors[0]["message"]
+    assert subs[delivering.id].status == "processing"
+
+    counts = reap_stuck_submissions()
+    assert counts == {"requeued": 0, "given_up": 0, "interrupted": 0}
+
+
+def test_duplicate_submissions_are_suppressed(client, msend):
+    form = Form("alice@testwebsite.com", host="testwebsite.com", confirmed=True)
+    DB.session.add(form)
+    DB.session.commit()
+
+    settings.DUPLICATE_SUBMISSION_WINDOW = 10
+    try:
+        # same data twice, like a double click
+        for _ in range(2):
+            r = client.post(
+                "/alice@testwebsite.com", headers=http_headers, data={"name": "alice"}
+            )
+            assert r.status_code == 302
+        assert form.submissions.count() == 1
+
+        # different data, but the same idempotency key, like a retry
+        # that picked up an edit
+        for name in ["bob", "bobby"]:
+            r = client.post(
+                "/alice@testwebsite.com",
+                headers=dict(http_headers, **{"Idempotency-Key": "abc"}),
+                data={"name": name},
+            )
+            assert r.status_code == 302
+        assert form.submissions.count() == 2
+
+        # same key in the form data, for a different form, isn't a duplicate
+        r = client.post(
+            "/carol@testwebsite.com",
+            headers=http_headers,
+            data={"name": "carol", "_idempotency": "abc"},
+        )
+        assert form.submissions.count() == 2
+    finally:
+        settings.DUPLICATE_SUBMISSION_WINDOW = 0
+
+    # an email for each of the two submissions, the notice that the form is
+    # approaching its monthly limit and the confirmation for carol's form
+    sent = [(c[1]["to"], c[1]["subject"]) for c in msend.call_args_list]
+    assert len(sent) == 4
+    assert ("alice@testwebsite.com", Submission.SUBJECT_APPROACHING_LIMIT) in sent
+    assert [to for to, _ in sent].count("carol@testwebsite.com") == 1
+    assert not any("bobby" in c[1]["text"] for c in msend.call_args_list)
+
+
 def test_fail_form_without_header(client, msend):
     msend.reset_mock()
     no_referer = http_headers.copy()
@@ -281,6 +625,39 @@ def test_overlimit_notifications(client, msend):
     assert "limit" in msend.call_args_list[-2][1]["text"]
     assert "limit" in msend.call_args_list[-1][1]["text"]
 
+    # the ones after the notifications were stored without being processed
+    f = Form.query.first()
+    assert f.counter == 20
+    assert f.get_monthly_counter() == 20
+    assert f.submissions.count() == settings.ARCHIVED_SUBMISSIONS_LIMIT
+    for sub in f.submissions:
+        assert sub.status == "processed"
+        assert sub.errors[0]["message"] == "Over submission limit"
+
+
+def test_overlimit_submissions_can_be_dropped(client, msend):
+    form = Form("luke@testwebsite.com", host="testwebsite.com", confirmed=True)
+    DB.session.add(form)
+    DB.session.commit()
+
+    settings.OVERLIMIT_SUBMISSIONS = "drop"
+    try:
+        for i in range(0, 10):
+            r = client.post(
+                "/luke@testwebsite.com", headers=http_headers, data={"name": "leia"}
+            )
+            assert r.status_code == 302
+    finally:
+        settings.OVERLIMIT_SUBMISSIONS = "store"
+
+    # 2 normal and 2 over the limit, then nothing
+    limit = settings.MONTHLY_SUBMISSIONS_LIMIT
+    limit += settings.OVERLIMIT_NOTIFICATION_QUANTITY
+    form = Form.query.get(form.id)
+    assert form.counter == limit
+    assert form.get_monthly_counter() == limit
+    assert form.submissions.count() == limit
+
 
 def test_first_submission_is_stored(client, msend):
     r = client.post(
@@ -309,6 +686,28 @@ def test_first_submission_is_stored(client, msend):
     assert "this was important" in msend.call_args[1]["text"]
 
 
+def test_first_submission_is_kept_until_confirmation_is_sent(client, msend):
+    from formspree.forms.models import send_confirmation_email
+
+    # the confirmation email task doesn't get to run before the second post
+    with patch("formspree.forms.models.send_confirmation_email.delay"):
+        for text in ["this was important", "this came later"]:
+            client.post(
+                "/what@firstsubmissed.com", headers=http_headers, data={"text": text}
+            )
+    f = Form.query.first()
+    send_confirmation_email(f.id)
+    assert "one step away" in msend.call_args[1]["text"]
+
+    client.get("/confirm/%s" % (f.hash,))
+    assert "this was important" in msend.call_args[1]["text"]
+    assert Form.query.first().counter == 1
+
+    # confirming again doesn't submit it again
+    client.get("/confirm/%s" % (f.hash,))
+    assert Form.query.first().counter == 1
+
+
 def test_recaptcha_is_rendered(client, msend):
     def revert(testing, seq):
         settings.TESTING = testing
@@ -4,7 +4,7 @@ import urllib
 from formspree import settings
 from formspree.app_globals import DB
 from formspree.users.models import User, Plan, Email
-from formspree.forms.models import Form, Submission
+from formspree.forms.models import Form, Submission, EmailTemplate
 
 from .helpers import create_user_and_form, PASSWORD
 
@@ -308,3 +308,39 @@ def test_form_and_submission_deletion(client, msend):
 
     # reset submission limit
     settings.ARCHIVED_SUBMISSIONS_LIMIT = old_submission_limit
+
+
+def test_custom_templates_are_inlined_when_saved(client, msend):
+    user, form = create_user_and_form(client)
+    user.plan = Plan.platinum
+    DB.session.add(user)
+    DB.session.commit()
+
+    r = client.put(
+        "/api-int/forms/" + form.hashid + "/whitelabel",
+        headers={"Referer": settings.SERVICE_URL},
+        content_type="application/json",
+        data=json.dumps(
+            {
+                "subject": "{{ name }} wrote",
+                "style": "p { color: red; }",
+                "body": '<p>{{ message }}</p><a href="{{ _unsubscribe }}">bye</a>',
+            }
+        ),
+    )
+    assert r.status_code == 200
+    template = EmailTemplate.query.filter_by(form_id=form.id).first()
+    assert "color:red" in template.inlined_body.replace(" ", "")
+    assert "{{ message }}" in template.inlined_body
+    assert 'href="{{ _unsubscribe }}"' in template.inlined_body
+
+    r = client.post(
+        "/" + form.hashid,
+        headers={"Referer": "http://example.com"},
+        data={"name": "alice", "message": "hello there"},
+    )
+    assert r.status_code == 302
+    html = msend.call_args[1]["html"]
+    assert msend.call_args[1]["subject"] == "alice wrote"
+    assert "hello there" in html
+    assert "color:red" in html.replace(" ", "")
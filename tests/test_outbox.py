@@ -0,0 +1,97 @@
+import datetime
+from unittest.mock import patch
+
+from formspree import settings
+from formspree.app_globals import DB
+from formspree.outbox import OutboxEmail, queue_email, replay_outbox
+
+from .helpers import create_user_and_form
+
+
+def test_emails_are_sent_once_committed(client, msend):
+    create_user_and_form(client)
+    msend.reset_mock()
+
+    def queue():
+        queue_email(
+            "notice",
+            to="alice@example.com",
+            subject="hello",
+            text="hello",
+            sender=settings.DEFAULT_SENDER,
+        )
+
+    queue()
+    DB.session.rollback()
+    assert not msend.called
+    assert OutboxEmail.query.count() == 0
+
+    queue()
+    assert not msend.called
+    DB.session.commit()
+    assert msend.call_count == 1
+    assert msend.call_args[1]["to"] == "alice@example.com"
+
+    email = OutboxEmail.query.one()
+    assert email.status == "sent"
+    assert email.attempts == 1
+    assert email.sent_at is not None
+
+
+def test_failed_emails_are_retried_and_replayed(client, msend):
+    user, form = create_user_and_form(client)
+
+    with patch("formspree.utils.send_email", return_value=(False, "busy", 503)) as send:
+        r = client.post(
+            "/" + form.hashid,
+            headers={"Referer": "http://example.com"},
+            data={"name": "alice"},
+        )
+        assert r.status_code == 302
+    assert send.call_count == settings.OUTBOX_MAX_ATTEMPTS
+
+    email = OutboxEmail.query.filter_by(kind="submission").one()
+    assert email.status == "failed"
+    assert email.last_error == "code 503: busy"
+    sub = form.submissions.first()
+    assert [(e["rule"], e["debug"]) for e in sub.errors] == [(None, "code 503: busy")]
+
+    # once the provider is back they can be sent again
+    msend.reset_mock()
+    assert replay_outbox(email.created_at) == 1
+    assert msend.call_args[1]["to"] == form.email
+    assert OutboxEmail.query.get(email.id).status == "sent"
+
+
+def test_drain_fails_emails_out_of_attempts(client, msend):
+    from formspree.outbox import drain_outbox
+
+    client.get("/")  # tasks log through g.log, set up by requests
+    long_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+
+    def sending(to, attempts):
+        email = OutboxEmail(
+            kind="notice",
+            message={
+                "to": to,
+                "subject": "hello",
+                "text": "hello",
+                "sender": settings.DEFAULT_SENDER,
+            },
+            status="sending",
+            attempts=attempts,
+            next_attempt_at=long_ago,
+        )
+        DB.session.add(email)
+        return email
+
+    # their workers died while sending them
+    lost = sending("alice@example.com", 1)
+    last = sending("bob@example.com", settings.OUTBOX_MAX_ATTEMPTS)
+    DB.session.commit()
+
+    assert drain_outbox() == {"enqueued": 1, "failed": 1, "purged": 0}
+    assert msend.call_args[1]["to"] == "alice@example.com"
+    assert OutboxEmail.query.get(lost.id).status == "sent"
+    assert OutboxEmail.query.get(last.id).status == "failed"
+    assert "interrupted" in OutboxEmail.query.get(last.id).last_error
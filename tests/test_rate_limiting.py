@@ -1,6 +1,11 @@
+import datetime
+
 from formspree import settings
 from formspree.app_globals import DB
 from formspree.forms.models import Form
+from formspree.forms.helpers import get_rate_rejections
+
+from .helpers import create_user_and_form
 
 
 def test_rate_limiting_on_form_posts(client, msend):
@@ -34,3 +39,33 @@ def test_rate_limiting_on_form_posts(client, msend):
     # should have gotten some 302 and then many 429 responses
     assert replies.count(302) <= limit
     assert replies.count(429) >= 900 - limit
+
+
+def test_form_token_buckets_follow_plans(client, msend):
+    free = Form("bob@example.com", host="example.com", confirmed=True)
+    DB.session.add(free)
+    DB.session.commit()
+    user, gold = create_user_and_form(client)
+
+    # free forms can take a burst of 30 submissions
+    replies = []
+    for _ in range(40):
+        r = client.post(
+            "/bob@example.com",
+            headers={"referer": "http://example.com"},
+            data={"name": "attacker"},
+        )
+        replies.append(r.status_code)
+    assert 30 <= replies.count(302) <= 31
+    assert replies.count(429) == 40 - replies.count(302)
+    assert r.headers["Retry-After"]
+    assert get_rate_rejections(datetime.date.today())[free.id] >= 1
+
+    # gold forms can take more
+    for _ in range(40):
+        r = client.post(
+            "/" + gold.hashid,
+            headers={"referer": "http://example.com"},
+            data={"name": "customer"},
+        )
+        assert r.status_code == 302
@@ -1,4 +1,29 @@
-from formspree.utils import next_url
+import json
+import datetime
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+
+from formspree import settings
+from formspree.utils import (
+    next_url,
+    verify_captcha,
+    CAPTCHA_VAL,
+    SendgridTransport,
+    FileTransport,
+)
+from formspree.stats import get_stats
+from formspree.app_globals import redis_store
+from formspree.forms.helpers import (
+    temp_store_hostname,
+    get_temp_hostname,
+    increase_monthly_counter,
+    get_monthly_counter,
+    get_monthly_counters,
+    migrate_legacy_monthly_counters,
+    REDIS_COUNTER_KEY,
+)
 from formspree.users.helpers import send_downgrade_email
 
 
@@ -37,3 +62,129 @@ def test_send_downgrade_email(client, msend):
     assert msend.called
     assert msend.call_args[1]["to"] == "whatever@example.com"
     assert "Successfully downgraded from" in msend.call_args[1]["subject"]
+
+
+def test_temp_hostname_nonces(client):
+    # signed nonces don't need redis
+    nonce = temp_store_hostname("fun.io/contact", "http://fun.io/contact")
+    assert "." in nonce
+    assert get_temp_hostname(nonce) == ("fun.io/contact", "http://fun.io/contact")
+
+    nonce = temp_store_hostname(None, "http://fun.io/contact")
+    assert get_temp_hostname(nonce) == ("fun.io/contact", "http://fun.io/contact")
+
+    with pytest.raises(KeyError):
+        get_temp_hostname(nonce[:-2] + "xx")
+
+    # nonces stored on redis by the old format are still accepted once
+    settings.SIGNED_HOST_NONCE = False
+    try:
+        nonce = str(temp_store_hostname("fun.io/contact", "http://fun.io/contact"))
+    finally:
+        settings.SIGNED_HOST_NONCE = True
+    assert get_temp_hostname(nonce) == ["fun.io/contact", "http://fun.io/contact"]
+    with pytest.raises(KeyError):
+        get_temp_hostname(nonce)
+
+
+def test_verify_captcha(client):
+    assert not verify_captcha({}, "127.0.0.1")
+    assert verify_captcha({CAPTCHA_VAL: "token"}, "127.0.0.1")
+    assert not verify_captcha({CAPTCHA_VAL: "invalid"}, "127.0.0.1")
+
+    # rejected tokens are answered from the cache, valid ones are always
+    # verified again (the local verifier, unlike google, accepts them twice)
+    assert verify_captcha({CAPTCHA_VAL: "token"}, "127.0.0.1")
+    assert not verify_captcha({CAPTCHA_VAL: "invalid"}, "127.0.0.1")
+
+    stats = get_stats()
+    assert stats["captcha_ok"] == 2
+    assert stats["captcha_rejected"] == 1
+    assert stats["captcha_cache_hit"] == 1
+
+
+def test_sendgrid_transport_retries(client):
+    transport = SendgridTransport("user", "key", 1, 1, 1, retries=2)
+    data = {"to": "alice@example.com", "subject": "hi", "text": "hi"}
+
+    def response(status, body):
+        return Mock(status_code=status, ok=status < 400, json=Mock(return_value=body))
+
+    # throttling and server errors are retried
+    with patch.object(
+        transport.session,
+        "post",
+        side_effect=[
+            response(429, {}),
+            requests.exceptions.ConnectionError(),
+            response(200, {"message": "success"}),
+        ],
+    ) as post:
+        assert transport.send(data) == (True, "", 200)
+    assert post.call_count == 3
+    assert post.call_args[1]["data"]["api_user"] == "user"
+
+    # bad requests aren't, and neither are read timeouts
+    with patch.object(
+        transport.session, "post", return_value=response(400, {"errors": ["bad"]})
+    ) as post:
+        assert transport.send(data) == (False, "bad", 400)
+    assert post.call_count == 1
+    with patch.object(
+        transport.session, "post", side_effect=requests.exceptions.ReadTimeout()
+    ) as post:
+        assert not transport.send(data)[0]
+    assert post.call_count == 1
+
+    stats = get_stats()
+    assert stats["sendgrid_retry"] == 2
+    assert stats["sendgrid_ok"] == 1
+    assert stats["sendgrid_throttled"] == 1
+    assert stats["sendgrid_rejected"] == 1
+    assert stats["sendgrid_timeout"] == 1
+
+
+def test_file_transport(tmpdir):
+    path = str(tmpdir.join("emails.jsonl"))
+    transport = FileTransport(path)
+    assert transport.send({"to": "alice@example.com", "subject": "one"})[0]
+    assert transport.send({"to": "bob@example.com", "subject": "two"})[0]
+
+    with open(path) as f:
+        emails = [json.loads(line) for line in f]
+    assert [email["to"] for email in emails] == ["alice@example.com", "bob@example.com"]
+
+
+def test_monthly_counters(client):
+    now = datetime.datetime.now()
+
+    assert increase_monthly_counter(1) == 1
+    assert increase_monthly_counter(1) == 2
+    assert increase_monthly_counter(2) == 1
+    assert get_monthly_counter(1) == 2
+    assert get_monthly_counters(now.year, now.month) == {1: 2, 2: 1}
+    assert get_monthly_counters(now.year - 1, now.month) == {}
+
+    # a submission processed again isn't counted twice
+    assert increase_monthly_counter(2, submission_id=10) == 2
+    assert increase_monthly_counter(2, submission_id=10) == 2
+    assert increase_monthly_counter(2, submission_id=11) == 3
+    assert get_monthly_counter(2) == 3
+
+    # counts left in legacy keys are folded in by the first increment
+    legacy = REDIS_COUNTER_KEY(form_id=3, month=now.month)
+    redis_store.set(legacy, 7)
+    assert get_monthly_counter(3) == 7
+    assert increase_monthly_counter(3) == 8
+    assert redis_store.get(legacy) is None
+
+    # or by the migration, which tells the year from their expiration
+    last_month = (now.replace(day=1) - datetime.timedelta(days=1)).date()
+    legacy = REDIS_COUNTER_KEY(form_id=4, month=last_month.month)
+    redis_store.set(legacy, 5)
+    redis_store.expireat(
+        legacy, datetime.datetime(last_month.year + 1, last_month.month, 15)
+    )
+    assert migrate_legacy_monthly_counters() == 1
+    assert get_monthly_counters(last_month.year, last_month.month) == {4: 5}
+    assert redis_store.get(legacy) is None
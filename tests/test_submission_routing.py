@@ -1,13 +1,16 @@
 import json
+import time
+from unittest.mock import patch
 
 import pytest
 
 from formspree import settings
 from formspree.app_globals import DB
 from formspree.users.models import Plan, Email
-from formspree.forms.models import RoutingRule
+from formspree.forms.models import RoutingRule, EmailTemplate, Submission
+from formspree.plugins.models import Plugin, PluginKind
 
-from .helpers import create_user_and_form
+from .helpers import create_user_and_form, count_queries
 
 
 def test_rules_api(client, msend):
@@ -158,6 +161,108 @@ def test_rules(client, msend):
     assert msend.call_args[1]["to"] == "customerdept@example.com"
 
 
+def test_compiled_operators_follow_rule_changes(client, msend):
+    user, form = create_user_and_form(client)
+    user.plan = Plan.platinum
+    DB.session.add(user)
+    DB.session.add(Email(address="big@example.com", owner_id=user.id, verified=True))
+    DB.session.commit()
+    headers = {"Referer": settings.SERVICE_URL, "Content-Type": "application/json"}
+
+    def rule(fn, field, *params):
+        return json.dumps(
+            {
+                "trigger": {"fn": fn, "field": field, "params": list(params)},
+                "email": "big@example.com",
+            }
+        )
+
+    def routed(data):
+        msend.reset_mock()
+        r = client.post(f"/{form.hashid}", data=data)
+        assert r.status_code == 302
+        return [c[1]["to"] for c in msend.call_args_list]
+
+    rules_url = f"/api-int/forms/{form.hashid}/rules"
+    r = client.post(rules_url, data=rule("regex", "budget", "[("), headers=headers)
+    assert r.status_code == 400
+    # patterns that could take forever on a crafted submission
+    for pattern in ["(a+)+$", "x" * 201]:
+        r = client.post(
+            rules_url, data=rule("regex", "budget", pattern), headers=headers
+        )
+        assert r.status_code == 400
+    r = client.post(rules_url, data=rule("gte", "budget", "lots"), headers=headers)
+    assert r.status_code == 400
+
+    r = client.post(rules_url, data=rule("gte", "budget", "1000"), headers=headers)
+    assert r.status_code == 201
+    rule_id = json.loads(r.data.decode("utf-8"))["id"]
+    assert routed({"budget": "5000"}) == ["big@example.com"]
+    assert routed({"budget": "999.5"}) == []
+    assert routed({"budget": "unknown"}) == []
+
+    # changing the rule drops the compiled one
+    r = client.put(
+        f"{rules_url}/{rule_id}",
+        data=rule("oneof", "size", "large, huge"),
+        headers=headers,
+    )
+    assert r.status_code == 200
+    assert routed({"budget": "5000"}) == []
+    assert routed({"size": "huge"}) == ["big@example.com"]
+
+    r = client.put(
+        f"{rules_url}/{rule_id}", data=rule("regex", "size", "^x+l$"), headers=headers
+    )
+    assert r.status_code == 200
+    assert routed({"size": "xxl"}) == ["big@example.com"]
+    assert routed({"size": "huge"}) == []
+
+
+@pytest.mark.parametrize(
+    "pattern", [r"((a+))+$", r"(?:(a)+)+$", r"(a|a)+$", r"(a|ab)*c", r"(\w+\s?)+$"]
+)
+def test_regex_rules_are_given_up_on_in_time(pattern):
+    from formspree.forms.routing import regex, RegexTimeout, REGEX_TIMEOUT
+
+    start = time.time()
+    try:
+        assert not regex(pattern)("a" * 40 + "!")
+    except RegexTimeout:
+        pass
+    assert time.time() - start < REGEX_TIMEOUT * 5
+
+
+def test_slow_regex_rules_dont_match(client, msend):
+    user, form = create_user_and_form(client)
+    user.plan = Plan.platinum
+    DB.session.add(user)
+    DB.session.add(Email(address="big@example.com", owner_id=user.id, verified=True))
+    DB.session.commit()
+
+    # gets past the check for nested repetition
+    r = client.post(
+        f"/api-int/forms/{form.hashid}/rules",
+        data=json.dumps(
+            {
+                "trigger": {"fn": "regex", "field": "name", "params": ["(a|a)+$"]},
+                "email": "big@example.com",
+            }
+        ),
+        headers={"Referer": settings.SERVICE_URL, "Content-Type": "application/json"},
+    )
+    assert r.status_code == 201
+    rule_id = json.loads(r.data.decode("utf-8"))["id"]
+
+    r = client.post(f"/{form.hashid}", data={"name": "a" * 40 + "!"})
+    assert r.status_code == 302
+    assert not any(c[1]["to"] == "big@example.com" for c in msend.call_args_list)
+    sub = Submission.query.first()
+    assert sub.errors[0]["rule"] == rule_id
+    assert "too long" in sub.errors[0]["message"]
+
+
 cases = [
     (
         "mysite.com/contact",
@@ -249,6 +354,124 @@ def test_multiple_cases(client, msend, case):
     referrer, data, targets = case
     r = client.post(f"/{form.hashid}", data=data, headers={"Referer": referrer})
     assert r.status_code == 302
-    received = {call[1]["to"] for call in msend.call_args_list}
+    # everybody gets it in the same request
+    assert msend.call_count == 1
+    to = msend.call_args[1]["to"]
     targets.add(emailalways.address)
-    assert received == targets
+    assert set(to if isinstance(to, list) else [to]) == targets
+
+
+def test_processing_loads_everything_at_once(client, msend):
+    user, form = create_user_and_form(client)
+    user.plan = Plan.platinum
+    DB.session.add(user)
+
+    for address in ["one@example.com", "two@example.com"]:
+        rule = RoutingRule(form.id)
+        rule.trigger = {"fn": "true", "field": "", "params": []}
+        rule.email = address
+        DB.session.add(rule)
+    template = EmailTemplate(form.id)
+    template.subject = "new submission"
+    DB.session.add(template)
+    plugin = Plugin(form.id, PluginKind.webhook)
+    plugin.enabled = False
+    DB.session.add(plugin)
+    sub = Submission(form.id)
+    sub.data = {"name": "alice"}
+    DB.session.add(sub)
+    DB.session.commit()
+    form.features  # warm the features cache
+    sub_id = sub.id
+
+    # imported here so the task is bound once the test app is set up.
+    from formspree.forms.models import process_and_commit_submission
+
+    DB.session.expire_all()
+    with count_queries() as statements:
+        process_and_commit_submission(sub_id, ["name"])
+
+    selects = [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+    assert len(selects) == 1
+    assert msend.call_count == 1
+    assert msend.call_args[1]["to"] == ["one@example.com", "two@example.com"]
+    assert msend.call_args[1]["subject"] == "new submission"
+
+
+def test_rejected_batches_are_split_by_recipient(client, msend):
+    user, form = create_user_and_form(client)
+    user.plan = Plan.platinum
+    DB.session.add(user)
+
+    rules = {}
+    for address in ["good@example.com", "bad@example.com", "fine@example.com"]:
+        rule = RoutingRule(form.id)
+        rule.trigger = {"fn": "true", "field": "", "params": []}
+        rule.email = address
+        DB.session.add(rule)
+        DB.session.flush()
+        rules[address] = rule.id
+    DB.session.commit()
+
+    def provider(to, **kwargs):
+        if "bad@example.com" in (to if isinstance(to, list) else [to]):
+            return False, "Invalid address", 400
+        return True, "", 200
+
+    with patch("formspree.utils.send_email", side_effect=provider) as send:
+        r = client.post(f"/{form.hashid}", data={"name": "alice"})
+    assert r.status_code == 302
+    assert send.call_count == 4
+    assert send.call_args_list[0][1]["to"] == [
+        "bad@example.com",
+        "fine@example.com",
+        "good@example.com",
+    ]
+
+    sub = form.submissions.first()
+    assert [(e["message"], e["rule"]) for e in sub.errors] == [
+        ("Could not send email", rules["bad@example.com"])
+    ]
+
+
+def test_split_recipients_that_can_be_retried_are(client, msend):
+    from formspree.outbox import OutboxEmail
+
+    user, form = create_user_and_form(client)
+    user.plan = Plan.platinum
+    DB.session.add(user)
+
+    rules = {}
+    for address in ["good@example.com", "bad@example.com", "busy@example.com"]:
+        rule = RoutingRule(form.id)
+        rule.trigger = {"fn": "true", "field": "", "params": []}
+        rule.email = address
+        DB.session.add(rule)
+        DB.session.flush()
+        rules[address] = rule.id
+    DB.session.commit()
+
+    busy = []
+
+    def provider(to, **kwargs):
+        if "bad@example.com" in (to if isinstance(to, list) else [to]):
+            return False, "Invalid address", 400
+        if to == "busy@example.com" and not busy:
+            busy.append(to)
+            return False, "Try later", 503
+        return True, "", 200
+
+    with patch("formspree.utils.send_email", side_effect=provider) as send:
+        r = client.post(f"/{form.hashid}", data={"name": "alice"})
+    assert r.status_code == 302
+    # the batch, one each, then the one that was busy again
+    assert send.call_count == 5
+    assert send.call_args[1]["to"] == "busy@example.com"
+
+    email = OutboxEmail.query.filter_by(kind="submission").one()
+    assert email.status == "sent"
+    assert email.recipients == {"busy@example.com": [rules["busy@example.com"]]}
+    sub = form.submissions.first()
+    assert [(e["message"], e["rule"]) for e in sub.errors] == [
+        ("Could not send email", rules["bad@example.com"])
+    ]